@@ -0,0 +1,97 @@
+"""Measure requests/s and latency of the tile server over local keep-alive connections.
+
+Run from python/pmtiles: python -m benchmarks.bench_server
+"""
+
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from pmtiles.pool import ReaderPool
+from pmtiles.server import TileServer
+from pmtiles.tile import tileid_to_zxy, Compression, TileType
+from pmtiles.writer import Writer
+
+N = 20000
+REQUESTS = 20000
+CONNECTIONS = (1, 16)
+
+
+def make_archive(path, tile_size):
+    rng = random.Random(0)
+    with open(path, "wb") as f:
+        writer = Writer(f)
+        for tile_id in range(N):
+            writer.write_tile(tile_id, rng.randbytes(tile_size))
+        writer.finalize(
+            {"tile_compression": Compression.NONE, "tile_type": TileType.PNG}, {}
+        )
+
+
+def run_server(directory, ports):
+    async def main():
+        with ReaderPool.from_directory(directory) as pool:
+            server = await TileServer(pool).start("127.0.0.1", 0)
+            ports.put(server.sockets[0].getsockname()[1])
+            async with server:
+                await server.serve_forever()
+
+    asyncio.run(main())
+
+
+async def client(port, paths, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for path in paths:
+        start = time.perf_counter()
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def measure(port, name, connections):
+    rng = random.Random(1)
+    paths = []
+    for _ in range(REQUESTS):
+        z, x, y = tileid_to_zxy(rng.randrange(N))
+        paths.append(f"/{name}/{z}/{x}/{y}.png")
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[client(port, paths[i::connections], latencies) for i in range(connections)]
+    )
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[len(latencies) * 99 // 100] * 1000
+    print(
+        f"{name:>6} {connections:>2} connections {REQUESTS / elapsed:8.0f} req/s"
+        f"  p50 {p50:6.3f} ms  p99 {p99:6.3f} ms"
+    )
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        # small tiles are read and written, large ones go through sendfile
+        make_archive(os.path.join(directory, "small.pmtiles"), 2000)
+        make_archive(os.path.join(directory, "large.pmtiles"), 100000)
+        ports = multiprocessing.Queue()
+        server = multiprocessing.Process(target=run_server, args=(directory, ports))
+        server.start()
+        try:
+            port = ports.get()
+            for name in ("small", "large"):
+                for connections in CONNECTIONS:
+                    asyncio.run(measure(port, name, connections))
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
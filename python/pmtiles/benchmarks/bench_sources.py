@@ -0,0 +1,61 @@
+"""Compare serving tiles through copying, zero-copy and pread sources.
+
+Run from python/pmtiles: python -m benchmarks.bench_sources
+"""
+
+import os
+import random
+import tempfile
+import timeit
+
+from pmtiles.reader import Reader, MmapSource, PreadSource
+from pmtiles.tile import tileid_to_zxy, Compression, TileType
+from pmtiles.writer import Writer
+
+N = 4000
+TILE_SIZE = 50000
+REQUESTS = 20000
+
+
+def make_archive(f):
+    rng = random.Random(0)
+    writer = Writer(f)
+    for tile_id in range(N):
+        writer.write_tile(tile_id, rng.randbytes(TILE_SIZE // 2) * 2)
+    writer.finalize(
+        {"tile_compression": Compression.NONE, "tile_type": TileType.PNG}, {}
+    )
+    f.flush()
+
+
+def serve(reader, tiles, sink):
+    # write each tile out, as a server would to its socket
+    for zxy in tiles:
+        sink.write(reader.get(*zxy))
+
+
+def report(name, fn, number=1):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    mb = REQUESTS * TILE_SIZE / seconds / 1e6
+    print(f"{name:<20} {seconds * 1000:9.2f} ms  {REQUESTS / seconds:9.0f} tiles/s  {mb:8.0f} MB/s")
+
+
+def main():
+    rng = random.Random(1)
+    tiles = [tileid_to_zxy(rng.randrange(N)) for _ in range(REQUESTS)]
+    with tempfile.TemporaryFile() as f, open(os.devnull, "wb") as sink:
+        make_archive(f)
+        print(f"{REQUESTS} requests for {TILE_SIZE // 1000} KB tiles from a {N} tile archive")
+        with MmapSource(f) as source:
+            reader = Reader(source)
+            report("mmap copy", lambda: serve(reader, tiles, sink))
+        with MmapSource(f, zero_copy=True) as source:
+            reader = Reader(source)
+            report("mmap zero-copy", lambda: serve(reader, tiles, sink))
+            del reader
+        reader = Reader(PreadSource(f))
+        report("pread", lambda: serve(reader, tiles, sink))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Measure how one shared Reader scales across threads.
+
+Run from python/pmtiles: python -m benchmarks.bench_threads
+"""
+
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pmtiles.reader import Reader, PreadSource
+from pmtiles.tile import tileid_to_zxy, Compression, TileType
+from pmtiles.writer import Writer
+
+N = 200000
+REQUESTS = 200000
+
+
+def make_archive(f):
+    rng = random.Random(0)
+    writer = Writer(f)
+    tile_ids = []
+    tile_id = 0
+    for _ in range(N):
+        tile_id += rng.randint(1, 50)
+        tile_ids.append(tile_id)
+        writer.write_tile(tile_id, rng.randbytes(rng.randint(100, 4000)))
+    writer.finalize(
+        {"tile_compression": Compression.NONE, "tile_type": TileType.PNG}, {}
+    )
+    f.flush()
+    return tile_ids
+
+
+def run(reader, tiles, threads):
+    barrier = threading.Barrier(threads)
+    chunk = len(tiles) // threads
+
+    def work(i):
+        barrier.wait()
+        for zxy in tiles[i * chunk : (i + 1) * chunk]:
+            reader.get(*zxy)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(work, range(threads)))
+    return chunk * threads / (time.perf_counter() - start)
+
+
+def main():
+    rng = random.Random(1)
+    with tempfile.TemporaryFile() as f:
+        tile_ids = make_archive(f)
+        tiles = [tileid_to_zxy(rng.choice(tile_ids)) for _ in range(REQUESTS)]
+        print(f"{REQUESTS} random requests against a {N} tile archive")
+        for cold in (True, False):
+            base = None
+            reader = Reader(PreadSource(f))
+            for threads in (1, 2, 4, 8, 16):
+                if cold:
+                    reader = Reader(PreadSource(f))
+                rate = run(reader, tiles, threads)
+                base = base or rate
+                label = "cold" if cold else "warm"
+                stats = reader.cache.stats()
+                print(
+                    f"{label} {threads:>2} threads {rate:10.0f} tiles/s  x{rate / base:4.2f}"
+                    f"  misses {stats['misses']:>5} coalesced {stats['coalesced']:>4}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Compare the bit-by-bit Hilbert conversion with the table driven and bulk versions.
+
+Run from python/pmtiles: python -m benchmarks.bench_tileid
+"""
+
+import random
+import timeit
+from array import array
+
+import pmtiles.tile
+from pmtiles.tile import (
+    zxy_to_tileid,
+    tileid_to_zxy,
+    zxy_to_tileid_array,
+    tileid_to_zxy_array,
+    _zxy_to_tileid_reference,
+    _tileid_to_zxy_reference,
+)
+
+N = 200000
+
+
+def make_tiles():
+    rng = random.Random(0)
+    zs, xs, ys = array("Q"), array("Q"), array("Q")
+    for _ in range(N):
+        z = rng.randint(10, 16)
+        zs.append(z)
+        xs.append(rng.getrandbits(z))
+        ys.append(rng.getrandbits(z))
+    return zs, xs, ys
+
+
+def report(name, fn, number=3):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print(f"{name:<32} {seconds * 1000:9.2f} ms  {N / seconds / 1e6:7.2f} M tiles/s")
+
+
+def main():
+    zs, xs, ys = make_tiles()
+    tileids = zxy_to_tileid_array(zs, xs, ys)
+
+    print(f"{N} tiles at z10-z16, numpy {'available' if pmtiles.tile.np else 'not installed'}")
+    report("zxy_to_tileid bitwise", lambda: list(map(_zxy_to_tileid_reference, zs, xs, ys)))
+    report("zxy_to_tileid tables", lambda: list(map(zxy_to_tileid, zs, xs, ys)))
+    report("tileid_to_zxy bitwise", lambda: list(map(_tileid_to_zxy_reference, tileids)))
+    report("tileid_to_zxy tables", lambda: list(map(tileid_to_zxy, tileids)))
+    if pmtiles.tile.np:
+        np = pmtiles.tile.np
+        report("zxy_to_tileid_array array", lambda: zxy_to_tileid_array(zs, xs, ys))
+        report("tileid_to_zxy_array array", lambda: tileid_to_zxy_array(tileids))
+        nz, nx, ny = (np.frombuffer(v, dtype=np.uint64) for v in (zs, xs, ys))
+        ntileids = np.frombuffer(tileids, dtype=np.uint64)
+        report("zxy_to_tileid_array numpy", lambda: zxy_to_tileid_array(nz, nx, ny))
+        report("tileid_to_zxy_array numpy", lambda: tileid_to_zxy_array(ntileids))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Compare the per-byte varint functions with the bulk codec.
+
+Run from python/pmtiles: python -m benchmarks.bench_varint
+"""
+
+import io
+import random
+import timeit
+from array import array
+
+import pmtiles.tile
+from pmtiles.tile import (
+    Directory,
+    read_varint,
+    write_varint,
+    decode_varints,
+    encode_varints,
+    serialize_directory,
+    deserialize_directory,
+    _decode_varints_python,
+    _encode_varints_python,
+)
+
+N = 200000
+
+
+def make_values():
+    rng = random.Random(0)
+    # mostly small values, like tile id deltas, run lengths and lengths
+    return array("Q", [rng.getrandbits(rng.choice((3, 7, 14, 21, 28))) for _ in range(N)])
+
+
+def make_directory():
+    directory = Directory()
+    offset = 0
+    for i in range(N):
+        length = 200 + (i * 7919) % 20000
+        directory.append(i * 2, offset, length, 1)
+        offset += length
+    return directory
+
+
+def per_byte_decode(buf, count):
+    b_io = io.BytesIO(buf)
+    return [read_varint(b_io) for _ in range(count)]
+
+
+def per_byte_encode(values):
+    b_io = io.BytesIO()
+    for v in values:
+        write_varint(b_io, v)
+    return b_io.getvalue()
+
+
+def python_encode(values):
+    out = bytearray()
+    _encode_varints_python(values, out)
+    return out
+
+
+def report(name, fn, number=3):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print(f"{name:<32} {seconds * 1000:9.2f} ms  {N / seconds / 1e6:7.2f} M values/s")
+
+
+def main():
+    values = make_values()
+    encoded = bytes(encode_varints(values))
+    directory = make_directory()
+    serialized = serialize_directory(directory)
+
+    print(f"{N} values, numpy {'available' if pmtiles.tile.np else 'not installed'}")
+    report("decode per byte (read_varint)", lambda: per_byte_decode(encoded, N))
+    report("decode bulk python", lambda: _decode_varints_python(encoded, N, 0))
+    if pmtiles.tile.np:
+        report("decode bulk numpy", lambda: decode_varints(encoded, N))
+    report("encode per byte (write_varint)", lambda: per_byte_encode(values))
+    report("encode bulk python", lambda: python_encode(values))
+    if pmtiles.tile.np:
+        report("encode bulk numpy", lambda: encode_varints(values))
+
+    report("deserialize_directory", lambda: deserialize_directory(serialized))
+    report("serialize_directory", lambda: serialize_directory(directory))
+    if pmtiles.tile.np:
+        numpy = pmtiles.tile.np
+        pmtiles.tile.np = None
+        report("deserialize_directory (no numpy)", lambda: deserialize_directory(serialized))
+        report("serialize_directory (no numpy)", lambda: serialize_directory(directory))
+        pmtiles.tile.np = numpy
+
+
+if __name__ == "__main__":
+    main()
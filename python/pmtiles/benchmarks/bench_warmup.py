@@ -0,0 +1,85 @@
+"""Compare cold-start request latency with and without warmup and a sidecar index.
+
+Run from python/pmtiles: python -m benchmarks.bench_warmup
+"""
+
+import os
+import random
+import tempfile
+import time
+
+from pmtiles.reader import Reader, PreadSource
+from pmtiles.tile import tileid_to_zxy, Compression, TileType
+from pmtiles.writer import Writer
+
+N = 500000
+REQUESTS = 2000
+
+# simulated round trip of each read, as against object storage
+LATENCY = 0.002
+
+
+def make_archive(f):
+    rng = random.Random(0)
+    writer = Writer(f)
+    tile_ids = []
+    tile_id = 0
+    for i in range(N):
+        tile_id += rng.randint(1, 50)
+        tile_ids.append(tile_id)
+        writer.write_tile(tile_id, str(i).encode())
+    writer.finalize(
+        {"tile_compression": Compression.NONE, "tile_type": TileType.MVT}, {}
+    )
+    f.flush()
+    return tile_ids
+
+
+def SlowSource(f):
+    source = PreadSource(f)
+
+    def get_bytes(offset, length):
+        time.sleep(LATENCY)
+        return source(offset, length)
+
+    return get_bytes
+
+
+def requests(reader, tiles):
+    latencies = []
+    for zxy in tiles:
+        start = time.perf_counter()
+        reader.get(*zxy)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return sum(latencies) / len(latencies), latencies[len(latencies) * 99 // 100]
+
+
+def main():
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp, open(os.path.join(tmp, "a.pmtiles"), "w+b") as f:
+        tile_ids = make_archive(f)
+        tiles = [tileid_to_zxy(rng.choice(tile_ids)) for _ in range(REQUESTS)]
+        index = os.path.join(tmp, "a.pmtiles.idx")
+        print(f"{REQUESTS} random requests, {LATENCY * 1000:.0f} ms per read")
+        for label, kwargs in (
+            ("cold", None),
+            ("warmup", {}),
+            ("warmup all leaves", {"leaves": True}),
+            ("save index", {"leaves": True, "index": index}),
+            ("load index", {"leaves": True, "index": index}),
+        ):
+            reader = Reader(SlowSource(f))
+            start = time.perf_counter()
+            if kwargs is not None:
+                reader.warmup(**kwargs)
+            warmup = (time.perf_counter() - start) * 1000
+            mean, p99 = requests(reader, tiles)
+            print(
+                f"{label:>18}: warmup {warmup:8.1f} ms, then mean {mean:6.3f} ms"
+                f"  p99 {p99:6.3f} ms per request"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import asyncio
+import gzip
+import json
+import os
+import ssl as ssl_module
+from urllib.parse import urlsplit
+from .tile import (
+    deserialize_header,
+    deserialize_directory,
+    zxy_to_tileid,
+    tileid_to_zxy,
+    find_tile,
+    Compression,
+)
+from .cache import DirectoryCache
+
+
+def FileSource(f):
+    """Read byte ranges of an open binary file with os.pread on the default executor."""
+    fd = f.fileno()
+
+    async def get_bytes(offset, length):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, os.pread, fd, length, offset)
+
+    return get_bytes
+
+
+def AiofilesSource(f):
+    """Read byte ranges of a file opened with aiofiles.open(path, "rb")."""
+    lock = asyncio.Lock()
+
+    async def get_bytes(offset, length):
+        async with lock:
+            await f.seek(offset)
+            return await f.read(length)
+
+    return get_bytes
+
+
+def AiohttpSource(session, url, headers=None):
+    """Read byte ranges of a remote archive through an aiohttp.ClientSession."""
+
+    async def get_bytes(offset, length):
+        request_headers = dict(headers or {})
+        request_headers["Range"] = f"bytes={offset}-{offset + length - 1}"
+        async with session.get(url, headers=request_headers) as resp:
+            resp.raise_for_status()
+            data = await resp.read()
+        if resp.status == 200:
+            return data[offset : offset + length]
+        return data
+
+    return get_bytes
+
+
+async def _read_chunked(reader):
+    body = bytearray()
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            return bytes(body)
+        body += await reader.readexactly(size)
+        await reader.readline()
+
+
+def HttpSource(url, headers=None, ssl=None):
+    """Read byte ranges of a remote archive with HTTP/1.1 range requests.
+
+    Uses only asyncio streams, opening one connection per request.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise ValueError(f"unsupported URL scheme {parts.scheme!r}")
+    https = parts.scheme == "https"
+    host = parts.hostname
+    port = parts.port or (443 if https else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    host_header = parts.netloc.rsplit("@", 1)[-1]
+    if https and ssl is None:
+        ssl = ssl_module.create_default_context()
+
+    async def get_bytes(offset, length):
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=ssl if https else None
+        )
+        try:
+            lines = [
+                f"GET {path} HTTP/1.1",
+                f"Host: {host_header}",
+                f"Range: bytes={offset}-{offset + length - 1}",
+                "Connection: close",
+            ]
+            for k, v in (headers or {}).items():
+                lines.append(f"{k}: {v}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                response_headers[k.strip().lower()] = v.strip()
+
+            if response_headers.get("transfer-encoding", "").lower() == "chunked":
+                body = await _read_chunked(reader)
+            elif "content-length" in response_headers:
+                body = await reader.readexactly(int(response_headers["content-length"]))
+            else:
+                body = await reader.read()
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+        if status == 206:
+            return body
+        if status == 200:
+            return body[offset : offset + length]
+        if status == 416:
+            return b""
+        raise OSError(f"unexpected HTTP status {status} for {url}")
+
+    return get_bytes
+
+
+class AsyncReader:
+    """Reader for sources whose get_bytes(offset, length) is a coroutine function.
+
+    Concurrent requests for the header or the same directory share one fetch.
+    """
+
+    def __init__(self, get_bytes, cache=None):
+        self.get_bytes = get_bytes
+        self.cache = DirectoryCache() if cache is None else cache
+        self._header = None
+        self._inflight = {}
+
+    async def _coalesce(self, key, load):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load_header(self):
+        self._header = deserialize_header(await self.get_bytes(0, 127))
+        return self._header
+
+    async def header(self):
+        if self._header is None:
+            return await self._coalesce("header", self._load_header)
+        return self._header
+
+    async def _load_directory(self, offset, length):
+        directory = deserialize_directory(await self.get_bytes(offset, length))
+        self.cache.put(offset, directory)
+        return directory
+
+    async def directory(self, offset, length):
+        directory = self.cache.lookup(offset)
+        if directory is None:
+            directory = await self._coalesce(
+                offset, lambda: self._load_directory(offset, length)
+            )
+        return directory
+
+    async def metadata(self):
+        header = await self.header()
+        metadata = await self.get_bytes(
+            header["metadata_offset"], header["metadata_length"]
+        )
+        if header["internal_compression"] == Compression.GZIP:
+            metadata = gzip.decompress(metadata)
+        return json.loads(metadata)
+
+    async def get(self, z, x, y):
+        tile_id = zxy_to_tileid(z, x, y)
+        header = await self.header()
+        dir_offset = header["root_offset"]
+        dir_length = header["root_length"]
+        for depth in range(0, 4):  # max depth
+            directory = await self.directory(dir_offset, dir_length)
+            result = find_tile(directory, tile_id)
+            if result is None:
+                return None
+            if result.run_length == 0:
+                dir_offset = header["leaf_directory_offset"] + result.offset
+                dir_length = result.length
+            else:
+                return await self.get_bytes(
+                    header["tile_data_offset"] + result.offset, result.length
+                )
+
+    async def _traverse(self, header, dir_offset, dir_length):
+        entries = deserialize_directory(await self.get_bytes(dir_offset, dir_length))
+        for entry in entries:
+            if entry.run_length > 0:
+                data = await self.get_bytes(
+                    header["tile_data_offset"] + entry.offset, entry.length
+                )
+                for i in range(entry.run_length):
+                    yield tileid_to_zxy(entry.tile_id + i), data
+            else:
+                async for t in self._traverse(
+                    header,
+                    header["leaf_directory_offset"] + entry.offset,
+                    entry.length,
+                ):
+                    yield t
+
+    async def all_tiles(self):
+        header = await self.header()
+        async for t in self._traverse(
+            header, header["root_offset"], header["root_length"]
+        ):
+            yield t
@@ -0,0 +1,177 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from .tile import Directory
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# approximate in-memory cost of one parsed Entry: the slotted object plus its four ints
+_ENTRY_BYTES = 48 + 4 * 32
+
+
+def directory_nbytes(directory):
+    if isinstance(directory, Directory):
+        return 64 + directory.nbytes
+    return 64 + len(directory) * _ENTRY_BYTES
+
+
+class DirectoryCache:
+    """A byte-budgeted LRU cache of parsed directories.
+
+    Values are loaded on a miss and evicted least-recently-used first once the
+    approximate size of all cached directories exceeds max_bytes.
+
+    All methods are thread-safe. Concurrent get() calls missing the same key
+    share one load; the others wait for its result and count as coalesced.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _lookup(self, key):
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def lookup(self, key):
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            return value
+
+    def get(self, key, load):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            future = self._loading.get(key)
+            if future is None:
+                future = self._loading[key] = Future()
+                self.misses += 1
+                owner = True
+            else:
+                self.coalesced += 1
+                owner = False
+        if not owner:
+            return future.result()
+        try:
+            value = load()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._put(key, value)
+            del self._loading[key]
+        future.set_result(value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        nbytes = directory_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+        self._entries[key] = (value, nbytes)
+        self.current_bytes += nbytes
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_bytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def items(self):
+        """A snapshot list of the cached (key, directory) pairs, oldest first."""
+        with self._lock:
+            return [(key, item[0]) for key, item in self._entries.items()]
+
+    def discard_where(self, predicate):
+        """Remove every entry whose key satisfies predicate; return how many."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self.current_bytes -= self._entries.pop(key)[1]
+        return len(keys)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class KeyedCache:
+    """A view of a shared DirectoryCache that prefixes every key.
+
+    Lets several readers share one byte budget: each reader's key becomes
+    (*prefix, key) in the underlying cache.
+    """
+
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = tuple(prefix)
+
+    def _key(self, key):
+        return self.prefix + (key,)
+
+    def __contains__(self, key):
+        return self._key(key) in self.cache
+
+    def lookup(self, key):
+        return self.cache.lookup(self._key(key))
+
+    def get(self, key, load):
+        return self.cache.get(self._key(key), load)
+
+    def put(self, key, value):
+        self.cache.put(self._key(key), value)
+
+    def items(self):
+        n = len(self.prefix)
+        return [
+            (key[n], value)
+            for key, value in self.cache.items()
+            if isinstance(key, tuple) and key[:n] == self.prefix
+        ]
+
+    def clear(self):
+        n = len(self.prefix)
+        self.cache.discard_where(
+            lambda key: isinstance(key, tuple) and key[:n] == self.prefix
+        )
+
+    def stats(self):
+        return self.cache.stats()
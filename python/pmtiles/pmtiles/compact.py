@@ -0,0 +1,107 @@
+"""Rewrite a PMTiles archive with its tile data in tile id order."""
+
+import os
+from collections import OrderedDict
+from .reader import Reader, MmapSource, iter_entries, DEFAULT_GAP
+from .writer import Writer, DEDUP_OFF, DEDUP_EXACT, COPY_CHUNK_SIZE, copy_entries
+
+
+def count_range_requests(entries, gap=DEFAULT_GAP, clustered=False, max_seen=None):
+    """Count the reads needed to fetch every tile in tile id order.
+
+    Consecutive tile contents closer than gap bytes are counted as one read,
+    and contents already fetched are not read again. In a clustered archive
+    contents are laid out in the order they are first addressed, so a
+    content is new exactly when it lies past everything read so far and the
+    count takes constant memory. Otherwise the offset of every distinct
+    content is remembered, unless max_seen bounds them to the most recent;
+    forgotten contents then count as read again.
+    """
+    requests = 0
+    end = None
+    high = 0
+    seen = OrderedDict()
+    for e in entries:
+        if clustered:
+            if e.offset < high:
+                continue
+            high = e.offset + e.length
+        else:
+            if e.offset in seen:
+                seen.move_to_end(e.offset)
+                continue
+            seen[e.offset] = None
+            if max_seen is not None and len(seen) > max_seen:
+                seen.popitem(last=False)
+        if end is None or not end <= e.offset <= end + gap:
+            requests += 1
+        end = e.offset + e.length
+    return requests
+
+
+def compact(
+    input,
+    output,
+    gap=DEFAULT_GAP,
+    chunk_size=COPY_CHUNK_SIZE,
+    max_memory_entries=None,
+    max_dedup_entries=None,
+):
+    """Write a clustered copy of input to output.
+
+    Tile contents are laid out in the order they are first addressed,
+    dropping bytes no entry refers to, and the directories are rebuilt with
+    freshly sized leaves. Data is copied in batches of about chunk_size and
+    entries are spilled to disk past max_memory_entries, as in Writer.
+
+    By default the output offset of every distinct content is kept in
+    memory, tens of bytes each. With max_dedup_entries, only that many
+    recent contents are remembered; older repeats are deduplicated by
+    content digest within the same bound, and may be stored twice once
+    forgotten.
+
+    Returns a dict with the sizes before and after, the bytes reclaimed, and
+    the number of range requests a full scan takes before and after.
+    """
+    with open(input, "rb") as f_in:
+        reader = Reader(MmapSource(f_in))
+        header = reader.header()
+        with open(output, "wb") as f_out:
+            writer = Writer(
+                f_out,
+                max_memory_entries=max_memory_entries,
+                max_dedup_entries=max_dedup_entries,
+                dedup=DEDUP_OFF if max_dedup_entries is None else DEDUP_EXACT,
+            )
+            entries = iter_entries(reader.get_bytes, header)
+            copy_entries(
+                writer,
+                [reader],
+                ((0, e) for e in entries),
+                gap,
+                chunk_size,
+                max_copied=max_dedup_entries,
+            )
+            writer.finalize(dict(header), reader.metadata())
+        before = count_range_requests(
+            iter_entries(reader.get_bytes, header),
+            gap,
+            clustered=header["clustered"],
+            max_seen=max_dedup_entries,
+        )
+
+    with open(output, "rb") as f_out:
+        compacted = Reader(MmapSource(f_out))
+        after = count_range_requests(
+            iter_entries(compacted.get_bytes), gap, clustered=True
+        )
+
+    bytes_before = os.path.getsize(input)
+    bytes_after = os.path.getsize(output)
+    return {
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "bytes_reclaimed": bytes_before - bytes_after,
+        "range_requests_before": before,
+        "range_requests_after": after,
+    }
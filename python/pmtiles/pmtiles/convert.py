@@ -3,8 +3,16 @@ import gzip
 import json
 import os
 import sqlite3
-from pmtiles.writer import write
-from pmtiles.reader import Reader, MmapSource, all_tiles
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from pmtiles.writer import write, bounded_map
+from pmtiles.reader import Reader, MmapSource, scan_tiles
 from .tile import zxy_to_tileid, tileid_to_zxy, TileType, Compression
 
 
@@ -66,41 +74,136 @@ def mbtiles_to_header_json(mbtiles_metadata):
     return header, mbtiles_metadata
 
 
-def mbtiles_to_pmtiles(input, output, maxzoom):
-    conn = sqlite3.connect(input)
+# rows handed to a worker at a time when recompressing tiles
+CONVERT_BATCH_SIZE = 256
+
+
+def _gzip_vector_tiles(batch):
+    # force gzip compression only for vector
+    return [
+        (tileid, key, data if data is None or data[0:2] == b"\x1f\x8b" else gzip.compress(data))
+        for tileid, key, data in batch
+    ]
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _has_map_images(cursor):
+    tables = {
+        row[0]
+        for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    }
+    return "map" in tables and "images" in tables
+
+
+def _ordered_tile_rows(conn, table, columns, maxzoom):
+    """Yield rows of table in ascending PMTiles tile id order.
+
+    The tile ids are computed once into a temporary table keyed by tile id,
+    which SQLite then walks in order while joining back to table.
+    """
+    conn.create_function(
+        "pmtiles_tileid",
+        3,
+        lambda z, x, y: zxy_to_tileid(z, x, (1 << z) - 1 - y),
+        deterministic=True,
+    )
     cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS temp.pmtiles_order")
+    cursor.execute(
+        "CREATE TEMP TABLE pmtiles_order "
+        "(tile_id INTEGER PRIMARY KEY, zoom_level, tile_column, tile_row)"
+    )
+    cursor.execute(
+        "INSERT INTO temp.pmtiles_order "
+        "SELECT pmtiles_tileid(zoom_level, tile_column, tile_row), zoom_level, tile_column, tile_row "
+        f"FROM {table} WHERE zoom_level <= ?",
+        (maxzoom,),
+    )
+    return cursor.execute(
+        f"SELECT o.tile_id, {columns} FROM temp.pmtiles_order o JOIN {table} t "
+        "ON t.zoom_level = o.zoom_level AND t.tile_column = o.tile_column AND t.tile_row = o.tile_row "
+        "ORDER BY o.tile_id"
+    )
 
-    with write(output) as writer:
 
-        # collect a set of all tile IDs
-        tileid_set = []
+def _map_images_rows(conn, maxzoom):
+    # images referenced by more than one tile are read once and then referenced
+    cursor = conn.cursor()
+    shared = {
+        row[0]
         for row in cursor.execute(
-            "SELECT zoom_level,tile_column,tile_row FROM tiles WHERE zoom_level <= ?",
-            (maxzoom or 99,),
-        ):
-            flipped = (1 << row[0]) - 1 - row[2]
-            tileid_set.append(zxy_to_tileid(row[0], row[1], flipped))
+            "SELECT tile_id FROM map WHERE zoom_level <= ? GROUP BY tile_id HAVING COUNT(*) > 1",
+            (maxzoom,),
+        )
+    }
+    read = set()
+    image_cursor = conn.cursor()
+    for tileid, image_id in _ordered_tile_rows(conn, "map", "t.tile_id", maxzoom):
+        if image_id in read:
+            yield tileid, image_id, None
+            continue
+        data = image_cursor.execute(
+            "SELECT tile_data FROM images WHERE tile_id = ?", (image_id,)
+        ).fetchone()[0]
+        if image_id in shared:
+            read.add(image_id)
+            yield tileid, image_id, data
+        else:
+            yield tileid, None, data
 
-        tileid_set.sort()
 
-        mbtiles_metadata = {}
-        for row in cursor.execute("SELECT name,value FROM metadata"):
-            mbtiles_metadata[row[0]] = row[1]
-        is_pbf = mbtiles_metadata["format"] == "pbf"
+def mbtiles_to_pmtiles(input, output, maxzoom, workers=None, map_images=None):
+    """Convert an MBTiles file to PMTiles.
 
-        # query the db in ascending tile order
-        for tileid in tileid_set:
-            z, x, y = tileid_to_zxy(tileid)
-            flipped = (1 << z) - 1 - y
-            res = cursor.execute(
-                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
-                (z, x, flipped),
+    Tiles are read in a single scan ordered by PMTiles tile id. Vector tiles
+    that are not yet gzipped are compressed on a pool of worker threads.
+
+    With map_images (detected automatically when None) the deduplicated
+    map/images table layout is read directly, so each shared image is read
+    and compressed once.
+    """
+    conn = sqlite3.connect(input)
+    cursor = conn.cursor()
+
+    mbtiles_metadata = {}
+    for row in cursor.execute("SELECT name,value FROM metadata"):
+        mbtiles_metadata[row[0]] = row[1]
+    is_pbf = mbtiles_metadata["format"] == "pbf"
+
+    if map_images is None:
+        map_images = _has_map_images(cursor)
+    if map_images:
+        rows = _map_images_rows(conn, maxzoom or 99)
+    else:
+        rows = (
+            (tileid, None, data)
+            for tileid, data in _ordered_tile_rows(
+                conn, "tiles", "t.tile_data", maxzoom or 99
             )
-            data = res.fetchone()[0]
-            # force gzip compression only for vector
-            if is_pbf and data[0:2] != b"\x1f\x8b":
-                data = gzip.compress(data)
-            writer.write_tile(tileid, data)
+        )
+
+    with write(output) as writer, ThreadPoolExecutor(workers) as executor:
+        batches = _batches(rows, CONVERT_BATCH_SIZE)
+        if is_pbf:
+            batches = bounded_map(executor, _gzip_vector_tiles, batches)
+
+        written = {}
+        for batch in batches:
+            for tileid, image_id, data in batch:
+                if data is None:
+                    writer.write_tile_reference(tileid, *written[image_id])
+                    continue
+                offset = writer.write_tile(tileid, data)
+                if image_id is not None:
+                    written[image_id] = (offset, len(data))
 
         pmtiles_header, pmtiles_metadata = mbtiles_to_header_json(mbtiles_metadata)
         if maxzoom:
@@ -111,15 +214,77 @@ def mbtiles_to_pmtiles(input, output, maxzoom):
     conn.close()
 
 
-def pmtiles_to_mbtiles(input, output):
+# rows inserted per executemany call when exporting to MBTiles
+MBTILES_BATCH_SIZE = 4096
+
+
+def _insert_tiles(cursor, source, batch_size):
+    batch = []
+    for (z, x, y), tile_data in scan_tiles(source):
+        batch.append((z, x, (1 << z) - 1 - y, tile_data))
+        if len(batch) >= batch_size:
+            cursor.executemany("INSERT INTO tiles VALUES(?,?,?,?)", batch)
+            batch = []
+    cursor.executemany("INSERT INTO tiles VALUES(?,?,?,?)", batch)
+
+
+def _insert_map_images(cursor, source, clustered, batch_size):
+    # one image per distinct PMTiles content, identified by its offset and length
+    images = []
+    rows = []
+    seen = set()
+    high_water = 0
+    last_new = None
+    for entry, tile_data in scan_tiles(source, expand_runs=False):
+        content = (entry.offset, entry.length)
+        if clustered:
+            # in clustered archives new contents appear in offset order
+            new = entry.offset >= high_water and content != last_new
+        else:
+            new = content not in seen
+            seen.add(content)
+        image_id = f"{entry.offset}:{entry.length}"
+        if new:
+            images.append((tile_data, image_id))
+            high_water = entry.offset + entry.length
+            last_new = content
+        for tileid in range(entry.tile_id, entry.tile_id + entry.run_length):
+            z, x, y = tileid_to_zxy(tileid)
+            rows.append((z, x, (1 << z) - 1 - y, image_id))
+        if len(rows) >= batch_size or len(images) >= batch_size:
+            cursor.executemany("INSERT INTO images VALUES(?,?)", images)
+            cursor.executemany("INSERT INTO map VALUES(?,?,?,?)", rows)
+            images = []
+            rows = []
+    cursor.executemany("INSERT INTO images VALUES(?,?)", images)
+    cursor.executemany("INSERT INTO map VALUES(?,?,?,?)", rows)
+
+
+def pmtiles_to_mbtiles(input, output, deduplicate=False, batch_size=MBTILES_BATCH_SIZE):
+    """Convert a PMTiles archive to MBTiles.
+
+    Rows are inserted in executemany batches with journaling and syncing
+    disabled for the duration of the load. With deduplicate, tiles are written
+    to the map/images layout behind a tiles view, storing every distinct
+    PMTiles content once.
+    """
     conn = sqlite3.connect(output)
     cursor = conn.cursor()
+    cursor.execute("PRAGMA page_size = 16384")
+    cursor.execute("PRAGMA journal_mode = OFF")
+    cursor.execute("PRAGMA synchronous = OFF")
     cursor.execute("CREATE TABLE metadata (name text, value text);")
-    cursor.execute(
-        "CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);"
-    )
+    if deduplicate:
+        cursor.execute(
+            "CREATE TABLE map (zoom_level integer, tile_column integer, tile_row integer, tile_id text);"
+        )
+        cursor.execute("CREATE TABLE images (tile_data blob, tile_id text);")
+    else:
+        cursor.execute(
+            "CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);"
+        )
 
-    with open(input, "r+b") as f:
+    with open(input, "rb") as f:
         source = MmapSource(f)
 
         reader = Reader(source)
@@ -167,35 +332,187 @@ def pmtiles_to_mbtiles(input, output):
                 ("json", json.dumps(json_metadata, ensure_ascii=False)),
             )
 
-        for zxy, tile_data in all_tiles(source):
-            flipped_y = (1 << zxy[0]) - 1 - zxy[2]
-            cursor.execute(
-                "INSERT INTO tiles VALUES(?,?,?,?)",
-                (zxy[0], zxy[1], flipped_y, tile_data),
-            )
-
-    cursor.execute(
-        "CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);"
-    )
+        if deduplicate:
+            _insert_map_images(cursor, source, header["clustered"], batch_size)
+        else:
+            _insert_tiles(cursor, source, batch_size)
+
+    if deduplicate:
+        cursor.execute(
+            "CREATE UNIQUE INDEX map_index on map (zoom_level, tile_column, tile_row);"
+        )
+        cursor.execute("CREATE UNIQUE INDEX images_id on images (tile_id);")
+        cursor.execute(
+            "CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, "
+            "map.tile_column AS tile_column, map.tile_row AS tile_row, "
+            "images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id;"
+        )
+    else:
+        cursor.execute(
+            "CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);"
+        )
     conn.commit()
+    cursor.execute("PRAGMA journal_mode = DELETE")
     conn.close()
 
 
-def pmtiles_to_dir(input, output):
+TILE_EXTENSIONS = {
+    TileType.MVT: "mvt",
+    TileType.PNG: "png",
+    TileType.JPEG: "jpg",
+    TileType.WEBP: "webp",
+    TileType.AVIF: "avif",
+    TileType.MLT: "mlt",
+}
+
+# paths of recently written tile contents kept for linking duplicates
+LINK_CACHE_SIZE = 65536
+
+# ioctl request cloning a whole file on filesystems with reflinks (Linux)
+FICLONE = 0x40049409
+
+
+def _link_file(src, dst, link):
+    try:
+        if link == "hardlink":
+            os.link(src, dst)
+        elif link == "reflink" and fcntl is not None:
+            with open(src, "rb") as s, open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        else:
+            return False
+    except OSError:
+        return False
+    return True
+
+
+def _write_tile_files(jobs, link):
+    # returns (offset, path) of contents written out in full by this batch
+    written = []
+    for offset, paths, data, source_path in jobs:
+        for path in paths:
+            if source_path is not None and _link_file(source_path, path, link):
+                continue
+            with open(path, "wb") as f:
+                f.write(data)
+            if link and source_path is None:
+                written.append((offset, path))
+                source_path = path
+    return written
+
+
+def pmtiles_to_dir(input, output, workers=None, link=None):
+    """Extract a PMTiles archive to a z/x/y directory of tile files.
+
+    Files are named after the header tile type and written on a pool of
+    worker threads. With link set to "hardlink" or "reflink", tiles sharing
+    content with an already written tile are linked to it instead, falling
+    back to a plain copy where the filesystem does not support it.
+    """
     os.makedirs(output)
-    with open(input, "r+b") as f:
+    with open(input, "rb") as f:
         source = MmapSource(f)
 
         reader = Reader(source)
         with open(os.path.join(output, "metadata.json"), "w") as f:
             f.write(json.dumps(reader.metadata()))
+        ext = TILE_EXTENSIONS.get(reader.header()["tile_type"], "bin")
+
+        made = set()
+        recent = OrderedDict()
+
+        def jobs():
+            for entry, tile_data in scan_tiles(source, expand_runs=False):
+                paths = []
+                for tileid in range(entry.tile_id, entry.tile_id + entry.run_length):
+                    z, x, y = tileid_to_zxy(tileid)
+                    directory = os.path.join(output, str(z), str(x))
+                    if directory not in made:
+                        os.makedirs(directory, exist_ok=True)
+                        made.add(directory)
+                    paths.append(os.path.join(directory, f"{y}.{ext}"))
+                source_path = recent.get(entry.offset) if link else None
+                yield entry.offset, paths, tile_data, source_path
+
+        with ThreadPoolExecutor(workers) as executor:
+            batches = _batches(jobs(), CONVERT_BATCH_SIZE)
+            for written in bounded_map(
+                executor, lambda b: _write_tile_files(b, link), batches
+            ):
+                # only completed files are used as link sources
+                for offset, path in written:
+                    recent[offset] = path
+                    recent.move_to_end(offset)
+                    if len(recent) > LINK_CACHE_SIZE:
+                        recent.popitem(last=False)
+
+
+def _tile_xy(scheme, z, row_name, file_name):
+    if scheme == "ags":
+        return int(file_name.replace("C", ""), 16), int(row_name.replace("R", ""), 16)
+    if scheme == "gwc":
+        x, y = file_name.split("_")
+        return int(x), flip_y(z, int(y))
+    if scheme == "zyx":
+        return int(file_name), int(row_name)
+    if scheme == "tms":
+        return int(row_name), flip_y(z, int(file_name))
+    return int(row_name), int(file_name)
+
+
+def _zoom_of(scheme, zoom_name):
+    if scheme == "ags":
+        return int(zoom_name.replace("L", ""))
+    if scheme == "gwc":
+        return int(zoom_name[-2:])
+    return int(zoom_name)
+
+
+def _subdirs(path):
+    with os.scandir(path) as it:
+        return [(e.name, e.path) for e in it if e.is_dir()]
+
+
+def scan_tile_directory(directory_path, scheme=None, minzoom=0, maxzoom=99, verbose=False):
+    """Find the tiles of a z/x/y style directory tree using os.scandir.
+
+    Returns (tileids, paths, zooms) where tileids is an array('Q') parallel to
+    the list of file paths, and zooms is the set of zoom levels found.
+    """
+    tileids = array("Q")
+    paths = []
+    zooms = set()
+    for zoom_name, zoom_path in _subdirs(directory_path):
+        z = _zoom_of(scheme, zoom_name)
+        if not minzoom <= z <= maxzoom:
+            continue
+        zooms.add(z)
+        if verbose:
+            print(" Searching for tiles at z=%s ..." % (z), end="", flush=True)
+        count = len(paths)
+        for row_name, row_path in _subdirs(zoom_path):
+            with os.scandir(row_path) as it:
+                for entry in it:
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    x, y = _tile_xy(scheme, z, row_name, entry.name.split(".", 1)[0])
+                    tileids.append(zxy_to_tileid(z, x, y))
+                    paths.append(entry.path)
+        if verbose:
+            print(" found %s" % (len(paths) - count))
+    return tileids, paths, zooms
 
-        for zxy, tile_data in all_tiles(source):
-            directory = os.path.join(output, str(zxy[0]), str(zxy[1]))
-            path = os.path.join(directory, str(zxy[2]) + "." + "mvt")
-            os.makedirs(directory, exist_ok=True)
-            with open(path, "wb") as f:
-                f.write(tile_data)
+
+def _read_tile_files(batch, is_pbf):
+    result = []
+    for tileid, filepath in batch:
+        with open(filepath, "rb") as f:
+            data = f.read()
+        # force gzip compression only for vector
+        if is_pbf and data[0:2] != b"\x1f\x8b":
+            data = gzip.compress(data)
+        result.append((tileid, data))
+    return result
 
 
 def disk_to_pmtiles(directory_path, output, maxzoom, **kwargs):
@@ -214,6 +531,7 @@ def disk_to_pmtiles(directory_path, output, maxzoom, **kwargs):
         scheme (str): Tiling scheme of the directory ('ags', 'gwc', 'tms', 'zyx', 'zxy' (default)).
         tile_format (str): Image format of the tiles ('png', 'jpeg', 'webp', 'avif') if not given in the metadata.
         verbose (bool): Set True to print progress.
+        workers (int): Number of threads reading and compressing tile files.
 
     Uses modified elements of 'disk_to_mbtiles' from mbutil
 
@@ -235,74 +553,19 @@ def disk_to_pmtiles(directory_path, output, maxzoom, **kwargs):
         raise Exception("tile format not found in metadata.json nor specified as keyword argument")
     metadata["format"] = tile_format  # Add 'format' to metadata
 
-    scheme = kwargs.get('scheme')
-
-    # Collect a set of all tile IDs
-    z_set = []  # List of all zoom levels for auto-detecting maxzoom.
-    tileid_path_set = []  # List of tile (id, filepath) pairs
-    zoom_dirs = get_dirs(directory_path)
-    zoom_dirs.sort(key=len)
     try:
         collect_max = int(maxzoom)
     except ValueError:
         collect_max = 99
     collect_min = metadata.get("minzoom", 0)
-    count = 0
-    warned = False
-    for zoom_dir in zoom_dirs:
-        if scheme == 'ags':
-            z = int(zoom_dir.replace("L", ""))
-        elif scheme == 'gwc':
-            z=int(zoom_dir[-2:])
-        else:
-            z = int(zoom_dir)
-        if not collect_min <= z <= collect_max:
-            continue
-        z_set.append(z)
-        if z > 9 and not warned:
-            print(" Warning: Large tilesets (z > 9) require extreme processing times.")
-            warned = True
-        if verbose:
-            print(" Searching for tiles at z=%s ..." % (z), end="", flush=True)
-        count = 0
-        for row_dir in get_dirs(os.path.join(directory_path, zoom_dir)):
-            if scheme == 'ags':
-                y = int(row_dir.replace("R", ""), 16)
-            elif scheme == 'gwc':
-                pass
-            elif scheme == 'zyx':
-                y = int(row_dir)
-            else:
-                x = int(row_dir)
-            for current_file in os.listdir(os.path.join(directory_path, zoom_dir, row_dir)):
-                if current_file == ".DS_Store":
-                    pass
-                else:
-                    file_name, _ = current_file.split('.',1)
-                    if scheme == 'tms':
-                        y = flip_y(z, int(file_name))
-                    elif scheme == 'ags':
-                        x = int(file_name.replace("C", ""), 16)
-                    elif scheme == 'gwc':
-                        x, y = file_name.split('_')
-                        x = int(x)
-                        y = flip_y(z, int(y))
-                    elif scheme == 'zyx':
-                        x = int(file_name)
-                    else:
-                        y = int(file_name)
-
-                    tileid = zxy_to_tileid(z, x, y)
-                    filepath = os.path.join(directory_path, zoom_dir, row_dir, current_file)
-                    tileid_path_set.append((tileid, filepath))
-                    count = count + 1
-        if verbose:
-            print(" found %s" % (count))
+    tileids, paths, z_set = scan_tile_directory(
+        directory_path, kwargs.get("scheme"), collect_min, collect_max, verbose
+    )
 
-    n_tiles = len(tileid_path_set)
+    n_tiles = len(paths)
     if verbose:
         print(" Sorting list of %s tile IDs ..." % (n_tiles), end="")
-    tileid_path_set.sort(key=lambda x: x[0])  # Sort by tileid
+    order = sorted(range(n_tiles), key=tileids.__getitem__)
     if verbose:
         print(" done.")
 
@@ -313,27 +576,21 @@ def disk_to_pmtiles(directory_path, output, maxzoom, **kwargs):
         metadata["minzoom"] = min(z_set)
 
     is_pbf = tile_format == "pbf"
+    batches = _batches(((tileids[i], paths[i]) for i in order), CONVERT_BATCH_SIZE)
 
-    with write(output) as writer:
+    with write(output) as writer, ThreadPoolExecutor(kwargs.get("workers")) as executor:
 
-        # read tiles in ascending tile order
+        # read tiles in ascending tile order, prefetching on the pool
         count = 0
         if verbose:
             count_step = (2**(maxzoom-3))**2 if maxzoom <= 9 else (2**(9-3))**2
             print(" Begin writing %s to .pmtiles ..." % (n_tiles), flush=True)
-        for tileid, filepath in tileid_path_set:
-            f = open(filepath, 'rb')
-            try:
-                data = f.read()
-                # force gzip compression only for vector
-                if is_pbf and data[0:2] != b"\x1f\x8b":
-                    data = gzip.compress(data)
+        for batch in bounded_map(executor, lambda b: _read_tile_files(b, is_pbf), batches):
+            for tileid, data in batch:
                 writer.write_tile(tileid, data)
                 count = count + 1
                 if verbose and (count % count_step) == 0:
                     print(" %s tiles inserted of %s" % (count, n_tiles), flush=True)
-            finally:
-                f.close()
 
         if verbose and (count % count_step) != 0:
             print(" %s tiles inserted of %s" % (count, n_tiles))
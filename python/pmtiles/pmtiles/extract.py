@@ -0,0 +1,190 @@
+"""Copy the tiles of a region of a PMTiles archive into a new archive."""
+
+import os
+from .reader import Reader, MmapSource, DEFAULT_GAP
+from .tile import (
+    tileid_ranges,
+    bbox_tileid_ranges,
+    lonlat_to_world,
+    OUTSIDE,
+    PARTIAL,
+    INSIDE,
+)
+from .writer import Writer, DEDUP_OFF, COPY_CHUNK_SIZE, copy_entries
+
+WORLD_BBOX = (-180.0, -90.0, 180.0, 90.0)
+
+
+def _polygons(geojson):
+    kind = geojson["type"]
+    if kind == "FeatureCollection":
+        for feature in geojson["features"]:
+            yield from _polygons(feature)
+    elif kind == "Feature":
+        yield from _polygons(geojson["geometry"])
+    elif kind == "GeometryCollection":
+        for geometry in geojson["geometries"]:
+            yield from _polygons(geometry)
+    elif kind == "Polygon":
+        yield geojson["coordinates"]
+    elif kind == "MultiPolygon":
+        yield from geojson["coordinates"]
+    else:
+        raise ValueError(f"region must be polygonal, got {kind}")
+
+
+def region_bbox(geojson):
+    """The (min_lon, min_lat, max_lon, max_lat) bounds of a GeoJSON region."""
+    lons = []
+    lats = []
+    for polygon in _polygons(geojson):
+        for lon, lat, *_ in polygon[0]:
+            lons.append(lon)
+            lats.append(lat)
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def _segment_hits_box(x0, y0, x1, y1, bx0, by0, bx1, by1):
+    if max(x0, x1) < bx0 or min(x0, x1) > bx1 or max(y0, y1) < by0 or min(y0, y1) > by1:
+        return False
+    dx = x1 - x0
+    dy = y1 - y0
+    t0 = 0.0
+    t1 = 1.0
+    for p, q in ((-dx, x0 - bx0), (dx, bx1 - x0), (-dy, y0 - by0), (dy, by1 - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+def _contains(edges, x, y):
+    inside = False
+    for x0, y0, x1, y1 in edges:
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+    return inside
+
+
+def region_classifier(geojson):
+    """Return a tileid_ranges classify function for a GeoJSON (Multi)Polygon region.
+
+    Tiles touching the boundary are PARTIAL. Each tile only tests the edges
+    that crossed its parent.
+    """
+    edges = []
+    vertices = []
+    for polygon in _polygons(geojson):
+        for ring in polygon:
+            points = [lonlat_to_world(lon, lat) for lon, lat, *_ in ring]
+            vertices.append(points[0])
+            edges.extend(
+                (x0, y0, x1, y1)
+                for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1])
+                if (x0, y0) != (x1, y1)
+            )
+    crossing = {(0, 0, 0): edges}
+
+    def classify(z, x, y):
+        scale = 1.0 / (1 << z)
+        bx0, by0 = x * scale, y * scale
+        bx1, by1 = bx0 + scale, by0 + scale
+        parent = crossing.get((z - 1, x >> 1, y >> 1), edges) if z else edges
+        hits = [e for e in parent if _segment_hits_box(*e, bx0, by0, bx1, by1)]
+        if hits:
+            crossing[(z, x, y)] = hits
+            return PARTIAL
+        if _contains(edges, bx0 + scale / 2, by0 + scale / 2):
+            return INSIDE
+        for vx, vy in vertices:
+            if bx0 <= vx <= bx1 and by0 <= vy <= by1:
+                return PARTIAL
+        return OUTSIDE
+
+    return classify
+
+
+def _clip_bbox(header, bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if min_lon > max_lon:
+        min_lon, max_lon = -180.0, 180.0
+    return (
+        max(int(min_lon * 10000000), header["min_lon_e7"]),
+        max(int(min_lat * 10000000), header["min_lat_e7"]),
+        min(int(max_lon * 10000000), header["max_lon_e7"]),
+        min(int(max_lat * 10000000), header["max_lat_e7"]),
+    )
+
+
+def extract(
+    input,
+    output,
+    bbox=None,
+    region=None,
+    minzoom=None,
+    maxzoom=None,
+    gap=DEFAULT_GAP,
+    chunk_size=COPY_CHUNK_SIZE,
+):
+    """Write the tiles of input inside bbox or a GeoJSON region to output.
+
+    Only the directories overlapping the region are read, and tile data is
+    copied as raw bytes in batches of about chunk_size, coalescing reads
+    closer than gap. Tiles sharing content in the input share it in the
+    output, and runs are kept. The zoom range defaults to the input's.
+
+    Raises ValueError if no tiles match; output is removed whenever the
+    extract fails.
+    """
+    if bbox is not None and region is not None:
+        raise ValueError("pass either bbox or region, not both")
+    with open(input, "rb") as f_in:
+        source = MmapSource(f_in)
+        reader = Reader(source)
+        header = reader.header()
+        minzoom = header["min_zoom"] if minzoom is None else int(minzoom)
+        maxzoom = header["max_zoom"] if maxzoom is None else int(maxzoom)
+        if region is not None:
+            ranges = tileid_ranges(minzoom, maxzoom, region_classifier(region))
+            bbox = region_bbox(region)
+        else:
+            bbox = WORLD_BBOX if bbox is None else bbox
+            ranges = bbox_tileid_ranges(bbox, minzoom, maxzoom)
+
+        f_out = open(output, "wb")
+        try:
+            with f_out:
+                writer = Writer(f_out, dedup=DEDUP_OFF)
+                entries = reader.tiles_in(ranges=ranges, data=False, gap=gap)
+                copy_entries(writer, [reader], ((0, e) for e in entries), gap, chunk_size)
+                if writer.addressed_tiles == 0:
+                    writer.tile_f.close()
+                    raise ValueError("no tiles inside the requested region")
+
+                out_header = dict(header)
+                (
+                    out_header["min_lon_e7"],
+                    out_header["min_lat_e7"],
+                    out_header["max_lon_e7"],
+                    out_header["max_lat_e7"],
+                ) = _clip_bbox(header, bbox)
+                if not (
+                    out_header["min_lon_e7"] <= header["center_lon_e7"] <= out_header["max_lon_e7"]
+                    and out_header["min_lat_e7"] <= header["center_lat_e7"] <= out_header["max_lat_e7"]
+                ):
+                    out_header["center_lon_e7"] = (out_header["min_lon_e7"] + out_header["max_lon_e7"]) // 2
+                    out_header["center_lat_e7"] = (out_header["min_lat_e7"] + out_header["max_lat_e7"]) // 2
+                out_header["center_zoom"] = min(max(header["center_zoom"], minzoom), maxzoom)
+                writer.finalize(out_header, reader.metadata())
+        except BaseException:
+            # never leave a partial, invalid archive behind
+            os.remove(output)
+            raise
@@ -0,0 +1,96 @@
+"""Merge several PMTiles archives into one without decoding tiles."""
+
+import heapq
+from contextlib import ExitStack
+from .reader import Reader, MmapSource, iter_entries, DEFAULT_GAP
+from .tile import Entry
+from .writer import Writer, COPY_CHUNK_SIZE, copy_entries
+
+
+def _ranked(rank, stream):
+    for e in stream:
+        yield e.tile_id, rank, e
+
+
+def paint_entries(streams):
+    """Overlay sorted entry streams, earlier streams taking precedence.
+
+    Yields (stream index, entry) in tile id order, where each entry is the
+    part of an input run not covered by any stream before it. Runs are split
+    wherever a higher priority stream starts or stops covering tiles.
+    """
+    merged = heapq.merge(*[_ranked(rank, stream) for rank, stream in enumerate(streams)])
+    upcoming = next(merged, None)
+    active = {}
+    pos = 0
+    last = None
+    while upcoming is not None or active:
+        if not active:
+            pos = upcoming[0]
+        while upcoming is not None and upcoming[0] <= pos:
+            active[upcoming[1]] = upcoming[2]
+            upcoming = next(merged, None)
+        stop = min(e.tile_id + e.run_length for e in active.values())
+        if upcoming is not None:
+            stop = min(stop, upcoming[0])
+        rank = min(active)
+        e = active[rank]
+        if last is not None and last[0] == rank and last[1].offset == e.offset and (
+            last[1].tile_id + last[1].run_length == pos
+        ):
+            last[1].run_length += stop - pos
+        else:
+            if last is not None:
+                yield last
+            last = (rank, Entry(pos, e.offset, e.length, stop - pos))
+        pos = stop
+        for r in [r for r, e in active.items() if e.tile_id + e.run_length <= pos]:
+            del active[r]
+    if last is not None:
+        yield last
+
+
+def merge(
+    inputs,
+    output,
+    priority=None,
+    metadata=None,
+    gap=DEFAULT_GAP,
+    chunk_size=COPY_CHUNK_SIZE,
+):
+    """Merge the archives at inputs into output.
+
+    Where inputs overlap, the tile comes from the input with the highest
+    priority, a list of numbers parallel to inputs; by default earlier inputs
+    win. Tile data is copied verbatim in large batches and contents are
+    deduplicated across inputs. All inputs must have the same tile type and
+    compression. The header bounds cover every input; the metadata is
+    taken from the highest priority input unless given.
+    """
+    if priority is None:
+        priority = [-i for i in range(len(inputs))]
+    order = sorted(range(len(inputs)), key=lambda i: -priority[i])
+
+    with ExitStack() as stack:
+        readers = []
+        for i in order:
+            f = stack.enter_context(open(inputs[i], "rb"))
+            readers.append(Reader(MmapSource(f)))
+        headers = [reader.header() for reader in readers]
+        for key in ("tile_type", "tile_compression"):
+            if len({h[key] for h in headers}) > 1:
+                raise ValueError(f"inputs differ in {key}")
+
+        header = dict(headers[0])
+        header["min_lon_e7"] = min(h["min_lon_e7"] for h in headers)
+        header["min_lat_e7"] = min(h["min_lat_e7"] for h in headers)
+        header["max_lon_e7"] = max(h["max_lon_e7"] for h in headers)
+        header["max_lat_e7"] = max(h["max_lat_e7"] for h in headers)
+        if metadata is None:
+            metadata = readers[0].metadata()
+
+        streams = [iter_entries(r.get_bytes, h) for r, h in zip(readers, headers)]
+        with open(output, "wb") as f_out:
+            writer = Writer(f_out)
+            copy_entries(writer, readers, paint_entries(streams), gap, chunk_size)
+            writer.finalize(header, metadata)
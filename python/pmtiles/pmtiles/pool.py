@@ -0,0 +1,301 @@
+"""Serve many PMTiles archives from one process with a shared directory cache."""
+
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from .cache import DirectoryCache, KeyedCache
+from .reader import Reader, PreadSource
+
+# archives kept open at once; the least recently used idle ones are closed first
+DEFAULT_MAX_OPEN = 64
+
+# seconds an archive may go unused before its file is closed
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+# seconds between checks of an archive's file for replacement
+DEFAULT_CHECK_INTERVAL = 1.0
+
+
+def _signature(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _fingerprint(signature, header_bytes):
+    # the same for every process that opens the same file
+    digest = hashlib.blake2b(header_bytes, digest_size=8)
+    digest.update(repr(signature).encode())
+    return digest.hexdigest()
+
+
+def _archive_key(key, name):
+    # the pool's keys are (name, generation, offset), but a cache passed in
+    # may be shared with Readers and other KeyedCaches using other keys
+    return isinstance(key, tuple) and len(key) == 3 and key[0] == name
+
+
+class _Handle:
+    def __init__(self, name, generation, fingerprint, f, source, reader):
+        self.name = name
+        self.generation = generation
+        self.fingerprint = fingerprint
+        self.f = f
+        self.source = source
+        self.reader = reader
+        self.users = 0
+        self.retired = False
+
+    def close(self):
+        if hasattr(self.source, "close"):
+            self.source.close()
+        self.f.close()
+
+
+class _Archive:
+    def __init__(self, path, generation):
+        self.path = path
+        self.handle = None
+        self.generation = generation
+        self.signature = None
+        self.header_bytes = None
+        self.last_used = 0.0
+        self.checked = 0.0
+
+
+class ReaderPool:
+    """Lazily opened Readers for a set of named archives.
+
+    All archives share one byte-budgeted DirectoryCache, keyed by
+    (name, generation, offset). At most max_open files are held open, and
+    files unused for idle_timeout seconds are closed; a closed archive is
+    reopened on its next use. At most every check_interval seconds, a use
+    checks whether the file was replaced or rewritten, by its inode, size,
+    mtime and header; if so the archive is reopened under a new generation
+    and its cached directories are dropped.
+
+    source wraps an open file as a get_bytes callable and defaults to
+    PreadSource. The pool is thread-safe.
+    """
+
+    def __init__(
+        self,
+        paths=None,
+        cache=None,
+        max_open=DEFAULT_MAX_OPEN,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        check_interval=DEFAULT_CHECK_INTERVAL,
+        source=PreadSource,
+    ):
+        self.cache = DirectoryCache() if cache is None else cache
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.source = source
+        self.opens = 0
+        self.reloads = 0
+        self._archives = {}
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+        # generations are unique across the pool, so a name removed and added
+        # again never sees directories cached for the old file
+        self._generations = itertools.count()
+        for name, path in (paths or {}).items():
+            self.add(name, path)
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """A pool of every .pmtiles file in directory, named by file stem."""
+        paths = {}
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith(".pmtiles"):
+                paths[entry.name[: -len(".pmtiles")]] = entry.path
+        return cls(paths, **kwargs)
+
+    def __contains__(self, name):
+        return name in self._archives
+
+    def __len__(self):
+        return len(self._archives)
+
+    def names(self):
+        return sorted(self._archives)
+
+    def add(self, name, path):
+        with self._lock:
+            if name in self._archives:
+                raise ValueError(f"archive {name!r} already in pool")
+            self._archives[name] = _Archive(path, next(self._generations))
+
+    def remove(self, name):
+        with self._lock:
+            archive = self._archives.pop(name)
+            self._retire(name, archive)
+        self.cache.discard_where(lambda key: _archive_key(key, name))
+
+    def _open_handle(self, name, archive):
+        f = open(archive.path, "rb")
+        try:
+            signature = _signature(os.fstat(f.fileno()))
+            source = self.source(f)
+            header_bytes = bytes(source(0, 127))
+        except BaseException:
+            f.close()
+            raise
+        if archive.signature is not None and (
+            signature != archive.signature or header_bytes != archive.header_bytes
+        ):
+            archive.generation = next(self._generations)
+            self.reloads += 1
+        archive.signature = signature
+        archive.header_bytes = header_bytes
+        reader = Reader(source, KeyedCache(self.cache, (name, archive.generation)))
+        self.opens += 1
+        fingerprint = _fingerprint(signature, header_bytes)
+        return _Handle(name, archive.generation, fingerprint, f, source, reader)
+
+    def _retire(self, name, archive):
+        handle = archive.handle
+        if handle is None:
+            return
+        archive.handle = None
+        self._open.pop(name, None)
+        handle.retired = True
+        if handle.users == 0:
+            handle.close()
+
+    def _changed(self, archive):
+        try:
+            st = os.stat(archive.path)
+        except FileNotFoundError:
+            return False
+        if _signature(st) != archive.signature:
+            return True
+        return bytes(archive.handle.source(0, 127)) != archive.header_bytes
+
+    def _acquire(self, name):
+        now = time.monotonic()
+        with self._lock:
+            archive = self._archives[name]
+            generation = archive.generation
+            if archive.handle is not None and now - archive.checked >= self.check_interval:
+                archive.checked = now
+                if self._changed(archive):
+                    self._retire(name, archive)
+            if archive.handle is None:
+                archive.handle = self._open_handle(name, archive)
+                archive.checked = now
+            handle = archive.handle
+            handle.users += 1
+            archive.last_used = now
+            self._open[name] = archive
+            self._open.move_to_end(name)
+            self._close_over(now)
+        if archive.generation != generation:
+            # the file changed since it was last open; drop its old directories
+            generation = archive.generation
+            self.cache.discard_where(
+                lambda key: _archive_key(key, name) and key[1] < generation
+            )
+        return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.users -= 1
+            if not handle.retired or handle.users:
+                return
+            handle.close()
+            archive = self._archives.get(handle.name)
+            outdated = archive is None or archive.generation > handle.generation
+        if outdated:
+            # drop directories its borrowers cached after the file changed
+            name, generation = handle.name, handle.generation
+            self.cache.discard_where(
+                lambda key: _archive_key(key, name) and key[1] == generation
+            )
+
+    def _close_over(self, now):
+        # close idle archives, then the least recently used beyond max_open
+        excess = len(self._open) - self.max_open
+        for name, archive in list(self._open.items()):
+            idle = now - archive.last_used >= self.idle_timeout
+            if not idle and excess <= 0:
+                break
+            if archive.handle.users == 0:
+                self._retire(name, archive)
+                excess -= 1
+
+    def close_idle(self):
+        """Close the files of archives unused for idle_timeout seconds."""
+        with self._lock:
+            self._close_over(time.monotonic())
+
+    def ready(self, name):
+        """Whether borrowing the named archive now touches no files.
+
+        True while its file is open and not yet due for a replacement check;
+        otherwise borrowing may open or stat the file.
+        """
+        archive = self._archives.get(name)
+        return (
+            archive is not None
+            and archive.handle is not None
+            and time.monotonic() - archive.checked < self.check_interval
+        )
+
+    @contextmanager
+    def borrow(self, name):
+        """Borrow the named archive for the duration of a with block.
+
+        Yields a handle with the archive's reader, its open file f, its
+        generation, which changes whenever the file does, and its
+        fingerprint, a hex digest of the file's inode, size, mtime and header
+        that other processes opening the same file agree on. The file stays
+        open until the block exits, even if it is replaced or closed as idle
+        meanwhile.
+        """
+        handle = self._acquire(name)
+        try:
+            yield handle
+        finally:
+            self._release(handle)
+
+    @contextmanager
+    def reader(self, name):
+        """Borrow the Reader of the named archive for the duration of a with block."""
+        with self.borrow(name) as handle:
+            yield handle.reader
+
+    def get(self, name, z, x, y):
+        with self.reader(name) as reader:
+            return reader.get(z, x, y)
+
+    def header(self, name):
+        with self.reader(name) as reader:
+            return reader.header()
+
+    def metadata(self, name):
+        with self.reader(name) as reader:
+            return reader.metadata()
+
+    def stats(self):
+        return {
+            "archives": len(self._archives),
+            "open": len(self._open),
+            "opens": self.opens,
+            "reloads": self.reloads,
+            "cache": self.cache.stats(),
+        }
+
+    def close(self):
+        with self._lock:
+            for name, archive in list(self._open.items()):
+                self._retire(name, archive)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,23 +1,89 @@
 import json
 import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 from .tile import (
     deserialize_header,
     deserialize_directory,
     zxy_to_tileid,
     tileid_to_zxy,
     find_tile,
+    merge_ranges,
+    bbox_tileid_ranges,
     Compression,
+    Directory,
+    Entry,
 )
+from .cache import DirectoryCache
 import gzip
 
 
-def MmapSource(f):
-    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+class MmapSource:
+    """Read byte ranges of a file through a read-only memory map.
 
-    def get_bytes(offset, length):
-        return mapping[offset : offset + length]
+    By default every read copies into new bytes. With zero_copy, reads return
+    memoryview slices of the mapping instead; close() fails with BufferError
+    while any of them are still alive.
+    """
+
+    def __init__(self, f, zero_copy=False):
+        self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.zero_copy = zero_copy
+        self._view = memoryview(self.mapping) if zero_copy else None
+
+    def __call__(self, offset, length):
+        if self._view is not None:
+            return self._view[offset : offset + length]
+        return self.mapping[offset : offset + length]
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    return get_bytes
+
+class PreadSource:
+    """Read byte ranges of a file with os.pread, without mapping it.
+
+    Safe to share between threads. Where os.pread is unavailable, reads
+    fall back to seek and read under a lock.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.fd = f.fileno()
+        self._lock = None if hasattr(os, "pread") else threading.Lock()
+
+    def __call__(self, offset, length):
+        if self._lock is not None:
+            with self._lock:
+                self.f.seek(offset)
+                return self.f.read(length)
+        data = os.pread(self.fd, length, offset)
+        if len(data) == length or not data:
+            return data
+        # large reads may come back short
+        parts = [data]
+        while length > len(data):
+            offset += len(data)
+            length -= len(data)
+            data = os.pread(self.fd, length, offset)
+            if not data:
+                break
+            parts.append(data)
+        return b"".join(parts)
 
 
 def MemorySource(buf):
@@ -27,46 +93,454 @@ def MemorySource(buf):
     return get_bytes
 
 
+# ranges separated by at most this many bytes are fetched with one get_bytes call
+DEFAULT_GAP = 4096
+
+
+def coalesce_ranges(ranges, gap=0):
+    """Merge (offset, length) ranges separated by at most gap bytes.
+
+    Returns the merged (offset, length) spans in offset order. Duplicate and
+    overlapping ranges are covered by a single span.
+    """
+    spans = []
+    for offset, length in sorted(set(ranges)):
+        if spans and offset <= spans[-1][0] + spans[-1][1] + gap:
+            start, span_length = spans[-1]
+            spans[-1] = (start, max(span_length, offset + length - start))
+        else:
+            spans.append((offset, length))
+    return spans
+
+
+def read_ranges(get_bytes, ranges, gap=0):
+    """Read many (offset, length) ranges with as few get_bytes calls as possible.
+
+    Returns a dict mapping each requested range to its bytes.
+    """
+    ranges = set(ranges)
+    spans = coalesce_ranges(ranges, gap)
+    starts = [start for start, _ in spans]
+    buffers = [get_bytes(start, length) for start, length in spans]
+    result = {}
+    for offset, length in ranges:
+        i = bisect_right(starts, offset) - 1
+        begin = offset - starts[i]
+        result[(offset, length)] = buffers[i][begin : begin + length]
+    return result
+
+
+# leaf directories fetched together while answering a range query
+RANGE_QUERY_LEAVES = 64
+
+# bytes of tile data fetched together while answering a range query
+RANGE_QUERY_BYTES = 4 * 1024 * 1024
+
+
+def _intersecting(directory, ranges):
+    """Yield (index, clipped ranges) for the entries of directory overlapping ranges.
+
+    ranges are sorted, disjoint half-open tile id intervals. A leaf pointer
+    spans the tile ids up to the next entry.
+    """
+    tile_ids = directory.tile_ids
+    run_lengths = directory.run_lengths
+    n = len(tile_ids)
+    i = 0
+    j = 0
+    while i < n and j < len(ranges):
+        i = max(i, bisect_right(tile_ids, ranges[j][0]) - 1)
+        start = tile_ids[i]
+        if run_lengths[i]:
+            end = start + run_lengths[i]
+        else:
+            end = tile_ids[i + 1] if i + 1 < n else 1 << 64
+        clipped = []
+        k = j
+        while k < len(ranges) and ranges[k][0] < end:
+            if ranges[k][1] > start:
+                clipped.append((max(ranges[k][0], start), min(ranges[k][1], end)))
+            k += 1
+        if clipped:
+            yield i, clipped
+        while j < len(ranges) and ranges[j][1] <= end:
+            j += 1
+        i += 1
+
+
+# the header and root directory always lie within the first 16 KiB
+WARMUP_BYTES = 16384
+
+INDEX_MAGIC = b"PMTIDX1\n"
+
+
+def _write_index(f, header_bytes, directories):
+    # magic, the archive header, then per directory its offset, entry count
+    # and four little-endian uint64 columns
+    f.write(INDEX_MAGIC)
+    f.write(header_bytes)
+    for offset, directory in directories:
+        if not isinstance(directory, Directory):
+            directory = Directory.from_entries(directory)
+        f.write(struct.pack("<QQ", offset, len(directory)))
+        for column in (
+            directory.tile_ids,
+            directory.offsets,
+            directory.lengths,
+            directory.run_lengths,
+        ):
+            if sys.byteorder == "big":
+                column = array("Q", column)
+                column.byteswap()
+            f.write(column.tobytes())
+
+
+def _read_index(buf, pos):
+    # yield the (offset, Directory) pairs of an index from pos to the end
+    while pos < len(buf):
+        offset, n = struct.unpack_from("<QQ", buf, pos)
+        pos += 16
+        columns = []
+        for _ in range(4):
+            column = array("Q")
+            column.frombytes(buf[pos : pos + 8 * n])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            pos += 8 * n
+        yield offset, Directory(*columns)
+
+
+def _zoom_ranges(zooms):
+    # the tile ids of zoom z are [(4**z - 1) / 3, (4**(z + 1) - 1) / 3)
+    return merge_ranges(
+        (((1 << (2 * z)) - 1) // 3, ((1 << (2 * z + 2)) - 1) // 3) for z in zooms
+    )
+
+
+class NotCached(Exception):
+    """Raised by a cached_only lookup that would have to read from the archive."""
+
+
 class Reader:
-    def __init__(self, get_bytes):
+    """Reads tiles from an archive through get_bytes(offset, length).
+
+    A Reader can be shared between threads when its get_bytes is
+    thread-safe, as PreadSource and MmapSource are. Concurrent misses on the
+    same directory are loaded once.
+    """
+
+    def __init__(self, get_bytes, cache=None):
         self.get_bytes = get_bytes
+        self.cache = DirectoryCache() if cache is None else cache
+        self._header = None
+        self._header_lock = threading.Lock()
+        self._metadata_bytes = None
 
     def header(self):
-        return deserialize_header(self.get_bytes(0, 127))
+        if self._header is None:
+            with self._header_lock:
+                if self._header is None:
+                    self._header = deserialize_header(self.get_bytes(0, 127))
+        return self._header
+
+    def directory(self, offset, length):
+        return self.cache.get(
+            offset,
+            lambda: deserialize_directory(self.get_bytes(offset, length)),
+        )
 
     def metadata(self):
         header = self.header()
-        metadata = self.get_bytes(header["metadata_offset"], header["metadata_length"])
+        metadata = self._metadata_bytes
+        if metadata is None:
+            metadata = self.get_bytes(header["metadata_offset"], header["metadata_length"])
         if header["internal_compression"] == Compression.GZIP:
             metadata = gzip.decompress(metadata)
-        return json.loads(metadata)
+        return json.loads(bytes(metadata))
 
-    def get(self, z, x, y):
+    def locate(self, z, x, y, cached_only=False):
+        """Return the (offset, length) of a tile's data in the archive, or None.
+
+        With cached_only, raises NotCached instead of reading the header or a
+        directory that is not loaded yet, so the lookup does no I/O.
+        """
         tile_id = zxy_to_tileid(z, x, y)
+        if cached_only and self._header is None:
+            raise NotCached("header")
         header = self.header()
         dir_offset = header["root_offset"]
         dir_length = header["root_length"]
         for depth in range(0, 4):  # max depth
-            directory = deserialize_directory(self.get_bytes(dir_offset, dir_length))
+            if cached_only and dir_offset not in self.cache:
+                raise NotCached(dir_offset)
+            directory = self.directory(dir_offset, dir_length)
             result = find_tile(directory, tile_id)
-            if result:
-                if result.run_length == 0:
-                    dir_offset = header["leaf_directory_offset"] + result.offset
-                    dir_length = result.length
-                else:
-                    return self.get_bytes(
-                        header["tile_data_offset"] + result.offset, result.length
-                    )
+            if result is None:
+                return None
+            if result.run_length == 0:
+                dir_offset = header["leaf_directory_offset"] + result.offset
+                dir_length = result.length
+            else:
+                return header["tile_data_offset"] + result.offset, result.length
+
+    def get(self, z, x, y):
+        location = self.locate(z, x, y)
+        if location is None:
+            return None
+        return self.get_bytes(*location)
+
+    def _directories(self, ranges, gap):
+        directories = {}
+        missing = []
+        for offset, length in ranges:
+            directory = self.cache.lookup(offset)
+            if directory is None:
+                missing.append((offset, length))
+            else:
+                directories[offset] = directory
+        for (offset, length), buf in read_ranges(self.get_bytes, missing, gap).items():
+            directory = deserialize_directory(buf)
+            self.cache.put(offset, directory)
+            directories[offset] = directory
+        return directories
+
+    def get_many(self, tiles, gap=DEFAULT_GAP):
+        """Fetch many (z, x, y) tiles, returning their data in the same order.
+
+        Every directory is visited at most once and tile data ranges closer
+        than gap bytes are merged into a single get_bytes call. Missing tiles
+        are returned as None.
+        """
+        tile_ids = [zxy_to_tileid(z, x, y) for z, x, y in tiles]
+        header = self.header()
+        found = {}
+
+        pending = {(header["root_offset"], header["root_length"]): sorted(set(tile_ids))}
+        for depth in range(0, 4):  # max depth
+            if not pending:
+                break
+            directories = self._directories(pending.keys(), gap)
+            leaves = {}
+            for (dir_offset, _), ids in pending.items():
+                directory = directories[dir_offset]
+                for tile_id in ids:
+                    result = find_tile(directory, tile_id)
+                    if result is None:
+                        continue
+                    if result.run_length == 0:
+                        leaf = (
+                            header["leaf_directory_offset"] + result.offset,
+                            result.length,
+                        )
+                        leaves.setdefault(leaf, []).append(tile_id)
+                    else:
+                        found[tile_id] = (
+                            header["tile_data_offset"] + result.offset,
+                            result.length,
+                        )
+            pending = leaves
+
+        data = read_ranges(self.get_bytes, found.values(), gap)
+        return [
+            data[found[tile_id]] if tile_id in found else None for tile_id in tile_ids
+        ]
+
+    def _leaves_in(self, header, leaves, gap):
+        directories = self._directories([leaf for leaf, _ in leaves], gap)
+        for (offset, _), ranges in leaves:
+            yield from self._entries_in(header, directories[offset], ranges, gap)
+
+    def _entries_in(self, header, directory, ranges, gap):
+        leaves = []
+        for i, clipped in _intersecting(directory, ranges):
+            entry = directory[i]
+            if entry.run_length == 0:
+                leaf = (header["leaf_directory_offset"] + entry.offset, entry.length)
+                leaves.append((leaf, clipped))
+                if len(leaves) < RANGE_QUERY_LEAVES:
+                    continue
+            yield from self._leaves_in(header, leaves, gap)
+            leaves = []
+            if entry.run_length:
+                for start, stop in clipped:
+                    yield Entry(start, entry.offset, entry.length, stop - start)
+        yield from self._leaves_in(header, leaves, gap)
+
+    def _tile_data(self, header, entries, gap):
+        batch = []
+        nbytes = 0
+        for entry in entries:
+            batch.append(entry)
+            nbytes += entry.length
+            if nbytes < RANGE_QUERY_BYTES:
+                continue
+            yield from self._read_batch(header, batch, gap)
+            batch = []
+            nbytes = 0
+        yield from self._read_batch(header, batch, gap)
+
+    def _read_batch(self, header, batch, gap):
+        tile_data_offset = header["tile_data_offset"]
+        data = read_ranges(
+            self.get_bytes,
+            [(tile_data_offset + e.offset, e.length) for e in batch],
+            gap,
+        )
+        for e in batch:
+            tile_data = data[(tile_data_offset + e.offset, e.length)]
+            for tile_id in range(e.tile_id, e.tile_id + e.run_length):
+                yield tileid_to_zxy(tile_id), tile_data
+
+    def tiles_in(
+        self, bbox=None, minzoom=None, maxzoom=None, data=True, gap=DEFAULT_GAP, ranges=None
+    ):
+        """Iterate lazily over the tiles inside a bbox, in tile id order.
+
+        bbox is (min_lon, min_lat, max_lon, max_lat) and defaults to the whole
+        world; the zoom range defaults to the header's. Alternatively pass
+        ranges, sorted half-open tile id intervals as from tileid_ranges.
+
+        Only directories overlapping the query are read. Yields ((z, x, y),
+        data) for every tile, or with data=False the matching entries with
+        their runs clipped to the query. Leaf and tile data reads closer than
+        gap bytes are coalesced.
+        """
+        header = self.header()
+        if ranges is None:
+            if minzoom is None:
+                minzoom = header["min_zoom"]
+            if maxzoom is None:
+                maxzoom = header["max_zoom"]
+            ranges = bbox_tileid_ranges(bbox or (-180, -90, 180, 90), minzoom, maxzoom)
+        root = self.directory(header["root_offset"], header["root_length"])
+        entries = self._entries_in(header, root, ranges, gap)
+        if not data:
+            return entries
+        return self._tile_data(header, entries, gap)
+
+    def _initial_read(self):
+        # load the header, root and metadata from one read of the file start
+        buf = self.get_bytes(0, WARMUP_BYTES)
+        header_bytes = bytes(buf[0:127])
+        header = deserialize_header(header_bytes)
+        with self._header_lock:
+            if self._header is None:
+                self._header = header
+        root_offset = header["root_offset"]
+        root_end = root_offset + header["root_length"]
+        if root_end <= len(buf) and root_offset not in self.cache:
+            self.cache.put(root_offset, deserialize_directory(buf[root_offset:root_end]))
+        metadata_offset = header["metadata_offset"]
+        metadata_end = metadata_offset + header["metadata_length"]
+        if metadata_end <= len(buf):
+            self._metadata_bytes = bytes(buf[metadata_offset:metadata_end])
+        return header_bytes
+
+    def _prefetch(self, header, directory, ranges, gap):
+        leaves = [
+            ((header["leaf_directory_offset"] + directory.offsets[i], directory.lengths[i]), clipped)
+            for i, clipped in _intersecting(directory, ranges)
+            if directory.run_lengths[i] == 0
+        ]
+        for start in range(0, len(leaves), RANGE_QUERY_LEAVES):
+            batch = leaves[start : start + RANGE_QUERY_LEAVES]
+            directories = self._directories([leaf for leaf, _ in batch], gap)
+            for (offset, _), clipped in batch:
+                self._prefetch(header, directories[offset], clipped, gap)
+
+    def warmup(
+        self,
+        leaves=False,
+        zooms=None,
+        bbox=None,
+        index=None,
+        background=False,
+        gap=DEFAULT_GAP,
+    ):
+        """Load the header, root directory and metadata with one read.
+
+        All three usually lie in the first 16 KiB of the archive. Then leaf
+        directories are prefetched: every leaf with leaves=True, those
+        covering a bbox on zooms (by default the header's zoom range), or
+        those covering zooms. Leaves are read in coalesced batches and stay
+        cached as far as the cache's byte budget allows.
+
+        index is the path of a sidecar file of parsed directories. If it was
+        saved for this exact archive header, its directories are loaded
+        instead of prefetched; otherwise the prefetched ones are saved to it.
+
+        With background, the prefetch runs in a daemon thread, which is
+        returned; the Reader is usable meanwhile.
+        """
+        header_bytes = self._initial_read()
+        header = self.header()
+        if index is not None and self.load_index(index, header_bytes) is not None:
+            return None
+
+        if leaves:
+            ranges = [(0, 1 << 64)]
+        elif bbox is not None:
+            if zooms is None:
+                zooms = range(header["min_zoom"], header["max_zoom"] + 1)
+            ranges = merge_ranges(r for z in zooms for r in bbox_tileid_ranges(bbox, z, z))
+        elif zooms is not None:
+            ranges = _zoom_ranges(zooms)
+        else:
+            ranges = []
+
+        def run():
+            root = self.directory(header["root_offset"], header["root_length"])
+            self._prefetch(header, root, ranges, gap)
+            if index is not None:
+                self.save_index(index, header_bytes)
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def save_index(self, path, header_bytes=None):
+        """Write the cached directories of this archive to a sidecar index file."""
+        if header_bytes is None:
+            header_bytes = bytes(self.get_bytes(0, 127))
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            _write_index(f, header_bytes, self.cache.items())
+        os.replace(tmp, path)
+
+    def load_index(self, path, header_bytes=None):
+        """Cache the directories of a sidecar index file written by save_index.
+
+        Returns how many were loaded, or None if the file is missing or was
+        saved for a different version of the archive.
+        """
+        if header_bytes is None:
+            header_bytes = bytes(self.get_bytes(0, 127))
+        try:
+            with open(path, "rb") as f:
+                buf = f.read()
+        except FileNotFoundError:
+            return None
+        if not buf.startswith(INDEX_MAGIC + header_bytes):
+            return None
+        count = 0
+        start = len(INDEX_MAGIC) + len(header_bytes)
+        for offset, directory in _read_index(memoryview(buf), start):
+            self.cache.put(offset, directory)
+            count += 1
+        return count
 
 
 def traverse(get_bytes, header, dir_offset, dir_length):
     entries = deserialize_directory(get_bytes(dir_offset, dir_length))
     for entry in entries:
         if entry.run_length > 0:
+            data = get_bytes(header["tile_data_offset"] + entry.offset, entry.length)
             for i in range(entry.run_length):
-                yield tileid_to_zxy(entry.tile_id + i), get_bytes(
-                    header["tile_data_offset"] + entry.offset, entry.length
-                )
+                yield tileid_to_zxy(entry.tile_id + i), data
         else:
             for t in traverse(
                 get_bytes,
@@ -80,3 +554,88 @@ def traverse(get_bytes, header, dir_offset, dir_length):
 def all_tiles(get_bytes):
     header = deserialize_header(get_bytes(0, 127))
     return traverse(get_bytes, header, header["root_offset"], header["root_length"])
+
+
+def _iter_entries(get_bytes, header, dir_offset, dir_length):
+    entries = deserialize_directory(get_bytes(dir_offset, dir_length))
+    for entry in entries:
+        if entry.run_length > 0:
+            yield entry
+        else:
+            yield from _iter_entries(
+                get_bytes,
+                header,
+                header["leaf_directory_offset"] + entry.offset,
+                entry.length,
+            )
+
+
+def iter_entries(get_bytes, header=None):
+    """Yield every tile entry of the archive in tile id order, skipping leaf pointers."""
+    if header is None:
+        header = deserialize_header(get_bytes(0, 127))
+    return _iter_entries(get_bytes, header, header["root_offset"], header["root_length"])
+
+
+# bytes of tile data read per get_bytes call when scanning a clustered archive
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# bytes of back-referenced (deduplicated) tile contents kept while scanning
+DEFAULT_DEDUP_CACHE_SIZE = 16 * 1024 * 1024
+
+
+def scan_tiles(
+    get_bytes,
+    block_size=DEFAULT_BLOCK_SIZE,
+    expand_runs=True,
+    dedup_cache_size=DEFAULT_DEDUP_CACHE_SIZE,
+):
+    """Iterate over every tile, reading tile data sequentially in large blocks.
+
+    Yields ((z, x, y), data) for every addressed tile, or (entry, data) once per
+    run-length entry when expand_runs is False. data is a memoryview slice of a
+    shared block; tiles in the same run share one view.
+
+    Blocks are only used for clustered archives, where tile data is laid out in
+    tile id order. Deduplicated contents referenced again after their block has
+    passed are read once and then served from a bounded cache.
+    """
+    header = deserialize_header(get_bytes(0, 127))
+    tile_data_offset = header["tile_data_offset"]
+    tile_data_length = header["tile_data_length"]
+    if not header["clustered"]:
+        block_size = 0
+
+    block = memoryview(b"")
+    block_start = 0
+    recent = OrderedDict()
+    recent_bytes = 0
+
+    for entry in iter_entries(get_bytes, header):
+        offset = entry.offset
+        length = entry.length
+        if block_start <= offset and offset + length <= block_start + len(block):
+            begin = offset - block_start
+            data = block[begin : begin + length]
+        elif offset >= block_start and block_size > 0:
+            size = max(length, min(block_size, tile_data_length - offset))
+            block = memoryview(get_bytes(tile_data_offset + offset, size))
+            block_start = offset
+            data = block[0:length]
+        else:
+            data = recent.get(offset)
+            if data is None:
+                data = memoryview(get_bytes(tile_data_offset + offset, length))
+                if length <= dedup_cache_size:
+                    recent[offset] = data
+                    recent_bytes += length
+                    while recent_bytes > dedup_cache_size:
+                        recent_bytes -= len(recent.popitem(last=False)[1])
+            else:
+                recent.move_to_end(offset)
+
+        if expand_runs:
+            for i in range(entry.run_length):
+                yield tileid_to_zxy(entry.tile_id + i), data
+        else:
+            yield entry, data
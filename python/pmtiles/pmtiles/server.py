@@ -0,0 +1,305 @@
+"""Serve tiles and TileJSON from PMTiles archives over HTTP with asyncio."""
+
+import asyncio
+import json
+import zlib
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from urllib.parse import unquote, urlsplit
+from .convert import TILE_EXTENSIONS
+from .pool import ReaderPool
+from .reader import NotCached
+from .tile import Compression, TileType
+
+CONTENT_TYPES = {
+    TileType.MVT: "application/vnd.mapbox-vector-tile",
+    TileType.PNG: "image/png",
+    TileType.JPEG: "image/jpeg",
+    TileType.WEBP: "image/webp",
+    TileType.AVIF: "image/avif",
+    TileType.MLT: "application/vnd.maplibre-vector-tile",
+}
+
+CONTENT_ENCODINGS = {
+    Compression.GZIP: "gzip",
+    Compression.BROTLI: "br",
+    Compression.ZSTD: "zstd",
+}
+
+# tiles at least this large are sent with sendfile rather than read and written
+SENDFILE_MIN_BYTES = 16 * 1024
+
+# longest request line and headers accepted
+MAX_REQUEST_BYTES = 16 * 1024
+
+
+def tilejson(header, metadata, tiles_url):
+    """Build a TileJSON 3.0.0 document for an archive served at tiles_url."""
+    doc = {
+        "tilejson": "3.0.0",
+        "scheme": "xyz",
+        "tiles": [tiles_url],
+        "minzoom": header["min_zoom"],
+        "maxzoom": header["max_zoom"],
+        "bounds": [
+            header["min_lon_e7"] / 10000000,
+            header["min_lat_e7"] / 10000000,
+            header["max_lon_e7"] / 10000000,
+            header["max_lat_e7"] / 10000000,
+        ],
+        "center": [
+            header["center_lon_e7"] / 10000000,
+            header["center_lat_e7"] / 10000000,
+            header["center_zoom"],
+        ],
+    }
+    for key in ("name", "description", "attribution", "version", "vector_layers"):
+        if key in metadata:
+            doc[key] = metadata[key]
+    return doc
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    return etag in tags or "W/" + etag in tags
+
+
+def _parse_tile(parts):
+    # ["name", "z", "x", "y.ext"] -> (name, z, x, y, ext) or None
+    name, z, x, y_ext = parts
+    y, _, ext = y_ext.partition(".")
+    if not all(s.isascii() and s.isdecimal() for s in (z, x, y)):
+        return None
+    z, x, y = int(z), int(x), int(y)
+    if z > 31 or x >= 1 << z or y >= 1 << z:
+        return None
+    return name, z, x, y, ext
+
+
+class TileServer:
+    """An HTTP/1.1 server for the archives of a ReaderPool.
+
+    Serves tiles at /{name}/{z}/{x}/{y}.{ext} and TileJSON at /{name}.json,
+    with keep-alive, HEAD, ETag and If-None-Match. Tiles are sent as stored,
+    with the Content-Encoding of the archive's tile_compression, and their
+    ETags derive from the file's fingerprint, so they survive restarts and
+    agree across processes. Lookups answered from the pool's shared cache
+    run on the event loop; opening files, reading directories and metadata
+    not cached yet, and reading tiles smaller than sendfile_min_bytes run in
+    the loop's default executor. Larger tiles are sent from the file with
+    loop.sendfile. A file that cannot be opened, read or parsed gives a 500.
+    """
+
+    def __init__(
+        self,
+        pool,
+        public_url=None,
+        cors=None,
+        cache_control=None,
+        sendfile_min_bytes=SENDFILE_MIN_BYTES,
+    ):
+        self.pool = pool
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.cors = cors
+        self.cache_control = cache_control
+        self.sendfile_min_bytes = sendfile_min_bytes
+        self._metadata = {}
+
+    async def start(self, host="127.0.0.1", port=8080):
+        return await asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST_BYTES)
+
+    async def handle(self, reader, writer):
+        """Serve the requests of one connection until it closes."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.LimitOverrunError:
+                    await self._send(writer, 431, [], b"", False)
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                request = lines[0].split(" ")
+                if len(request) != 3:
+                    await self._send(writer, 400, [], b"", False)
+                    break
+                method, target, version = request
+                headers = {}
+                for line in lines[1:]:
+                    key, _, value = line.partition(":")
+                    if key:
+                        headers[key.strip().lower()] = value.strip()
+                length = headers.get("content-length", "0")
+                if not length.isdigit():
+                    await self._send(writer, 400, [], b"", False)
+                    break
+                if int(length):
+                    await reader.readexactly(int(length))
+                connection = headers.get("connection", "").lower()
+                if version == "HTTP/1.1":
+                    keep_alive = connection != "close"
+                else:
+                    keep_alive = connection == "keep-alive"
+                keep_alive = await self._respond(
+                    writer, method, target, headers, keep_alive
+                )
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status, headers, body, keep_alive, length=None):
+        # length overrides the Content-Length of body, for HEAD and sendfile
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+        lines.extend(f"{key}: {value}" for key, value in headers)
+        if self.cors:
+            lines.append(f"Access-Control-Allow-Origin: {self.cors}")
+        if status != 304:
+            lines.append(f"Content-Length: {len(body) if length is None else length}")
+        if not keep_alive:
+            lines.append("Connection: close")
+        lines.append("\r\n")
+        writer.write("\r\n".join(lines).encode("latin-1"))
+        if body:
+            writer.write(body)
+        await writer.drain()
+
+    async def _respond(self, writer, method, target, headers, keep_alive):
+        # returns whether the connection stays open
+        try:
+            await self._route(writer, method, target, headers, keep_alive)
+        except ConnectionError:
+            raise
+        except Exception:
+            # the archive's file is missing, unreadable or not an archive
+            await self._send(writer, 500, [], b"", False)
+            return False
+        return keep_alive
+
+    async def _route(self, writer, method, target, headers, keep_alive):
+        if method not in ("GET", "HEAD"):
+            allow = [("Allow", "GET, HEAD")]
+            return await self._send(writer, 405, allow, b"", keep_alive)
+        parts = unquote(urlsplit(target).path).strip("/").split("/")
+        try:
+            if len(parts) == 1 and parts[0].endswith(".json"):
+                name = parts[0][: -len(".json")]
+                if name in self.pool:
+                    return await self._tilejson(writer, method, name, headers, keep_alive)
+            elif len(parts) == 4:
+                tile = _parse_tile(parts)
+                if tile is not None and tile[0] in self.pool:
+                    return await self._tile(writer, method, tile, headers, keep_alive)
+        except KeyError:
+            pass  # removed from the pool meanwhile
+        await self._send(writer, 404, [], b"", keep_alive)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    @asynccontextmanager
+    async def _borrow(self, name):
+        # pool.borrow, opening or checking the file off the event loop
+        borrowed = self.pool.borrow(name)
+        if self.pool.ready(name):
+            archive = borrowed.__enter__()
+        else:
+            archive = await self._run(borrowed.__enter__)
+        try:
+            yield archive
+        finally:
+            borrowed.__exit__(None, None, None)
+
+    async def _archive_info(self, name, archive):
+        cached = self._metadata.get(name)
+        if cached is None or cached[0] != archive.generation:
+            reader = archive.reader
+            header, metadata = await self._run(
+                lambda: (reader.header(), reader.metadata())
+            )
+            cached = (archive.generation, header, metadata)
+            self._metadata[name] = cached
+        return cached[1], cached[2]
+
+    async def _tilejson(self, writer, method, name, headers, keep_alive):
+        async with self._borrow(name) as archive:
+            header, metadata = await self._archive_info(name, archive)
+        base = self.public_url or f"http://{headers.get('host', 'localhost')}"
+        ext = TILE_EXTENSIONS.get(header["tile_type"], "bin")
+        doc = tilejson(header, metadata, f"{base}/{name}/{{z}}/{{x}}/{{y}}.{ext}")
+        body = json.dumps(doc).encode()
+        etag = f'"{zlib.crc32(body):08x}-{len(body):x}"'
+        response = [("Content-Type", "application/json"), ("ETag", etag)]
+        if _etag_matches(headers.get("if-none-match"), etag):
+            return await self._send(writer, 304, response, b"", keep_alive)
+        if method == "HEAD":
+            return await self._send(writer, 200, response, b"", keep_alive, len(body))
+        await self._send(writer, 200, response, body, keep_alive)
+
+    async def _tile(self, writer, method, tile, headers, keep_alive):
+        name, z, x, y, ext = tile
+        async with self._borrow(name) as archive:
+            header, _ = await self._archive_info(name, archive)
+            tile_type = header["tile_type"]
+            if tile_type != TileType.UNKNOWN and ext not in (
+                TILE_EXTENSIONS.get(tile_type),
+                "pbf" if tile_type == TileType.MVT else None,
+            ):
+                return await self._send(writer, 404, [], b"", keep_alive)
+            try:
+                location = archive.reader.locate(z, x, y, cached_only=True)
+            except NotCached:
+                location = await self._run(archive.reader.locate, z, x, y)
+            if location is None:
+                return await self._send(writer, 404, [], b"", keep_alive)
+            offset, length = location
+            etag = f'"{archive.fingerprint}-{offset:x}-{length:x}"'
+            response = [
+                ("Content-Type", CONTENT_TYPES.get(tile_type, "application/octet-stream")),
+                ("ETag", etag),
+            ]
+            encoding = CONTENT_ENCODINGS.get(header["tile_compression"])
+            if encoding is not None:
+                response.append(("Content-Encoding", encoding))
+            if self.cache_control:
+                response.append(("Cache-Control", self.cache_control))
+            if _etag_matches(headers.get("if-none-match"), etag):
+                return await self._send(writer, 304, response, b"", keep_alive)
+            if method == "HEAD":
+                return await self._send(writer, 200, response, b"", keep_alive, length)
+            if length < self.sendfile_min_bytes:
+                body = await self._run(archive.reader.get_bytes, offset, length)
+                return await self._send(writer, 200, response, body, keep_alive)
+            await self._send(writer, 200, response, b"", keep_alive, length)
+            try:
+                await asyncio.get_running_loop().sendfile(
+                    writer.transport, archive.f, offset, length
+                )
+            except ConnectionError:
+                raise
+            except OSError as e:
+                # the status line is out already; all that is left is to drop
+                # the connection
+                writer.transport.abort()
+                raise ConnectionAbortedError("tile could not be read") from e
+
+
+def serve(pool, host="127.0.0.1", port=8080, **kwargs):
+    """Serve the archives of pool, a ReaderPool or a directory of archives, until interrupted."""
+    if not isinstance(pool, ReaderPool):
+        pool = ReaderPool.from_directory(pool)
+
+    async def main():
+        server = await TileServer(pool, **kwargs).start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    with pool:
+        asyncio.run(main())
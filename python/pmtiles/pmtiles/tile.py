@@ -2,13 +2,23 @@ from __future__ import annotations
 
 import gzip
 import io
+import math
+from array import array
+from bisect import bisect_right
 from enum import Enum
+from itertools import accumulate, chain
+from operator import sub
 from typing import TYPE_CHECKING, TypedDict
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 if TYPE_CHECKING:
     import sys
 
-    from typing import Sequence, IO
+    from typing import Iterable, Iterator, Sequence, IO
 
     if sys.version_info >= (3, 12):
         from collections.abc import Buffer
@@ -34,6 +44,93 @@ class Entry:
         return f"id={self.tile_id} offset={self.offset} length={self.length} runlength={self.run_length}"
 
 
+class Directory:
+    """A directory stored as four packed uint64 columns instead of Entry objects.
+
+    Indexing returns an Entry, slicing returns a Directory sharing no storage
+    with the original. The columns are array("Q") and can be viewed without
+    copying as NumPy arrays with numpy.frombuffer(column, dtype=numpy.uint64).
+    """
+
+    __slots__ = ("tile_ids", "offsets", "lengths", "run_lengths")
+
+    def __init__(
+        self,
+        tile_ids: array | None = None,
+        offsets: array | None = None,
+        lengths: array | None = None,
+        run_lengths: array | None = None,
+    ):
+        self.tile_ids = array("Q") if tile_ids is None else tile_ids
+        self.offsets = array("Q") if offsets is None else offsets
+        self.lengths = array("Q") if lengths is None else lengths
+        self.run_lengths = array("Q") if run_lengths is None else run_lengths
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[Entry]) -> Directory:
+        directory = cls()
+        for e in entries:
+            directory.append(e.tile_id, e.offset, e.length, e.run_length)
+        return directory
+
+    def append(self, tile_id: int, offset: int, length: int, run_length: int):
+        self.tile_ids.append(tile_id)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.run_lengths.append(run_length)
+
+    def extend(self, other: Directory):
+        self.tile_ids.extend(other.tile_ids)
+        self.offsets.extend(other.offsets)
+        self.lengths.extend(other.lengths)
+        self.run_lengths.extend(other.run_lengths)
+
+    @property
+    def nbytes(self) -> int:
+        return 4 * self.tile_ids.itemsize * len(self.tile_ids)
+
+    def __len__(self) -> int:
+        return len(self.tile_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Directory(
+                self.tile_ids[i], self.offsets[i], self.lengths[i], self.run_lengths[i]
+            )
+        return Entry(self.tile_ids[i], self.offsets[i], self.lengths[i], self.run_lengths[i])
+
+    def __iter__(self) -> Iterator[Entry]:
+        for tile_id, offset, length, run_length in zip(
+            self.tile_ids, self.offsets, self.lengths, self.run_lengths
+        ):
+            yield Entry(tile_id, offset, length, run_length)
+
+    def __eq__(self, other):
+        if not isinstance(other, Directory):
+            return NotImplemented
+        return (
+            self.tile_ids == other.tile_ids
+            and self.offsets == other.offsets
+            and self.lengths == other.lengths
+            and self.run_lengths == other.run_lengths
+        )
+
+    def find_index(self, tile_id: int) -> int:
+        i = bisect_right(self.tile_ids, tile_id) - 1
+        if i < 0:
+            return -1
+        run_length = self.run_lengths[i]
+        if run_length == 0 or tile_id - self.tile_ids[i] < run_length:
+            return i
+        return -1
+
+    def find_tile(self, tile_id: int) -> Entry | None:
+        i = self.find_index(tile_id)
+        if i < 0:
+            return None
+        return self[i]
+
+
 def rotate(n, x, y, rx, ry):
     if ry == 0:
         if rx != 0:
@@ -43,7 +140,7 @@ def rotate(n, x, y, rx, ry):
     return x, y
 
 
-def zxy_to_tileid(z: int, x: int, y: int) -> int:
+def _zxy_to_tileid_reference(z: int, x: int, y: int) -> int:
     if z > 31:
         raise OverflowError("tile zoom exceeds 64-bit limit")
     if x > (1 << z) - 1 or y > (1 << z) - 1:
@@ -61,7 +158,7 @@ def zxy_to_tileid(z: int, x: int, y: int) -> int:
     return acc
 
 
-def tileid_to_zxy(tile_id: int) -> tuple[int, int, int]:
+def _tileid_to_zxy_reference(tile_id: int) -> tuple[int, int, int]:
     z = ((3 * tile_id + 1).bit_length() - 1) // 2
     if z >= 32:
         raise OverflowError("tile zoom exceeds 64-bit limit")
@@ -82,7 +179,285 @@ def tileid_to_zxy(tile_id: int) -> tuple[int, int, int]:
     return (z, x, y)
 
 
-def find_tile(entries: list[Entry], tile_id) -> Entry | None:
+def _build_hilbert_tables() -> tuple[array, array]:
+    # Tables stepping the Hilbert curve four levels at a time. The state
+    # records how the remaining lower bits are transformed by the rotations
+    # so far: bit 0 is an x/y swap, bit 1 a complement of both.
+    encode = array("H", [0]) * 1024
+    decode = array("H", [0]) * 1024
+    for state in range(4):
+        for xs in range(16):
+            for ys in range(16):
+                st = state
+                d = 0
+                for b in range(3, -1, -1):
+                    rx = (xs >> b) & 1
+                    ry = (ys >> b) & 1
+                    if st & 1:
+                        rx, ry = ry, rx
+                    if st & 2:
+                        rx ^= 1
+                        ry ^= 1
+                    d = (d << 2) | ((3 * rx) ^ ry)
+                    if ry == 0:
+                        if rx:
+                            st ^= 2
+                        st ^= 1
+                encode[(state << 8) | (xs << 4) | ys] = (d << 2) | st
+                decode[(state << 8) | d] = (xs << 6) | (ys << 2) | st
+    return encode, decode
+
+
+_HILBERT_ENCODE, _HILBERT_DECODE = _build_hilbert_tables()
+
+# number of tiles on all zoom levels below z, for z in 0..32
+_HILBERT_ACC = [((1 << (z * 2)) - 1) // 3 for z in range(33)]
+
+
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    if z > 31:
+        raise OverflowError("tile zoom exceeds 64-bit limit")
+    if x > (1 << z) - 1 or y > (1 << z) - 1:
+        raise ValueError("tile x/y outside zoom level bounds")
+
+    # pad to a multiple of 4 levels; each leading zero level swaps x and y
+    a = (z + 3) & ~3
+    state = (a - z) & 1
+    d = 0
+    while a > 0:
+        a -= 4
+        v = _HILBERT_ENCODE[(state << 8) | (((x >> a) & 15) << 4) | ((y >> a) & 15)]
+        d = (d << 8) | (v >> 2)
+        state = v & 3
+    return _HILBERT_ACC[z] + d
+
+
+def tileid_to_zxy(tile_id: int) -> tuple[int, int, int]:
+    z = ((3 * tile_id + 1).bit_length() - 1) // 2
+    if z >= 32:
+        raise OverflowError("tile zoom exceeds 64-bit limit")
+    pos = tile_id - _HILBERT_ACC[z]
+    a = (z + 3) & ~3
+    state = (a - z) & 1
+    x = 0
+    y = 0
+    while a > 0:
+        a -= 4
+        v = _HILBERT_DECODE[(state << 8) | ((pos >> (2 * a)) & 255)]
+        x = (x << 4) | (v >> 6)
+        y = (y << 4) | ((v >> 2) & 15)
+        state = v & 3
+    return (z, x, y)
+
+
+def _zxy_to_tileid_numpy(z, x, y):
+    z = np.asarray(z, dtype=np.uint64)
+    x = np.asarray(x, dtype=np.uint64)
+    y = np.asarray(y, dtype=np.uint64)
+    if z.size and z.max() > 31:
+        raise OverflowError("tile zoom exceeds 64-bit limit")
+    limit = (np.uint64(1) << z) - np.uint64(1)
+    if np.any(x > limit) or np.any(y > limit):
+        raise ValueError("tile x/y outside zoom level bounds")
+    encode = np.asarray(_HILBERT_ENCODE, dtype=np.uint64)
+    # every tile is padded to 32 levels
+    state = z & np.uint64(1)
+    d = np.zeros(z.shape, dtype=np.uint64)
+    for a in range(28, -1, -4):
+        a = np.uint64(a)
+        v = encode[
+            (state << np.uint64(8))
+            | (((x >> a) & np.uint64(15)) << np.uint64(4))
+            | ((y >> a) & np.uint64(15))
+        ]
+        d = (d << np.uint64(8)) | (v >> np.uint64(2))
+        state = v & np.uint64(3)
+    return np.asarray(_HILBERT_ACC, dtype=np.uint64)[z] + d
+
+
+def _tileid_to_zxy_numpy(tile_ids):
+    tile_ids = np.asarray(tile_ids, dtype=np.uint64)
+    acc = np.asarray(_HILBERT_ACC, dtype=np.uint64)
+    z = (np.searchsorted(acc, tile_ids, side="right") - 1).astype(np.uint64)
+    if z.size and z.max() > 31:
+        raise OverflowError("tile zoom exceeds 64-bit limit")
+    pos = tile_ids - acc[z]
+    decode = np.asarray(_HILBERT_DECODE, dtype=np.uint64)
+    state = z & np.uint64(1)
+    x = np.zeros(z.shape, dtype=np.uint64)
+    y = np.zeros(z.shape, dtype=np.uint64)
+    for a in range(28, -1, -4):
+        v = decode[(state << np.uint64(8)) | ((pos >> np.uint64(2 * a)) & np.uint64(255))]
+        x = (x << np.uint64(4)) | (v >> np.uint64(6))
+        y = (y << np.uint64(4)) | ((v >> np.uint64(2)) & np.uint64(15))
+        state = v & np.uint64(3)
+    return z, x, y
+
+
+def _to_array(values) -> array:
+    result = array("Q")
+    result.frombytes(np.ascontiguousarray(values, dtype=np.uint64).tobytes())
+    return result
+
+
+def zxy_to_tileid_array(z, x, y):
+    """Convert parallel sequences of z, x and y to tile ids in bulk.
+
+    Returns a NumPy uint64 array when any input is a NumPy array, otherwise
+    array("Q").
+    """
+    if np is not None and any(isinstance(v, np.ndarray) for v in (z, x, y)):
+        return _zxy_to_tileid_numpy(z, x, y)
+    if np is not None and len(z) >= NUMPY_MIN_VALUES:
+        return _to_array(_zxy_to_tileid_numpy(z, x, y))
+    return array("Q", map(zxy_to_tileid, z, x, y))
+
+
+def tileid_to_zxy_array(tile_ids):
+    """Convert a sequence of tile ids to (z, x, y) sequences in bulk.
+
+    Returns NumPy uint64 arrays when tile_ids is a NumPy array, otherwise
+    three array("Q").
+    """
+    if np is not None and isinstance(tile_ids, np.ndarray):
+        return _tileid_to_zxy_numpy(tile_ids)
+    if np is not None and len(tile_ids) >= NUMPY_MIN_VALUES:
+        return tuple(_to_array(v) for v in _tileid_to_zxy_numpy(tile_ids))
+    zs, xs, ys = array("Q"), array("Q"), array("Q")
+    for tile_id in tile_ids:
+        z, x, y = tileid_to_zxy(tile_id)
+        zs.append(z)
+        xs.append(x)
+        ys.append(y)
+    return zs, xs, ys
+
+
+OUTSIDE = 0
+PARTIAL = 1
+INSIDE = 2
+
+# latitude limit of the web mercator tile grid
+MAX_LAT = 85.0511287798066
+
+
+def merge_ranges(ranges: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Sort half-open (start, stop) intervals and merge overlapping or adjacent ones."""
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            if stop > merged[-1][1]:
+                merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def tileid_ranges(minzoom: int, maxzoom: int, classify) -> list[tuple[int, int]]:
+    """Decompose a region into sorted, merged half-open tile id intervals.
+
+    classify(z, x, y) returns OUTSIDE, PARTIAL or INSIDE for a tile of the
+    quadtree. Every tile on zooms minzoom..maxzoom that is not OUTSIDE is
+    covered. The descendants of an INSIDE tile are never visited: on each zoom
+    they form a single interval of the Hilbert curve.
+    """
+    if maxzoom > 31:
+        raise OverflowError("tile zoom exceeds 64-bit limit")
+    ranges = []
+    stack = [(0, 0, 0)]
+    while stack:
+        z, x, y = stack.pop()
+        c = classify(z, x, y)
+        if c == OUTSIDE:
+            continue
+        pos = zxy_to_tileid(z, x, y) - _HILBERT_ACC[z]
+        last = maxzoom if c == INSIDE else z
+        for zz in range(max(z, minzoom), last + 1):
+            shift = 2 * (zz - z)
+            start = _HILBERT_ACC[zz] + (pos << shift)
+            ranges.append((start, start + (1 << shift)))
+        if c != INSIDE and z < maxzoom:
+            x *= 2
+            y *= 2
+            z += 1
+            stack.extend(((z, x, y), (z, x + 1, y), (z, x, y + 1), (z, x + 1, y + 1)))
+    return merge_ranges(ranges)
+
+
+def rect_tileid_ranges(
+    z: int, min_x: int, min_y: int, max_x: int, max_y: int
+) -> list[tuple[int, int]]:
+    """Tile id intervals covering the inclusive tile rectangle at zoom z."""
+
+    def classify(nz, nx, ny):
+        d = z - nz
+        x0, x1 = nx << d, ((nx + 1) << d) - 1
+        y0, y1 = ny << d, ((ny + 1) << d) - 1
+        if x1 < min_x or x0 > max_x or y1 < min_y or y0 > max_y:
+            return OUTSIDE
+        if x0 >= min_x and x1 <= max_x and y0 >= min_y and y1 <= max_y:
+            return INSIDE
+        return PARTIAL
+
+    return tileid_ranges(z, z, classify)
+
+
+def lonlat_to_world(lon: float, lat: float) -> tuple[float, float]:
+    """Project a longitude and latitude to web mercator, scaled to [0, 1]."""
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    x = (lon + 180.0) / 360.0
+    y = 0.5 - math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) / (2 * math.pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def _world_boxes(bbox: Sequence[float]) -> list[tuple[float, float, float, float]]:
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if min_lon > max_lon:
+        # crosses the antimeridian
+        return _world_boxes((min_lon, min_lat, 180.0, max_lat)) + _world_boxes(
+            (-180.0, min_lat, max_lon, max_lat)
+        )
+    x0, y1 = lonlat_to_world(min_lon, min_lat)
+    x1, y0 = lonlat_to_world(max_lon, max_lat)
+    # a tile touching the box only at its edge is outside, but a degenerate
+    # box still selects the tile it lies in
+    return [(x0, y0, max(x1, x0 + 1e-12), max(y1, y0 + 1e-12))]
+
+
+def bbox_classifier(bbox: Sequence[float]):
+    """Return a tileid_ranges classify function for a lon/lat bounding box.
+
+    bbox is (min_lon, min_lat, max_lon, max_lat); min_lon > max_lon crosses
+    the antimeridian.
+    """
+    boxes = _world_boxes(bbox)
+
+    def classify(z, x, y):
+        scale = 1.0 / (1 << z)
+        tx0, ty0 = x * scale, y * scale
+        tx1, ty1 = tx0 + scale, ty0 + scale
+        result = OUTSIDE
+        for x0, y0, x1, y1 in boxes:
+            if tx1 <= x0 or tx0 >= x1 or ty1 <= y0 or ty0 >= y1:
+                continue
+            if tx0 >= x0 and tx1 <= x1 and ty0 >= y0 and ty1 <= y1:
+                return INSIDE
+            result = PARTIAL
+        return result
+
+    return classify
+
+
+def bbox_tileid_ranges(
+    bbox: Sequence[float], minzoom: int, maxzoom: int
+) -> list[tuple[int, int]]:
+    """Tile id intervals covering a lon/lat bounding box on zooms minzoom..maxzoom."""
+    return tileid_ranges(minzoom, maxzoom, bbox_classifier(bbox))
+
+
+def find_tile(entries: list[Entry] | Directory, tile_id) -> Entry | None:
+    if isinstance(entries, Directory):
+        return entries.find_tile(tile_id)
+
     m = 0
     n = len(entries) - 1
     while m <= n:
@@ -130,6 +505,111 @@ def write_varint(b_io: IO[bytes], i: int):
             break
 
 
+# below this many values the NumPy codec is slower than the pure Python loop
+NUMPY_MIN_VALUES = 256
+
+
+def _decode_varints_python(buf: Buffer, count: int, pos: int) -> tuple[array, int]:
+    values = array("Q")
+    append = values.append
+    try:
+        for _ in range(count):
+            b = buf[pos]
+            pos += 1
+            if b < 0x80:
+                append(b)
+                continue
+            result = b & 0x7F
+            shift = 7
+            while True:
+                b = buf[pos]
+                pos += 1
+                result |= (b & 0x7F) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            append(result)
+    except IndexError:
+        raise EOFError("unexpectedly reached end of varint stream")
+    return values, pos
+
+
+def _decode_varints_numpy(buf: Buffer, count: int, pos: int) -> tuple[array, int]:
+    data = np.frombuffer(buf, dtype=np.uint8, offset=pos)
+    ends = np.flatnonzero(data < 0x80)[:count]
+    if len(ends) < count:
+        raise EOFError("unexpectedly reached end of varint stream")
+    stop = int(ends[-1]) + 1
+    if stop == count:
+        values = data[:count].astype(np.uint64)
+    else:
+        data = data[:stop]
+        starts = np.empty(count, dtype=np.intp)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        widths = ends - starts + 1
+        shifts = (np.arange(stop) - np.repeat(starts, widths)) * 7
+        parts = (data & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+        values = np.bitwise_or.reduceat(parts, starts)
+    result = array("Q")
+    result.frombytes(values.astype(np.uint64, copy=False).tobytes())
+    return result, pos + stop
+
+
+def decode_varints(buf: Buffer, count: int, pos: int = 0) -> tuple[array, int]:
+    """Decode count consecutive varints from buf starting at byte pos.
+
+    Returns the values as array("Q") and the position just past the last
+    byte consumed.
+    """
+    if count == 0:
+        return array("Q"), pos
+    if np is not None and count >= NUMPY_MIN_VALUES:
+        return _decode_varints_numpy(buf, count, pos)
+    return _decode_varints_python(memoryview(buf), count, pos)
+
+
+def _encode_varints_python(values: Iterable[int], out: bytearray):
+    append = out.append
+    for v in values:
+        while v >= 0x80:
+            append((v & 0x7F) | 0x80)
+            v >>= 7
+        append(v)
+
+
+def _encode_varints_numpy(values, out: bytearray):
+    values = np.asarray(values, dtype=np.uint64)
+    widths = np.ones(len(values), dtype=np.intp)
+    for k in range(1, 10):
+        widths += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(widths) - widths
+    encoded = np.empty(int(widths.sum()), dtype=np.uint8)
+    for k in range(10):
+        mask = widths > k
+        if not mask.any():
+            break
+        byte = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        byte |= (widths[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        encoded[starts[mask] + k] = byte
+    out += encoded.tobytes()
+
+
+def encode_varints(values: Iterable[int], out: bytearray | None = None) -> bytearray:
+    """Append the varint encoding of every value to out and return it."""
+    if out is None:
+        out = bytearray()
+    if (
+        np is not None
+        and isinstance(values, (array, np.ndarray))
+        and len(values) >= NUMPY_MIN_VALUES
+    ):
+        _encode_varints_numpy(values, out)
+    else:
+        _encode_varints_python(values, out)
+    return out
+
+
 class Compression(Enum):
     UNKNOWN = 0
     NONE = 1
@@ -148,55 +628,79 @@ class TileType(Enum):
     MLT = 6
 
 
-def deserialize_directory(buf: Buffer) -> list[Entry]:
-    b_io = io.BytesIO(gzip.decompress(buf))
-    entries: list[Entry] = []
-    num_entries = read_varint(b_io)
-
-    last_id = 0
-    for i in range(num_entries):
-        tmp = read_varint(b_io)
-        entries.append(Entry(last_id + tmp, 0, 0, 0))
-        last_id += tmp
-
-    for i in range(num_entries):
-        entries[i].run_length = read_varint(b_io)
-
-    for i in range(num_entries):
-        entries[i].length = read_varint(b_io)
-
-    for i in range(num_entries):
-        tmp = read_varint(b_io)
-        if i > 0 and tmp == 0:
-            entries[i].offset = entries[i - 1].offset + entries[i - 1].length
-        else:
-            entries[i].offset = tmp - 1
-
-    return entries
-
-
-def serialize_directory(entries: Sequence[Entry]) -> bytes:
-    b_io = io.BytesIO()
-    write_varint(b_io, len(entries))
-
-    last_id = 0
-    for e in entries:
-        write_varint(b_io, e.tile_id - last_id)
-        last_id = e.tile_id
-
-    for e in entries:
-        write_varint(b_io, e.run_length)
-
-    for e in entries:
-        write_varint(b_io, e.length)
-
-    for i, e in enumerate(entries):
-        if i > 0 and e.offset == entries[i - 1].offset + entries[i - 1].length:
-            write_varint(b_io, 0)
-        else:
-            write_varint(b_io, e.offset + 1)
-
-    return gzip.compress(b_io.getvalue())
+def _resolve_offsets_numpy(raw, lengths):
+    n = len(raw)
+    indices = np.arange(n)
+    anchors = np.maximum.accumulate(np.where(raw != 0, indices, 0))
+    starts = np.cumsum(lengths) - lengths
+    return raw[anchors] - np.uint64(1) + (starts - starts[anchors])
+
+
+def deserialize_directory(buf: Buffer) -> Directory:
+    data = gzip.decompress(buf)
+    (num_entries,), pos = decode_varints(data, 1)
+    n = num_entries
+    values, _ = decode_varints(data, 4 * n, pos)
+
+    if np is not None and n >= NUMPY_MIN_VALUES:
+        columns = np.frombuffer(values, dtype=np.uint64).reshape(4, n)
+        tile_ids = array("Q")
+        tile_ids.frombytes(np.cumsum(columns[0], dtype=np.uint64).tobytes())
+        offsets = array("Q")
+        offsets.frombytes(_resolve_offsets_numpy(columns[3], columns[2]).tobytes())
+        return Directory(tile_ids, offsets, values[2 * n : 3 * n], values[n : 2 * n])
+
+    tile_ids = array("Q", accumulate(values[0:n]))
+    lengths = values[2 * n : 3 * n]
+    offsets = array("Q")
+    next_offset = 0
+    for i, (tmp, length) in enumerate(zip(values[3 * n : 4 * n], lengths)):
+        offset = next_offset if i > 0 and tmp == 0 else tmp - 1
+        offsets.append(offset)
+        next_offset = offset + length
+
+    return Directory(tile_ids, offsets, lengths, values[n : 2 * n])
+
+
+def serialize_directory(entries: Sequence[Entry] | Directory) -> bytes:
+    if not isinstance(entries, Directory):
+        entries = Directory.from_entries(entries)
+
+    out = encode_varints((len(entries),))
+    n = len(entries)
+
+    if np is not None and n >= NUMPY_MIN_VALUES:
+        tile_ids = np.frombuffer(entries.tile_ids, dtype=np.uint64)
+        offsets = np.frombuffer(entries.offsets, dtype=np.uint64)
+        lengths = np.frombuffer(entries.lengths, dtype=np.uint64)
+        contiguous = np.empty(n, dtype=bool)
+        contiguous[0] = False
+        contiguous[1:] = offsets[1:] == offsets[:-1] + lengths[:-1]
+        encode_varints(
+            np.concatenate(
+                (
+                    np.diff(tile_ids, prepend=np.uint64(0)),
+                    np.frombuffer(entries.run_lengths, dtype=np.uint64),
+                    lengths,
+                    np.where(contiguous, np.uint64(0), offsets + np.uint64(1)),
+                )
+            ),
+            out,
+        )
+        return gzip.compress(out)
+
+    encode_varints(map(sub, entries.tile_ids, chain((0,), entries.tile_ids)), out)
+    encode_varints(entries.run_lengths, out)
+    encode_varints(entries.lengths, out)
+
+    offset_values = []
+    next_offset = -1
+    for offset, length in zip(entries.offsets, entries.lengths):
+        offset_values.append(0 if offset == next_offset else offset + 1)
+        next_offset = offset + length
+    encode_varints(offset_values, out)
+
+    return gzip.compress(out)
 
 
 class SpecVersionUnsupported(Exception):
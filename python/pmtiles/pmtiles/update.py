@@ -0,0 +1,254 @@
+"""Patch tiles into an existing PMTiles archive in place."""
+
+import gzip
+import json
+import os
+from bisect import bisect_right
+from .tile import (
+    Entry,
+    Compression,
+    deserialize_header,
+    serialize_header,
+    deserialize_directory,
+    serialize_directory,
+    tileid_to_zxy,
+)
+from .writer import content_digest, optimize_directories
+
+
+# a gzipped root pointing at a single leaf needs about this many bytes
+_MIN_ROOT_SPACE = 64
+
+# levels of leaf directories below the root that readers follow
+_MAX_LEAF_DEPTH = 3
+
+
+def _apply(entries, changes, counts):
+    # merge sorted (tile_id, location or None) changes into the tile entries,
+    # splitting runs where a changed tile falls inside them
+    out = []
+
+    def add(tile_id, offset, length, run_length):
+        if out:
+            last = out[-1]
+            if (
+                last.tile_id + last.run_length == tile_id
+                and last.offset == offset
+                and last.length == length
+            ):
+                last.run_length += run_length
+                return
+        out.append(Entry(tile_id, offset, length, run_length))
+
+    def change(tile_id, location, existed):
+        if location is not None:
+            add(tile_id, location[0], location[1], 1)
+        counts["addressed"] += (location is not None) - existed
+
+    i = 0
+    for e in entries:
+        end = e.tile_id + e.run_length
+        while i < len(changes) and changes[i][0] < e.tile_id:
+            change(*changes[i], False)
+            i += 1
+        pos = e.tile_id
+        while i < len(changes) and changes[i][0] < end:
+            tile_id, location = changes[i]
+            if tile_id > pos:
+                add(pos, e.offset, e.length, tile_id - pos)
+            change(tile_id, location, True)
+            pos = tile_id + 1
+            i += 1
+        if pos < end:
+            add(pos, e.offset, e.length, end - pos)
+    for tile_id, location in changes[i:]:
+        change(tile_id, location, False)
+    counts["entries"] += len(out) - len(entries)
+    return out
+
+
+def _update_directory(archive, directory, changes):
+    header, get_bytes, append, counts = archive
+    tile_ids = directory.tile_ids
+    run_lengths = directory.run_lengths
+    leaf_changes = {}
+    own = []
+    for change in changes:
+        i = max(bisect_right(tile_ids, change[0]) - 1, 0)
+        if len(directory) and run_lengths[i] == 0:
+            leaf_changes.setdefault(i, []).append(change)
+        else:
+            own.append(change)
+
+    result = _apply([e for e in directory if e.run_length > 0], own, counts)
+    for i, e in enumerate(directory):
+        if e.run_length > 0:
+            continue
+        if i not in leaf_changes:
+            result.append(e)
+            continue
+        leaf = deserialize_directory(
+            get_bytes(header["leaf_directory_offset"] + e.offset, e.length)
+        )
+        new_leaf = _update_directory(archive, leaf, leaf_changes[i])
+        if new_leaf:
+            leaf_bytes = serialize_directory(new_leaf)
+            offset = append(leaf_bytes) - header["leaf_directory_offset"]
+            counts["leaf_bytes"] += len(leaf_bytes)
+            result.append(Entry(new_leaf[0].tile_id, offset, len(leaf_bytes), 0))
+    result.sort(key=lambda e: e.tile_id)
+    return result
+
+
+def _leaf_depth(get_bytes, header, directory):
+    # Writer and update keep every leaf of an archive at the same depth, so
+    # following the first leaf pointer of each level is enough
+    depth = 0
+    while True:
+        pointer = next((e for e in directory if e.run_length == 0), None)
+        if pointer is None:
+            return depth
+        directory = deserialize_directory(
+            get_bytes(header["leaf_directory_offset"] + pointer.offset, pointer.length)
+        )
+        depth += 1
+
+
+def _root_slots(header, metadata_moves):
+    # the free space before and after the root, and the space the root may
+    # take when rewritten in place; the root must stay in the first 16 KiB,
+    # clear of the sections that follow it
+    root_start = header["root_offset"]
+    root_end = root_start + header["root_length"]
+    sections = [header["leaf_directory_offset"], header["tile_data_offset"]]
+    if not metadata_moves:
+        sections.append(header["metadata_offset"])
+    end = min([o for o in sections if o >= root_end] + [16384])
+    start = 127
+    if any(start <= o < root_start for o in sections):
+        start = root_start
+    before = (start, root_start - start)
+    after = (root_end, end - root_end)
+    return before, after, end - root_start
+
+
+def update(path, tiles=None, deleted=None, metadata=None):
+    """Add, replace or delete tiles of the archive at path in place.
+
+    tiles maps tile ids to new tile data and deleted lists tile ids to
+    remove. New contents, every rewritten leaf directory and new metadata are
+    appended to the end of the file, so the cost scales with the size of the
+    change. A root directory that no longer fits beside its old copy first
+    moves the metadata out of its way, then is pushed down one level into
+    new leaf directories, up to the depth readers follow.
+
+    Replaced data and leaves stay in the file as orphaned bytes until the
+    archive is rewritten with compact.compact. The tile data and leaf
+    directory sections then continue past their original ends, interleaved
+    at the end of the file; tile_data_length and leaf_directory_length still
+    count the bytes of each, but no longer bound a contiguous range.
+
+    The new root is written to free space beside the old one and the header,
+    written last once everything else is synced, switches to it, so a crash
+    leaves either the old or the updated archive. Only a root that fits
+    nowhere else is rewritten in place, and a crash between that write and
+    the header's leaves the archive unreadable.
+
+    Returns the new header.
+    """
+    changes = {tile_id: None for tile_id in deleted or ()}
+    changes.update(tiles or {})
+
+    with open(path, "r+b") as f:
+
+        def get_bytes(offset, length):
+            f.seek(offset)
+            return f.read(length)
+
+        def append(data):
+            offset = f.seek(0, 2)
+            f.write(data)
+            return offset
+
+        header = deserialize_header(get_bytes(0, 127))
+        counts = {"addressed": 0, "entries": 0, "leaf_bytes": 0}
+
+        located = []
+        offsets = {}
+        tile_bytes = 0
+        for tile_id in sorted(changes):
+            data = changes[tile_id]
+            if data is None:
+                located.append((tile_id, None))
+                continue
+            digest = content_digest(data)
+            if digest not in offsets:
+                offsets[digest] = append(data) - header["tile_data_offset"]
+                tile_bytes += len(data)
+            located.append((tile_id, (offsets[digest], len(data))))
+
+        archive = (header, get_bytes, append, counts)
+        root = deserialize_directory(get_bytes(header["root_offset"], header["root_length"]))
+        root = _update_directory(archive, root, located)
+        if not root:
+            raise ValueError("update would leave the archive without tiles")
+
+        new_metadata = None
+        if metadata is not None:
+            new_metadata = json.dumps(metadata).encode()
+            if header["internal_compression"] == Compression.GZIP:
+                new_metadata = gzip.compress(new_metadata)
+        root_bytes = serialize_directory(root)
+        slots = _root_slots(header, new_metadata is not None)
+        if len(root_bytes) > max(slots[0][1], slots[1][1]) and new_metadata is None:
+            freed = _root_slots(header, True)
+            if freed != slots:
+                # the metadata is in the root's way; move it to the end
+                new_metadata = get_bytes(header["metadata_offset"], header["metadata_length"])
+                slots = freed
+        before, after, in_place = slots
+        space = max(before[1], after[1])
+        if len(root_bytes) > space:
+            target = space if space >= _MIN_ROOT_SPACE else in_place
+            if (
+                target >= _MIN_ROOT_SPACE
+                and _leaf_depth(get_bytes, header, root) < _MAX_LEAF_DEPTH
+            ):
+                # push the root's entries down into a new level of leaves
+                root_bytes, leaves_bytes, num_leaves = optimize_directories(root, target)
+                if num_leaves:
+                    base = append(leaves_bytes) - header["leaf_directory_offset"]
+                    counts["leaf_bytes"] += len(leaves_bytes)
+                    root = deserialize_directory(root_bytes)
+                    for i in range(len(root)):
+                        if root.run_lengths[i] == 0:
+                            root.offsets[i] += base
+                    root_bytes = serialize_directory(root)
+        slot = next((s for s in (after, before) if len(root_bytes) <= s[1]), None)
+        if slot is not None:
+            header["root_offset"] = slot[0]
+        elif len(root_bytes) > in_place:
+            raise ValueError("root directory no longer fits; rewrite the archive")
+
+        if new_metadata is not None:
+            header["metadata_offset"] = append(new_metadata)
+            header["metadata_length"] = len(new_metadata)
+        header["root_length"] = len(root_bytes)
+        header["leaf_directory_length"] += counts["leaf_bytes"]
+        header["tile_data_length"] += tile_bytes
+        header["addressed_tiles_count"] += counts["addressed"]
+        header["tile_entries_count"] += counts["entries"]
+        header["tile_contents_count"] += len(offsets)
+        if offsets:
+            header["clustered"] = False
+            zooms = [tileid_to_zxy(t)[0] for t, data in changes.items() if data is not None]
+            header["min_zoom"] = min(header["min_zoom"], *zooms)
+            header["max_zoom"] = max(header["max_zoom"], *zooms)
+
+        f.seek(header["root_offset"])
+        f.write(root_bytes)
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(0)
+        f.write(serialize_header(header))
+    return header
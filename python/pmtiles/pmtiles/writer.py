@@ -1,15 +1,23 @@
 import json
 import tempfile
 import gzip
+import hashlib
+import heapq
 import shutil
-from contextlib import contextmanager
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import chain, islice
 from .tile import (
     Entry,
+    Directory,
     serialize_directory,
     Compression,
     serialize_header,
     tileid_to_zxy,
 )
+from .reader import read_ranges, DEFAULT_GAP
 
 
 @contextmanager
@@ -22,80 +30,421 @@ def write(fname):
         f.close()
 
 
-def build_roots_leaves(entries, leaf_size):
-    root_entries = []
-    leaves_bytes = b""
-    num_leaves = 0
+def bounded_map(executor, fn, iterable, window=None):
+    """Like executor.map, but keeps at most window calls in flight.
+
+    Results are yielded in input order. Without an executor fn runs inline.
+    """
+    if executor is None:
+        yield from map(fn, iterable)
+        return
+    if window is None:
+        window = 2 * getattr(executor, "_max_workers", 4)
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
-    i = 0
-    while i < len(entries):
-        num_leaves += 1
-        serialized = serialize_directory(entries[i : i + leaf_size])
-        root_entries.append(
-            Entry(entries[i].tile_id, len(leaves_bytes), len(serialized), 0)
-        )
-        leaves_bytes += serialized
-        i += leaf_size
 
-    return serialize_directory(root_entries), leaves_bytes, num_leaves
+# compressed size of one root entry pointing at a leaf is at most ~6 bytes
+# for realistic tile id gaps and leaf lengths; see estimate_leaf_size
+_ROOT_ENTRY_BYTES = 6
 
+# gzip cannot compress better than ~1032:1 and every entry takes 4 varint bytes
+_MAX_COMPRESSION = 1032
 
-def optimize_directories(entries, target_root_len):
-    test_bytes = serialize_directory(entries)
-    if len(test_bytes) < target_root_len:
-        return test_bytes, b"", 0
+# below this many entries building leaves is not worth a thread pool
+PARALLEL_MIN_ENTRIES = 4 * 4096
 
+
+def estimate_leaf_size(num_entries, target_root_len):
+    """Return the smallest power-of-two leaf size (at least 4096) whose root
+    directory is expected to fit in target_root_len bytes."""
+    max_root_entries = max(1, target_root_len // _ROOT_ENTRY_BYTES)
     leaf_size = 4096
+    while (num_entries + leaf_size - 1) // leaf_size > max_root_entries:
+        leaf_size *= 2
+    return leaf_size
+
+
+def build_roots_leaves(entries, leaf_size, executor=None):
+    chunks = (entries[i : i + leaf_size] for i in range(0, len(entries), leaf_size))
+    leaves = list(bounded_map(executor, serialize_directory, chunks))
+
+    root = Directory()
+    offset = 0
+    for i, serialized in zip(range(0, len(entries), leaf_size), leaves):
+        root.append(entries[i].tile_id, offset, len(serialized), 0)
+        offset += len(serialized)
+
+    return serialize_directory(root), b"".join(leaves), len(leaves)
+
+
+def optimize_directories(entries, target_root_len, executor=None):
+    """Serialize entries into a root directory smaller than target_root_len
+    and, if they do not fit in the root alone, a run of leaf directories.
+
+    Leaves are serialized with executor.map when an executor is given.
+    Returns (root_bytes, leaves_bytes, num_leaves).
+    """
+    if not isinstance(entries, Directory):
+        entries = Directory.from_entries(entries)
+
+    if 4 * len(entries) < target_root_len * _MAX_COMPRESSION:
+        test_bytes = serialize_directory(entries)
+        if len(test_bytes) < target_root_len:
+            return test_bytes, b"", 0
+
+    leaf_size = estimate_leaf_size(len(entries), target_root_len)
     while True:
-        root_bytes, leaves_bytes, num_leaves = build_roots_leaves(entries, leaf_size)
+        root_bytes, leaves_bytes, num_leaves = build_roots_leaves(
+            entries, leaf_size, executor
+        )
         if len(root_bytes) < target_root_len:
             return root_bytes, leaves_bytes, num_leaves
         leaf_size *= 2
 
 
+# most spilled runs merged at once; more are first merged in passes
+_MERGE_FAN_IN = 64
+
+
+def _read_run(f, start, count, batch):
+    while count > 0:
+        n = min(count, batch)
+        f.seek(start * 32)
+        values = array("Q")
+        values.fromfile(f, n * 4)
+        it = iter(values)
+        yield from zip(it, it, it, it)
+        start += n
+        count -= n
+
+
+def _chunk_entries(entries, size):
+    it = iter(entries)
+    while True:
+        directory = Directory()
+        for tile_id, offset, length, run_length in islice(it, size):
+            directory.append(tile_id, offset, length, run_length)
+        if len(directory) == 0:
+            return
+        yield directory
+
+
+DEDUP_EXACT = "exact"
+DEDUP_RUN_LENGTH = "run_length"
+DEDUP_OFF = "off"
+
+
+def content_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _serialize_leaf(leaf):
+    return leaf.tile_ids[0], leaf.tile_ids[-1], serialize_directory(leaf)
+
+
+# bytes of tile data read per batch when copying entries between archives
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _copy_batch(writer, readers, batch, copied, max_copied, gap):
+    wanted = {}
+    known = {}
+    for source, e in batch:
+        key = (source, e.offset)
+        offset = copied.get(key)
+        if offset is None:
+            base = readers[source].header()["tile_data_offset"]
+            wanted.setdefault(source, []).append((base + e.offset, e.length))
+        else:
+            known[key] = offset
+            if max_copied is not None:
+                copied.move_to_end(key)
+    data = {
+        source: read_ranges(readers[source].get_bytes, ranges, gap)
+        for source, ranges in wanted.items()
+    }
+    for source, e in batch:
+        key = (source, e.offset)
+        tile_id = e.tile_id
+        run_length = e.run_length
+        offset = known.get(key)
+        if offset is None:
+            base = readers[source].header()["tile_data_offset"]
+            offset = writer.write_tile(tile_id, data[source][(base + e.offset, e.length)])
+            known[key] = offset
+            copied[key] = offset
+            if max_copied is not None and len(copied) > max_copied:
+                copied.popitem(last=False)
+            tile_id += 1
+            run_length -= 1
+        if run_length:
+            writer.write_tile_reference(tile_id, offset, e.length, run_length)
+
+
+def copy_entries(
+    writer,
+    readers,
+    entries,
+    gap=DEFAULT_GAP,
+    chunk_size=COPY_CHUNK_SIZE,
+    max_copied=None,
+):
+    """Add (source, entry) pairs to writer, copying tile data verbatim.
+
+    source indexes readers and entry offsets are relative to that reader's
+    tile data section. Contents are read once per source offset, in batches
+    of about chunk_size bytes with reads closer than gap coalesced; tiles
+    sharing a content in a source share it in the output.
+
+    The output offset of every copied content is remembered, unless
+    max_copied bounds them to the most recently used; a forgotten content
+    is read and written again, so pair it with the writer's own dedup.
+    """
+    copied = {} if max_copied is None else OrderedDict()
+    batch = []
+    nbytes = 0
+    for source, entry in entries:
+        batch.append((source, entry))
+        if (source, entry.offset) not in copied:
+            nbytes += entry.length
+        if nbytes >= chunk_size:
+            _copy_batch(writer, readers, batch, copied, max_copied, gap)
+            batch = []
+            nbytes = 0
+    _copy_batch(writer, readers, batch, copied, max_copied, gap)
+
+
 class Writer:
-    def __init__(self, f):
+    """Writes tiles to a PMTiles archive.
+
+    dedup selects how repeated tile contents are stored:
+    "exact" stores each distinct content once, keyed by a 128-bit BLAKE2b
+    digest; "run_length" only reuses the content of the previous tile, which
+    still collapses runs of identical tiles; "off" stores every tile.
+
+    By default every entry and content digest is kept in memory until finalize.
+    With max_memory_entries set, entries are spilled to a temporary file as
+    sorted runs whenever the buffer exceeds that many entries and merged when
+    the archive is finalized, in passes of at most 64 runs that also hold
+    about max_memory_entries entries in memory. With max_dedup_entries set,
+    only that many recently seen contents are remembered for deduplication.
+
+    Leaf directories are serialized on executor if one is given, otherwise on
+    a thread pool for archives large enough to need several leaves.
+    """
+
+    def __init__(
+        self,
+        f,
+        max_memory_entries=None,
+        max_dedup_entries=None,
+        dedup=DEDUP_EXACT,
+        executor=None,
+    ):
+        if dedup not in (DEDUP_EXACT, DEDUP_RUN_LENGTH, DEDUP_OFF):
+            raise ValueError(f"unknown dedup mode {dedup!r}")
         self.f = f
+        self.executor = executor
         self.tile_entries = []
-        self.hash_to_offset = {}
+        self.dedup = dedup
+        self.max_dedup_entries = max_dedup_entries
+        self.hash_to_offset = {} if max_dedup_entries is None else OrderedDict()
+        self.last_digest = None
+        self.deduplicated_tiles = 0
+        self.deduplicated_bytes = 0
         self.tile_f = tempfile.TemporaryFile()
         self.offset = 0
         self.addressed_tiles = 0
+        self.tile_contents = 0
         self.clustered = True
+        self.max_memory_entries = max_memory_entries
+        self.entries_f = None
+        self.runs = []
+        self.spilled_entries = 0
 
     def write_tile(self, tileid, data):
-        if len(self.tile_entries) > 0 and tileid < self.tile_entries[-1].tile_id:
-            self.clustered = False
+        """Add a tile and return the offset of its content in the tile data section."""
+        found = None
+        if self.dedup == DEDUP_EXACT:
+            digest = content_digest(data)
+            found = self.hash_to_offset.get(digest)
+            if found is None:
+                self.hash_to_offset[digest] = self.offset
+                if (
+                    self.max_dedup_entries is not None
+                    and len(self.hash_to_offset) > self.max_dedup_entries
+                ):
+                    self.hash_to_offset.popitem(last=False)
+            elif self.max_dedup_entries is not None:
+                self.hash_to_offset.move_to_end(digest)
+        elif self.dedup == DEDUP_RUN_LENGTH:
+            digest = content_digest(data)
+            if digest == self.last_digest:
+                found = self.tile_entries[-1].offset
+            self.last_digest = digest
+
+        if found is None:
+            found = self.offset
+            self.tile_f.write(data)
+            self.offset += len(data)
+            self.tile_contents += 1
+        else:
+            self.deduplicated_tiles += 1
+            self.deduplicated_bytes += len(data)
 
-        hsh = hash(data)
-        if hsh in self.hash_to_offset:
+        self._add_entry(tileid, found, len(data))
+        return found
+
+    def write_tile_reference(self, tileid, offset, length, run_length=1):
+        """Add run_length tiles from tileid on whose content was already written at offset by write_tile."""
+        self.deduplicated_tiles += run_length
+        self.deduplicated_bytes += length * run_length
+        self.last_digest = None
+        self._add_entry(tileid, offset, length, run_length)
+
+    def _add_entry(self, tileid, offset, length, run_length=1):
+        if len(self.tile_entries) > 0:
             last = self.tile_entries[-1]
-            found = self.hash_to_offset[hsh]
-            if tileid == last.tile_id + last.run_length and last.offset == found:
-                self.tile_entries[-1].run_length += 1
+            if tileid < last.tile_id:
+                self.clustered = False
+            if (
+                tileid == last.tile_id + last.run_length
+                and last.offset == offset
+                and last.length == length
+            ):
+                last.run_length += run_length
             else:
-                self.tile_entries.append(Entry(tileid, found, len(data), 1))
+                self.tile_entries.append(Entry(tileid, offset, length, run_length))
         else:
-            self.tile_f.write(data)
-            self.tile_entries.append(Entry(tileid, self.offset, len(data), 1))
-            self.hash_to_offset[hsh] = self.offset
-            self.offset += len(data)
+            self.tile_entries.append(Entry(tileid, offset, length, run_length))
+
+        self.addressed_tiles += run_length
+
+        if (
+            self.max_memory_entries is not None
+            and len(self.tile_entries) > self.max_memory_entries
+        ):
+            # the last entry stays in memory so its run can still be extended
+            self._spill(self.tile_entries[:-1])
+            del self.tile_entries[:-1]
+
+    def _spill(self, entries):
+        if self.entries_f is None:
+            self.entries_f = tempfile.TemporaryFile()
+        entries = sorted(entries, key=lambda e: e.tile_id)
+        values = array("Q")
+        for e in entries:
+            values.extend((e.tile_id, e.offset, e.length, e.run_length))
+        self.entries_f.seek(self.spilled_entries * 32)
+        values.tofile(self.entries_f)
+        self.runs.append((self.spilled_entries, len(entries)))
+        self.spilled_entries += len(entries)
 
-        self.addressed_tiles += 1
+    def _merged_entries(self):
+        budget = self.max_memory_entries
+        if self.clustered:
+            # runs follow each other, so only one is read at a time
+            return chain(
+                *[_read_run(self.entries_f, start, count, budget) for start, count in self.runs]
+            )
+        while len(self.runs) > _MERGE_FAN_IN:
+            self._merge_pass(budget)
+        batch = max(1, budget // len(self.runs))
+        return heapq.merge(
+            *[_read_run(self.entries_f, start, count, batch) for start, count in self.runs]
+        )
+
+    def _merge_pass(self, budget):
+        # merge groups of _MERGE_FAN_IN runs into a new file of longer runs,
+        # holding about budget entries in memory
+        batch = max(1, budget // _MERGE_FAN_IN)
+        merged_f = tempfile.TemporaryFile()
+        runs = []
+        position = 0
+        for i in range(0, len(self.runs), _MERGE_FAN_IN):
+            group = self.runs[i : i + _MERGE_FAN_IN]
+            merged = heapq.merge(
+                *[_read_run(self.entries_f, start, count, batch) for start, count in group]
+            )
+            values = array("Q")
+            count = 0
+            for entry in merged:
+                values.extend(entry)
+                if len(values) >= 4 * budget:
+                    merged_f.seek((position + count) * 32)
+                    values.tofile(merged_f)
+                    count += len(values) // 4
+                    values = array("Q")
+            merged_f.seek((position + count) * 32)
+            values.tofile(merged_f)
+            count += len(values) // 4
+            runs.append((position, count))
+            position += count
+        self.entries_f.close()
+        self.entries_f = merged_f
+        self.runs = runs
+
+    def _streaming_directories(self, target_root_len, executor):
+        leaves_f = tempfile.TemporaryFile()
+        leaf_size = estimate_leaf_size(self.spilled_entries, target_root_len)
+        while True:
+            leaves_f.seek(0)
+            leaves_f.truncate()
+            root = Directory()
+            leaves_length = 0
+            last = None
+            chunks = _chunk_entries(self._merged_entries(), leaf_size)
+            for first, last, serialized in bounded_map(
+                executor, _serialize_leaf, chunks
+            ):
+                root.append(first, leaves_length, len(serialized), 0)
+                leaves_f.write(serialized)
+                leaves_length += len(serialized)
+            root_bytes = serialize_directory(root)
+            if len(root_bytes) < target_root_len:
+                leaves_f.seek(0)
+                return root_bytes, leaves_f, root.tile_ids[0], last
+            leaf_size *= 2
 
     def finalize(self, header, metadata):
+        num_entries = self.spilled_entries + len(self.tile_entries)
         header["addressed_tiles_count"] = self.addressed_tiles
-        header["tile_entries_count"] = len(self.tile_entries)
-        header["tile_contents_count"] = len(self.hash_to_offset)
+        header["tile_entries_count"] = num_entries
+        header["tile_contents_count"] = self.tile_contents
 
-        self.tile_entries = sorted(self.tile_entries, key=lambda e: e.tile_id)
+        if self.executor is not None:
+            executor_context = nullcontext(self.executor)
+        elif num_entries >= PARALLEL_MIN_ENTRIES:
+            executor_context = ThreadPoolExecutor()
+        else:
+            executor_context = nullcontext(None)
 
-        header["min_zoom"] = tileid_to_zxy(self.tile_entries[0].tile_id)[0]
-        header["max_zoom"] = tileid_to_zxy(self.tile_entries[-1].tile_id)[0]
+        with executor_context as executor:
+            if self.runs:
+                self._spill(self.tile_entries)
+                self.tile_entries = []
+                root_bytes, leaves_f, first_id, last_id = self._streaming_directories(
+                    16384 - 127, executor
+                )
+                leaves_length = leaves_f.seek(0, 2)
+                leaves_f.seek(0)
+            else:
+                self.tile_entries = sorted(self.tile_entries, key=lambda e: e.tile_id)
+                first_id = self.tile_entries[0].tile_id
+                last_id = self.tile_entries[-1].tile_id
+                root_bytes, leaves_bytes, num_leaves = optimize_directories(
+                    self.tile_entries, 16384 - 127, executor
+                )
+                leaves_length = len(leaves_bytes)
 
-        root_bytes, leaves_bytes, num_leaves = optimize_directories(
-            self.tile_entries, 16384 - 127
-        )
+        header["min_zoom"] = tileid_to_zxy(first_id)[0]
+        header["max_zoom"] = tileid_to_zxy(last_id)[0]
 
         compressed_metadata = gzip.compress(json.dumps(metadata).encode())
         header["clustered"] = self.clustered
@@ -107,7 +456,7 @@ class Writer:
         header["leaf_directory_offset"] = (
             header["metadata_offset"] + header["metadata_length"]
         )
-        header["leaf_directory_length"] = len(leaves_bytes)
+        header["leaf_directory_length"] = leaves_length
         header["tile_data_offset"] = (
             header["leaf_directory_offset"] + header["leaf_directory_length"]
         )
@@ -118,7 +467,12 @@ class Writer:
         self.f.write(header_bytes)
         self.f.write(root_bytes)
         self.f.write(compressed_metadata)
-        self.f.write(leaves_bytes)
+        if self.runs:
+            shutil.copyfileobj(leaves_f, self.f)
+            leaves_f.close()
+            self.entries_f.close()
+        else:
+            self.f.write(leaves_bytes)
         self.tile_f.seek(0)
         shutil.copyfileobj(self.tile_f, self.f)
         self.tile_f.close()
@@ -0,0 +1,108 @@
+import asyncio
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pmtiles.writer import Writer
+from pmtiles.async_reader import AsyncReader, FileSource, HttpSource
+from pmtiles.tile import Compression, TileType, zxy_to_tileid
+
+
+def make_archive():
+    buf = BytesIO()
+    writer = Writer(buf)
+    writer.write_tile(zxy_to_tileid(0, 0, 0), b"1")
+    writer.write_tile(zxy_to_tileid(1, 0, 0), b"2")
+    writer.write_tile(zxy_to_tileid(1, 0, 1), b"2")
+    writer.write_tile(zxy_to_tileid(2, 0, 0), b"3")
+    writer.finalize(
+        {
+            "tile_compression": Compression.UNKNOWN,
+            "tile_type": TileType.UNKNOWN,
+        },
+        {"key": "value"},
+    )
+    return buf.getvalue()
+
+
+def CountingSource(buf):
+    calls = []
+
+    async def get_bytes(offset, length):
+        calls.append((offset, length))
+        await asyncio.sleep(0.01)
+        return buf[offset : offset + length]
+
+    get_bytes.calls = calls
+    return get_bytes
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    data = b""
+
+    def do_GET(self):
+        first, last = self.headers["Range"].split("=")[1].split("-")
+        body = self.data[int(first) : int(last) + 1]
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header(
+            "Content-Range", f"bytes {first}-{last}/{len(self.data)}"
+        )
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestAsyncReader(unittest.IsolatedAsyncioTestCase):
+    async def test_get(self):
+        reader = AsyncReader(CountingSource(make_archive()))
+        header = await reader.header()
+        self.assertEqual(header["min_zoom"], 0)
+        self.assertEqual(header["max_zoom"], 2)
+        self.assertEqual((await reader.metadata())["key"], "value")
+        self.assertEqual(await reader.get(0, 0, 0), b"1")
+        self.assertEqual(await reader.get(1, 0, 1), b"2")
+        self.assertEqual(await reader.get(2, 0, 0), b"3")
+        self.assertEqual(await reader.get(3, 0, 0), None)
+
+    async def test_coalesce(self):
+        source = CountingSource(make_archive())
+        reader = AsyncReader(source)
+        results = await asyncio.gather(*[reader.get(1, 0, 0) for _ in range(10)])
+        self.assertEqual(results, [b"2"] * 10)
+        # one header fetch, one root directory fetch, ten tile fetches
+        self.assertEqual(len(source.calls), 12)
+        self.assertEqual(reader.cache.stats()["entries"], 1)
+
+    async def test_all_tiles(self):
+        reader = AsyncReader(CountingSource(make_archive()))
+        tiles = [t async for t in reader.all_tiles()]
+        self.assertEqual(
+            tiles,
+            [((0, 0, 0), b"1"), ((1, 0, 0), b"2"), ((1, 0, 1), b"2"), ((2, 0, 0), b"3")],
+        )
+
+    async def test_file_source(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(make_archive())
+            f.flush()
+            reader = AsyncReader(FileSource(f))
+            self.assertEqual(await reader.get(2, 0, 0), b"3")
+
+    async def test_http_source(self):
+        handler = type("Handler", (RangeHandler,), {"data": make_archive()})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/test.pmtiles"
+            reader = AsyncReader(HttpSource(url))
+            self.assertEqual((await reader.metadata())["key"], "value")
+            self.assertEqual(await reader.get(1, 0, 0), b"2")
+            self.assertEqual(await reader.get(3, 0, 0), None)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, server.shutdown)
+            server.server_close()
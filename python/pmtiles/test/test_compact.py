@@ -0,0 +1,72 @@
+import os
+import unittest
+from pmtiles.writer import Writer
+from pmtiles.reader import Reader, MemorySource, all_tiles, iter_entries
+from pmtiles.compact import compact, count_range_requests
+from pmtiles.update import update
+from pmtiles.tile import Compression, TileType
+
+
+class TestCompact(unittest.TestCase):
+    def tearDown(self):
+        for fname in ("test_compact_in.pmtiles", "test_compact_out.pmtiles"):
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+
+    def write_input(self):
+        with open("test_compact_in.pmtiles", "wb") as f:
+            writer = Writer(f)
+            for i in reversed(range(3000)):
+                writer.write_tile(i, b"land" if i % 5 else b"%d" % i * 500)
+            writer.finalize(
+                {"tile_compression": Compression.NONE, "tile_type": TileType.MVT},
+                {"name": "test"},
+            )
+        update("test_compact_in.pmtiles", {i: b"new" * 300 for i in range(0, 3000, 7)})
+        with open("test_compact_in.pmtiles", "rb") as f:
+            return list(all_tiles(MemorySource(f.read())))
+
+    def test_compact(self):
+        before = self.write_input()
+
+        report = compact("test_compact_in.pmtiles", "test_compact_out.pmtiles", chunk_size=10000)
+        with open("test_compact_out.pmtiles", "rb") as f:
+            buf = f.read()
+        self.assertEqual(list(all_tiles(MemorySource(buf))), before)
+        reader = Reader(MemorySource(buf))
+        self.assertEqual(reader.header()["clustered"], True)
+        self.assertEqual(reader.metadata(), {"name": "test"})
+        self.assertEqual(report["bytes_after"], len(buf))
+        self.assertGreater(report["bytes_reclaimed"], 0)
+        self.assertEqual(report["range_requests_after"], 1)
+        self.assertGreater(report["range_requests_before"], 100)
+
+    def test_bounded_dedup(self):
+        before = self.write_input()
+        unbounded = compact("test_compact_in.pmtiles", "test_compact_out.pmtiles")
+        report = compact(
+            "test_compact_in.pmtiles", "test_compact_out.pmtiles", max_dedup_entries=2
+        )
+        with open("test_compact_out.pmtiles", "rb") as f:
+            buf = f.read()
+        self.assertEqual(list(all_tiles(MemorySource(buf))), before)
+        # "land" stays remembered as the most recent repeat
+        self.assertEqual(report["bytes_after"], unbounded["bytes_after"])
+        self.assertEqual(report["range_requests_after"], 1)
+        # forgotten contents of the unclustered input count as read again
+        self.assertGreaterEqual(
+            report["range_requests_before"], unbounded["range_requests_before"]
+        )
+
+    def test_count_clustered(self):
+        self.write_input()
+        compact("test_compact_in.pmtiles", "test_compact_out.pmtiles")
+        with open("test_compact_out.pmtiles", "rb") as f:
+            get_bytes = MemorySource(f.read())
+        for gap in (0, 4096):
+            self.assertEqual(
+                count_range_requests(iter_entries(get_bytes), gap, clustered=True),
+                count_range_requests(iter_entries(get_bytes), gap),
+            )
@@ -5,15 +5,16 @@ import os
 import shutil
 import json
 from pmtiles.writer import Writer
-from pmtiles.reader import Reader, MemorySource
+from pmtiles.reader import Reader, MemorySource, all_tiles
 from pmtiles.convert import (
     pmtiles_to_mbtiles,
     pmtiles_to_dir,
     mbtiles_to_pmtiles,
     mbtiles_to_header_json,
-    disk_to_pmtiles
+    disk_to_pmtiles,
+    scan_tile_directory,
 )
-from pmtiles.tile import TileType, Compression
+from pmtiles.tile import TileType, Compression, zxy_to_tileid
 
 
 class TestConvert(unittest.TestCase):
@@ -38,6 +39,10 @@ class TestConvert(unittest.TestCase):
             os.remove("test_tmp_from_dir.pmtiles")
         except:
             pass
+        try:
+            os.remove("test_tmp_2.pmtiles")
+        except:
+            pass
 
     def test_roundtrip(self):
         with open("test_tmp.pmtiles", "wb") as f:
@@ -153,3 +158,139 @@ class TestConvert(unittest.TestCase):
         self.assertEqual(header["center_lon_e7"], 0)
         self.assertEqual(header["center_lat_e7"], 0)
         self.assertEqual(header["center_zoom"], 1)
+
+    def test_mbtiles_map_images(self):
+        conn = sqlite3.connect("test_tmp.mbtiles")
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE metadata (name text, value text)")
+        cursor.execute(
+            "CREATE TABLE map (zoom_level integer, tile_column integer, tile_row integer, tile_id text)"
+        )
+        cursor.execute("CREATE TABLE images (tile_data blob, tile_id text)")
+        cursor.execute(
+            "CREATE VIEW tiles AS SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_data "
+            "FROM map JOIN images ON images.tile_id = map.tile_id"
+        )
+        for k, v in [("format", "png"), ("minzoom", "0"), ("maxzoom", "3")]:
+            cursor.execute("INSERT INTO metadata VALUES (?, ?)", (k, v))
+        expected = []
+        for z in range(0, 4):
+            for x in range(0, 1 << z):
+                for y in range(0, 1 << z):
+                    image_id = "water" if (x + y) % 3 else f"{z}/{x}/{y}"
+                    data = b"water" if image_id == "water" else image_id.encode()
+                    cursor.execute("INSERT INTO map VALUES (?, ?, ?, ?)", (z, x, (1 << z) - 1 - y, image_id))
+                    expected.append(((z, x, y), data))
+        for image_id in {"water"} | {d.decode() for _, d in expected if d != b"water"}:
+            data = b"water" if image_id == "water" else image_id.encode()
+            cursor.execute("INSERT INTO images VALUES (?, ?)", (data, image_id))
+        conn.commit()
+        conn.close()
+
+        mbtiles_to_pmtiles("test_tmp.mbtiles", "test_tmp.pmtiles", None)
+
+        with open("test_tmp.pmtiles", "rb") as f:
+            buf = f.read()
+        tiles = list(all_tiles(MemorySource(buf)))
+        expected.sort(key=lambda t: zxy_to_tileid(*t[0]))
+        self.assertEqual(tiles, expected)
+        header = Reader(MemorySource(buf)).header()
+        self.assertEqual(header["clustered"], True)
+        self.assertEqual(header["tile_type"], TileType.PNG)
+        self.assertEqual(
+            header["tile_contents_count"], len({d for _, d in expected})
+        )
+
+    def test_pmtiles_to_mbtiles_deduplicate(self):
+        with open("test_tmp.pmtiles", "wb") as f:
+            writer = Writer(f)
+            for tileid in range(0, 85):
+                writer.write_tile(tileid, b"ocean" if tileid % 7 else str(tileid).encode())
+            writer.finalize(
+                {
+                    "tile_type": TileType.PNG,
+                    "tile_compression": Compression.NONE,
+                    "min_zoom": 0,
+                    "max_zoom": 3,
+                },
+                {},
+            )
+        with open("test_tmp.pmtiles", "rb") as f:
+            buf = f.read()
+        expected = sorted(
+            (z, x, (1 << z) - 1 - y, d) for (z, x, y), d in all_tiles(MemorySource(buf))
+        )
+        header = Reader(MemorySource(buf)).header()
+
+        for output, deduplicate in [("test_tmp.mbtiles", False), ("test_tmp_2.mbtiles", True)]:
+            pmtiles_to_mbtiles("test_tmp.pmtiles", output, deduplicate=deduplicate, batch_size=10)
+            conn = sqlite3.connect(output)
+            cursor = conn.cursor()
+            rows = cursor.execute(
+                "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"
+            ).fetchall()
+            self.assertEqual(sorted(rows), expected)
+            if deduplicate:
+                images = cursor.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+                self.assertEqual(images, header["tile_contents_count"])
+            conn.close()
+
+    def test_disk_to_pmtiles_schemes(self):
+        tiles = {
+            (z, x, y): f"{z}/{x}/{y}".encode()
+            for z in range(0, 3)
+            for x in range(0, 1 << z)
+            for y in range(0, 1 << z)
+        }
+        layouts = {
+            "zxy": lambda z, x, y: (str(z), str(x), f"{y}.png"),
+            "zyx": lambda z, x, y: (str(z), str(y), f"{x}.png"),
+            "tms": lambda z, x, y: (str(z), str(x), f"{(1 << z) - 1 - y}.png"),
+            "ags": lambda z, x, y: (f"L{z:02d}", f"R{y:08x}", f"C{x:08x}.png"),
+            "gwc": lambda z, x, y: (f"EPSG_900913_{z:02d}", "00_00", f"{x}_{(1 << z) - 1 - y}.png"),
+        }
+        expected = sorted(tiles.items(), key=lambda t: zxy_to_tileid(*t[0]))
+        for scheme, layout in layouts.items():
+            shutil.rmtree("test_dir", ignore_errors=True)
+            for (z, x, y), data in tiles.items():
+                parts = layout(z, x, y)
+                os.makedirs(os.path.join("test_dir", *parts[:2]), exist_ok=True)
+                with open(os.path.join("test_dir", *parts), "wb") as f:
+                    f.write(data)
+            with open(os.path.join("test_dir", "metadata.json"), "w") as f:
+                json.dump({"format": "png"}, f)
+
+            tileids, paths, zooms = scan_tile_directory("test_dir", scheme)
+            self.assertEqual(sorted(tileids), [zxy_to_tileid(*t) for t, _ in expected])
+            self.assertEqual(zooms, {0, 1, 2})
+
+            disk_to_pmtiles("test_dir", "test_tmp_from_dir.pmtiles", "auto", scheme=scheme, workers=2)
+            with open("test_tmp_from_dir.pmtiles", "rb") as f:
+                self.assertEqual(list(all_tiles(MemorySource(f.read()))), expected)
+
+    def test_pmtiles_to_dir_links(self):
+        with open("test_tmp.pmtiles", "wb") as f:
+            writer = Writer(f)
+            for tileid in range(0, 21):
+                writer.write_tile(tileid, b"sea" if tileid % 5 else str(tileid).encode())
+            writer.finalize(
+                {
+                    "tile_type": TileType.PNG,
+                    "tile_compression": Compression.NONE,
+                    "min_zoom": 0,
+                    "max_zoom": 2,
+                },
+                {"name": "test"},
+            )
+        pmtiles_to_dir("test_tmp.pmtiles", "test_dir", workers=2, link="hardlink")
+        with open(os.path.join("test_dir", "metadata.json")) as f:
+            self.assertEqual(json.load(f), {"name": "test"})
+        with open("test_tmp.pmtiles", "rb") as f:
+            tiles = list(all_tiles(MemorySource(f.read())))
+        self.assertEqual(len(tiles), 21)
+        for (z, x, y), data in tiles:
+            path = os.path.join("test_dir", str(z), str(x), f"{y}.png")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), data)
+            if data == b"sea":
+                self.assertGreater(os.stat(path).st_nlink, 1)
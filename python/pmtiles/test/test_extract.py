@@ -0,0 +1,98 @@
+import os
+import unittest
+from pmtiles.writer import Writer
+from pmtiles.reader import Reader, MemorySource, all_tiles
+from pmtiles.extract import extract, region_bbox
+from pmtiles.tile import Compression, TileType, zxy_to_tileid
+
+
+def write_archive(fname):
+    with open(fname, "wb") as f:
+        writer = Writer(f)
+        for i in range(0, zxy_to_tileid(7, 0, 0)):
+            writer.write_tile(i, b"water" if i % 13 < 8 else str(i).encode())
+        writer.finalize(
+            {
+                "tile_compression": Compression.NONE,
+                "tile_type": TileType.PNG,
+                "min_lon_e7": -1800000000,
+                "min_lat_e7": -850000000,
+                "max_lon_e7": 1800000000,
+                "max_lat_e7": 850000000,
+                "center_zoom": 0,
+                "center_lon_e7": 0,
+                "center_lat_e7": 0,
+            },
+            {"name": "test"},
+        )
+
+
+def read_archive(fname):
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+class TestExtract(unittest.TestCase):
+    def setUp(self):
+        write_archive("test_extract_in.pmtiles")
+
+    def tearDown(self):
+        for fname in ("test_extract_in.pmtiles", "test_extract_out.pmtiles", "test_extract_out_2.pmtiles"):
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+
+    def test_bbox(self):
+        bbox = (5.5, 45.2, 15.1, 55.3)
+        extract("test_extract_in.pmtiles", "test_extract_out.pmtiles", bbox=bbox, minzoom=1, maxzoom=5, chunk_size=64)
+        src = Reader(MemorySource(read_archive("test_extract_in.pmtiles")))
+        buf = read_archive("test_extract_out.pmtiles")
+        out = Reader(MemorySource(buf))
+        expected = list(src.tiles_in(bbox, minzoom=1, maxzoom=5))
+        self.assertEqual(list(all_tiles(MemorySource(buf))), expected)
+
+        header = out.header()
+        self.assertEqual(header["min_zoom"], 1)
+        self.assertEqual(header["max_zoom"], 5)
+        self.assertEqual(header["min_lon_e7"], 55000000)
+        self.assertEqual(header["max_lat_e7"], 553000000)
+        self.assertEqual(header["clustered"], True)
+        self.assertEqual(header["addressed_tiles_count"], len(expected))
+        self.assertEqual(header["tile_contents_count"], len({d for _, d in expected}))
+        self.assertEqual(out.metadata(), {"name": "test"})
+
+    def test_region(self):
+        square = {
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[-60.1, -20.3], [-30.2, -20.3], [-30.2, 10.4], [-60.1, 10.4], [-60.1, -20.3]]],
+            },
+        }
+        self.assertEqual(region_bbox(square), (-60.1, -20.3, -30.2, 10.4))
+        extract("test_extract_in.pmtiles", "test_extract_out.pmtiles", region=square)
+        extract("test_extract_in.pmtiles", "test_extract_out_2.pmtiles", bbox=region_bbox(square))
+        self.assertEqual(
+            list(all_tiles(MemorySource(read_archive("test_extract_out.pmtiles")))),
+            list(all_tiles(MemorySource(read_archive("test_extract_out_2.pmtiles")))),
+        )
+
+        triangle = {
+            "type": "Polygon",
+            "coordinates": [[[-60.1, -20.3], [-30.2, -20.3], [-60.1, 10.4], [-60.1, -20.3]]],
+        }
+        extract("test_extract_in.pmtiles", "test_extract_out.pmtiles", region=triangle, minzoom=6)
+        tiles = {zxy for zxy, _ in all_tiles(MemorySource(read_archive("test_extract_out.pmtiles")))}
+        square_tiles = {
+            zxy
+            for zxy, _ in all_tiles(MemorySource(read_archive("test_extract_out_2.pmtiles")))
+            if zxy[0] == 6
+        }
+        self.assertLess(tiles, square_tiles)
+        self.assertGreater(len(tiles), len(square_tiles) // 2)
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            extract("test_extract_in.pmtiles", "test_extract_out.pmtiles", bbox=(0, 0, 1, 1), minzoom=8)
+        self.assertFalse(os.path.exists("test_extract_out.pmtiles"))
@@ -0,0 +1,74 @@
+import os
+import unittest
+from pmtiles.writer import Writer
+from pmtiles.reader import Reader, MemorySource, all_tiles
+from pmtiles.merge import merge, paint_entries
+from pmtiles.tile import Compression, TileType, Entry
+
+
+def write_archive(fname, tiles, bounds):
+    with open(fname, "wb") as f:
+        writer = Writer(f)
+        for tile_id, data in tiles:
+            writer.write_tile(tile_id, data)
+        writer.finalize(
+            {
+                "tile_compression": Compression.NONE,
+                "tile_type": TileType.PNG,
+                "min_lon_e7": bounds[0],
+                "min_lat_e7": bounds[1],
+                "max_lon_e7": bounds[2],
+                "max_lat_e7": bounds[3],
+            },
+            {"name": fname},
+        )
+
+
+class TestMerge(unittest.TestCase):
+    files = ("test_merge_a.pmtiles", "test_merge_b.pmtiles", "test_merge_out.pmtiles")
+
+    def tearDown(self):
+        for fname in self.files:
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+
+    def test_paint_entries(self):
+        a = [Entry(10, 0, 1, 10)]
+        b = [Entry(0, 0, 1, 15), Entry(18, 1, 1, 5)]
+        self.assertEqual(
+            [(i, e.tile_id, e.run_length) for i, e in paint_entries([a, b])],
+            [(1, 0, 10), (0, 10, 10), (1, 20, 3)],
+        )
+        self.assertEqual(
+            [(i, e.tile_id, e.run_length) for i, e in paint_entries([b, a])],
+            [(0, 0, 15), (1, 15, 3), (0, 18, 5)],
+        )
+
+    def test_merge(self):
+        a = [(i, b"land" if i % 4 else b"a%d" % i) for i in range(0, 300)]
+        b = [(i, b"land" if i % 3 else b"b%d" % i) for i in range(200, 500)]
+        write_archive("test_merge_a.pmtiles", a, (0, 0, 10, 10))
+        write_archive("test_merge_b.pmtiles", reversed(b), (-5, 5, 5, 20))
+
+        for priority, first in ((None, a), ([0, 1], b)):
+            merge(["test_merge_a.pmtiles", "test_merge_b.pmtiles"], "test_merge_out.pmtiles", priority=priority)
+            expected = dict(b if first is a else a)
+            expected.update(first)
+            with open("test_merge_out.pmtiles", "rb") as f:
+                buf = f.read()
+            reader = Reader(MemorySource(buf))
+            tiles = list(all_tiles(MemorySource(buf)))
+            self.assertEqual(len(tiles), 500)
+            for (zxy, data), (tile_id, expected_data) in zip(tiles, sorted(expected.items())):
+                self.assertEqual(data, expected_data)
+            header = reader.header()
+            self.assertEqual(header["clustered"], True)
+            self.assertEqual(header["tile_contents_count"], len(set(expected.values())))
+            self.assertEqual(
+                (header["min_lon_e7"], header["min_lat_e7"], header["max_lon_e7"], header["max_lat_e7"]),
+                (-5, 0, 10, 20),
+            )
+            name = "test_merge_a.pmtiles" if first is a else "test_merge_b.pmtiles"
+            self.assertEqual(reader.metadata(), {"name": name})
@@ -0,0 +1,185 @@
+import os
+import random
+import tempfile
+import threading
+import unittest
+from pmtiles.writer import Writer
+from pmtiles.pool import ReaderPool
+from pmtiles.reader import Reader, PreadSource
+from pmtiles.cache import DirectoryCache
+from pmtiles.update import update
+from pmtiles.tile import Compression, TileType, zxy_to_tileid, tileid_to_zxy
+
+
+def make_tile_ids():
+    # irregular ids and sizes so the archives need leaf directories
+    rng = random.Random(0)
+    tile_ids = {0, 7, 5463}
+    tile_id = 0
+    while len(tile_ids) < 10000:
+        tile_id += rng.randint(1, 40)
+        tile_ids.add(tile_id)
+    return sorted(tile_ids)
+
+
+TILE_IDS = make_tile_ids()
+
+
+def tile_data(i, tile_id):
+    return f"{i}:{tile_id};".encode() * (tile_id % 30 + 1)
+
+
+def write_archive(fname, tiles, name="test"):
+    with open(fname, "wb") as f:
+        writer = Writer(f)
+        for tile_id in sorted(tiles):
+            writer.write_tile(tile_id, tiles[tile_id])
+        writer.finalize(
+            {"tile_compression": Compression.NONE, "tile_type": TileType.MVT},
+            {"name": name},
+        )
+
+
+class TestReaderPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = {}
+        for i in range(5):
+            path = os.path.join(self.tmp.name, f"layer{i}.pmtiles")
+            write_archive(path, {t: tile_data(i, t) for t in TILE_IDS}, f"layer{i}")
+            self.paths[f"layer{i}"] = path
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get(self):
+        with ReaderPool.from_directory(self.tmp.name) as pool:
+            self.assertEqual(pool.names(), sorted(self.paths))
+            self.assertEqual(pool.stats()["open"], 0)
+            self.assertEqual(pool.get("layer3", 0, 0, 0), tile_data(3, 0))
+            self.assertEqual(pool.get("layer1", 2, 1, 1), tile_data(1, 7))
+            self.assertIsNone(pool.get("layer1", 20, 0, 0))
+            self.assertEqual(pool.metadata("layer2"), {"name": "layer2"})
+            self.assertEqual(
+                pool.header("layer4")["max_zoom"], tileid_to_zxy(TILE_IDS[-1])[0]
+            )
+            self.assertEqual(pool.stats()["open"], 4)
+            with self.assertRaises(KeyError):
+                pool.get("missing", 0, 0, 0)
+
+    def test_ready(self):
+        with ReaderPool(self.paths, check_interval=60) as pool:
+            self.assertFalse(pool.ready("layer0"))
+            with pool.borrow("layer0") as handle:
+                self.assertTrue(pool.ready("layer0"))
+                fingerprint = handle.fingerprint
+            self.assertFalse(pool.ready("missing"))
+        with ReaderPool(self.paths) as other:
+            with other.borrow("layer0") as handle:
+                self.assertEqual(handle.fingerprint, fingerprint)
+            with other.borrow("layer1") as handle:
+                self.assertNotEqual(handle.fingerprint, fingerprint)
+
+    def test_shared_cache(self):
+        with ReaderPool(self.paths) as pool:
+            for name in self.paths:
+                pool.get(name, 7, 1, 1)
+            keys = list(pool.cache._entries)
+            self.assertEqual({key[0] for key in keys}, set(self.paths))
+            # a root and one leaf per archive
+            self.assertEqual(len(keys), 2 * len(self.paths))
+            pool.remove("layer0")
+            self.assertNotIn("layer0", pool)
+            self.assertEqual(len(pool.cache), 2 * (len(self.paths) - 1))
+
+    def test_cache_shared_with_reader(self):
+        cache = DirectoryCache()
+        with open(self.paths["layer4"], "rb") as f:
+            reader = Reader(PreadSource(f), cache)
+            self.assertEqual(reader.get(7, 1, 1), tile_data(4, 5463))
+            with ReaderPool(self.paths, cache=cache, check_interval=0) as pool:
+                with pool.reader("layer0") as borrowed:
+                    self.assertEqual(borrowed.get(7, 1, 1), tile_data(0, 5463))
+                    write_archive(self.paths["layer0"], {0: b"new"})
+                    self.assertEqual(pool.get("layer0", 0, 0, 0), b"new")
+                pool.remove("layer0")
+            # the plain reader's directories are left alone
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(reader.get(7, 1, 1), tile_data(4, 5463))
+
+    def test_max_open(self):
+        with ReaderPool(self.paths, max_open=2) as pool:
+            for i, name in enumerate(sorted(self.paths)):
+                self.assertEqual(pool.get(name, 0, 0, 0), tile_data(i, 0))
+                self.assertLessEqual(pool.stats()["open"], 2)
+            misses = pool.cache.stats()["misses"]
+            # closed archives keep their cached directories
+            self.assertEqual(pool.get("layer0", 0, 0, 0), tile_data(0, 0))
+            self.assertEqual(pool.stats()["opens"], 6)
+            self.assertEqual(pool.cache.stats()["misses"], misses)
+
+    def test_close_idle(self):
+        with ReaderPool(self.paths, idle_timeout=0) as pool:
+            with pool.reader("layer0") as reader:
+                pool.get("layer1", 0, 0, 0)
+                pool.close_idle()
+                # borrowed readers stay open
+                self.assertEqual(pool.stats()["open"], 1)
+                self.assertEqual(reader.get(0, 0, 0), tile_data(0, 0))
+            pool.close_idle()
+            self.assertEqual(pool.stats()["open"], 0)
+
+    def test_replaced(self):
+        with ReaderPool(self.paths, check_interval=0) as pool:
+            self.assertEqual(pool.get("layer0", 7, 1, 1), tile_data(0, 5463))
+            with pool.reader("layer0") as reader:
+                replacement = self.paths["layer0"] + ".tmp"
+                write_archive(replacement, {0: b"new", 7: b"new7"})
+                os.replace(replacement, self.paths["layer0"])
+                self.assertEqual(pool.get("layer0", 7, 1, 1), None)
+                self.assertEqual(pool.get("layer0", 0, 0, 0), b"new")
+                # the borrowed reader still reads the old file
+                self.assertEqual(reader.get(7, 1, 1), tile_data(0, 5463))
+            self.assertEqual(pool.stats()["reloads"], 1)
+            self.assertEqual(pool.metadata("layer0"), {"name": "test"})
+            # directories of the old file are gone once its last borrower is done
+            generations = {key[1] for key in pool.cache._entries if key[0] == "layer0"}
+            self.assertEqual(len(generations), 1)
+
+    def test_updated_in_place(self):
+        with ReaderPool(self.paths, check_interval=0) as pool:
+            tile_id = zxy_to_tileid(7, 1, 1)
+            self.assertEqual(pool.get("layer0", 7, 1, 1), tile_data(0, 5463))
+            update(self.paths["layer0"], tiles={tile_id: b"patched"})
+            self.assertEqual(pool.get("layer0", 7, 1, 1), b"patched")
+            self.assertEqual(pool.stats()["reloads"], 1)
+
+    def test_replaced_while_closed(self):
+        with ReaderPool(self.paths, idle_timeout=0) as pool:
+            self.assertEqual(pool.get("layer0", 0, 0, 0), tile_data(0, 0))
+            pool.close_idle()
+            write_archive(self.paths["layer0"], {0: b"new"})
+            self.assertEqual(pool.get("layer0", 0, 0, 0), b"new")
+            self.assertEqual(pool.stats()["reloads"], 1)
+
+    def test_threads(self):
+        with ReaderPool(self.paths, max_open=2, idle_timeout=0, check_interval=0) as pool:
+            errors = []
+
+            def work(i):
+                try:
+                    for j in range(200):
+                        name = f"layer{(i + j) % 5}"
+                        self.assertEqual(pool.get(name, 7, 1, 1), tile_data((i + j) % 5, 5463))
+                        if j % 50 == 0:
+                            pool.close_idle()
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            self.assertLessEqual(pool.stats()["open"], 2)
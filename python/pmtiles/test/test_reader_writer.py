@@ -1,8 +1,50 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pmtiles.writer import Writer
-from pmtiles.reader import all_tiles, Reader, MemorySource
-from pmtiles.tile import Compression, TileType, tileid_to_zxy, zxy_to_tileid
+from pmtiles.reader import all_tiles, Reader, MemorySource, coalesce_ranges
+from pmtiles.reader import iter_entries, scan_tiles, MmapSource, PreadSource, NotCached
+from pmtiles.tile import Compression, TileType, tileid_to_zxy, zxy_to_tileid, Entry
+from pmtiles.tile import bbox_tileid_ranges
+from pmtiles.cache import DirectoryCache, directory_nbytes
+
+
+def CountingSource(buf):
+    calls = []
+
+    def get_bytes(offset, length):
+        calls.append((offset, length))
+        return buf[offset : offset + length]
+
+    get_bytes.calls = calls
+    return get_bytes
+
+
+def make_leafy_archive(n=20000):
+    """Write n tiles with irregular ids so that the archive needs leaf directories."""
+    rng = random.Random(1)
+    buf = BytesIO()
+    writer = Writer(buf)
+    tile_ids = []
+    tile_id = 0
+    for i in range(n):
+        tile_id += rng.randint(1, 1000)
+        tile_ids.append(tile_id)
+        writer.write_tile(tile_id, str(i).encode())
+    writer.finalize(
+        {
+            "tile_compression": Compression.NONE,
+            "tile_type": TileType.MVT,
+        },
+        {},
+    )
+    return buf.getvalue(), tile_ids
 
 
 class TestReaderWriter(unittest.TestCase):
@@ -67,4 +109,497 @@ class TestReaderWriter(unittest.TestCase):
             ((0,0,0), b"1"),
             ((1,0,0), b"1"),
             ((2,0,0), b"2"),
-        ])
\ No newline at end of file
+        ])
+
+class TestDirectoryCache(unittest.TestCase):
+    def test_reader_cache(self):
+        buf = BytesIO()
+        writer = Writer(buf)
+        writer.write_tile(zxy_to_tileid(0, 0, 0), b"1")
+        writer.write_tile(zxy_to_tileid(1, 0, 0), b"2")
+        writer.finalize(
+            {
+                "tile_compression": Compression.UNKNOWN,
+                "tile_type": TileType.UNKNOWN,
+            },
+            {},
+        )
+
+        reader = Reader(MemorySource(buf.getvalue()))
+        self.assertEqual(reader.get(0, 0, 0), b"1")
+        self.assertEqual(reader.get(1, 0, 0), b"2")
+        self.assertEqual(reader.get(2, 0, 0), None)
+        self.assertEqual(reader.cache.misses, 1)
+        self.assertEqual(reader.cache.hits, 2)
+        self.assertEqual(len(reader.cache), 1)
+
+    def test_locate_cached_only(self):
+        buf = BytesIO()
+        writer = Writer(buf)
+        writer.write_tile(zxy_to_tileid(0, 0, 0), b"1")
+        writer.finalize(
+            {
+                "tile_compression": Compression.UNKNOWN,
+                "tile_type": TileType.UNKNOWN,
+            },
+            {},
+        )
+
+        reader = Reader(MemorySource(buf.getvalue()))
+        with self.assertRaises(NotCached):
+            reader.locate(0, 0, 0, cached_only=True)
+        location = reader.locate(0, 0, 0)
+        self.assertEqual(reader.locate(0, 0, 0, cached_only=True), location)
+        self.assertIsNone(reader.locate(1, 0, 0, cached_only=True))
+
+    def test_eviction(self):
+        entries = [Entry(i, i, 1, 1) for i in range(10)]
+        size = directory_nbytes(entries)
+        cache = DirectoryCache(max_bytes=size * 2)
+        cache.get(0, lambda: list(entries))
+        cache.get(1, lambda: list(entries))
+        cache.get(0, lambda: list(entries))
+        cache.get(2, lambda: list(entries))
+        self.assertEqual(cache.evictions, 1)
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+        self.assertIn(2, cache)
+        self.assertEqual(cache.current_bytes, size * 2)
+
+    def test_oversized(self):
+        cache = DirectoryCache(max_bytes=0)
+        self.assertEqual(cache.get(0, lambda: [Entry(0, 0, 1, 1)])[0].tile_id, 0)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 1)
+
+    def test_load_error(self):
+        cache = DirectoryCache()
+
+        def fail():
+            raise OSError("unreachable")
+
+        with self.assertRaises(OSError):
+            cache.get(0, fail)
+        self.assertEqual(cache.get(0, lambda: [Entry(0, 0, 1, 1)])[0].tile_id, 0)
+
+    def test_threads(self):
+        buf, tile_ids = make_leafy_archive()
+        header = Reader(MemorySource(buf)).header()
+        calls = []
+        barrier = threading.Barrier(16)
+
+        def get_bytes(offset, length):
+            calls.append((offset, length))
+            if offset < header["tile_data_offset"]:
+                time.sleep(0.005)
+            return buf[offset : offset + length]
+
+        reader = Reader(get_bytes)
+
+        def work(seed):
+            ids = list(tile_ids)
+            random.Random(seed).shuffle(ids)
+            barrier.wait()
+            return [(t, reader.get(*tileid_to_zxy(t))) for t in ids[:2000]]
+
+        with ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(work, range(16)))
+        expected = {t: str(i).encode() for i, t in enumerate(tile_ids)}
+        for result in results:
+            for t, data in result:
+                self.assertEqual(data, expected[t])
+
+        directory_calls = [c for c in calls if 0 < c[0] < header["tile_data_offset"]]
+        self.assertEqual(len(directory_calls), len(set(directory_calls)))
+        self.assertEqual(reader.cache.misses, len(directory_calls))
+        self.assertGreater(reader.cache.coalesced, 0)
+
+
+class TestGetMany(unittest.TestCase):
+    def test_coalesce_ranges(self):
+        self.assertEqual(coalesce_ranges([]), [])
+        self.assertEqual(
+            coalesce_ranges([(10, 5), (0, 5), (5, 5), (30, 1), (0, 5)]),
+            [(0, 15), (30, 1)],
+        )
+        self.assertEqual(coalesce_ranges([(0, 5), (30, 1)], gap=25), [(0, 31)])
+        self.assertEqual(coalesce_ranges([(0, 10), (2, 3)]), [(0, 10)])
+
+    def test_get_many(self):
+        buf, tile_ids = make_leafy_archive()
+        source = CountingSource(buf)
+        reader = Reader(source)
+        header = reader.header()
+        self.assertGreater(header["leaf_directory_length"], 0)
+
+        wanted = tile_ids[100:140] + tile_ids[15000:15005] + [0, tile_ids[5]]
+        tiles = [tileid_to_zxy(i) for i in wanted]
+        source.calls.clear()
+        results = reader.get_many(tiles)
+        # root, two leaves far apart, then tile data in two spans
+        self.assertEqual(len(source.calls), 5)
+        self.assertEqual(results, [reader.get(*t) for t in tiles])
+        self.assertEqual(results[-2], None)
+        self.assertEqual(results[0], b"100")
+
+        source.calls.clear()
+        reader.get_many(tiles, gap=1 << 30)
+        self.assertEqual(len(source.calls), 1)
+
+
+class TestStreamingWriter(unittest.TestCase):
+    def write(self, tiles, **kwargs):
+        buf = BytesIO()
+        writer = Writer(buf, **kwargs)
+        for tile_id, data in tiles:
+            writer.write_tile(tile_id, data)
+        writer.finalize(
+            {
+                "tile_compression": Compression.NONE,
+                "tile_type": TileType.MVT,
+            },
+            {},
+        )
+        return writer, buf.getvalue()
+
+    def test_spill_clustered(self):
+        tiles = [(i * 3, str(i % 50).encode()) for i in range(20000)]
+        writer, buf = self.write(tiles, max_memory_entries=1000, max_dedup_entries=10)
+        self.assertGreater(len(writer.runs), 10)
+        reader = Reader(MemorySource(buf))
+        header = reader.header()
+        self.assertEqual(header["clustered"], True)
+        self.assertEqual(header["tile_entries_count"], 20000)
+        self.assertEqual(header["addressed_tiles_count"], 20000)
+        self.assertEqual(header["max_zoom"], tileid_to_zxy(19999 * 3)[0])
+        for tile_id, data in tiles[::97]:
+            self.assertEqual(reader.get(*tileid_to_zxy(tile_id)), data)
+
+    def test_spill_unclustered(self):
+        rng = random.Random(2)
+        tiles = [(i, str(i % 300).encode()) for i in range(10000)]
+        rng.shuffle(tiles)
+        _, expected = self.write(tiles)
+        writer, buf = self.write(tiles, max_memory_entries=500, max_dedup_entries=100)
+        self.assertEqual(Reader(MemorySource(buf)).header()["clustered"], False)
+        self.assertEqual(
+            [(zxy, bytes(data)) for zxy, data in all_tiles(MemorySource(buf))],
+            [(zxy, bytes(data)) for zxy, data in all_tiles(MemorySource(expected))],
+        )
+        # the bounded dedup table forgets old contents, so more bytes are stored
+        self.assertGreater(writer.tile_contents, 300)
+
+    def test_spill_merge_passes(self):
+        rng = random.Random(3)
+        tiles = [(i, str(i % 300).encode()) for i in range(10000)]
+        rng.shuffle(tiles)
+        _, expected = self.write(tiles)
+        writer, buf = self.write(tiles, max_memory_entries=50)
+        # 200 runs are first merged into 4
+        self.assertEqual(len(writer.runs), 4)
+        self.assertEqual(
+            [(zxy, bytes(data)) for zxy, data in all_tiles(MemorySource(buf))],
+            [(zxy, bytes(data)) for zxy, data in all_tiles(MemorySource(expected))],
+        )
+
+    def finalize_peak(self, n):
+        rng = random.Random(4)
+        tile_ids = list(range(n))
+        rng.shuffle(tile_ids)
+        with tempfile.TemporaryFile() as f:
+            writer = Writer(f, max_memory_entries=1000, max_dedup_entries=10)
+            for tile_id in tile_ids:
+                writer.write_tile(tile_id, b"x")
+            tracemalloc.start()
+            try:
+                writer.finalize(
+                    {"tile_compression": Compression.NONE, "tile_type": TileType.MVT}, {}
+                )
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    def test_finalize_memory_bounded(self):
+        small = self.finalize_peak(50000)
+        large = self.finalize_peak(200000)
+        self.assertLess(large, 1.5 * small)
+
+
+class TestDedup(unittest.TestCase):
+    tiles = [(0, b"a"), (1, b"b"), (2, b"b"), (3, b"b"), (4, b"a"), (5, b"c")]
+
+    def write(self, dedup):
+        buf = BytesIO()
+        writer = Writer(buf, dedup=dedup)
+        for tile_id, data in self.tiles:
+            writer.write_tile(tile_id, data)
+        writer.finalize(
+            {
+                "tile_compression": Compression.NONE,
+                "tile_type": TileType.MVT,
+            },
+            {},
+        )
+        tiles = [(zxy_to_tileid(*zxy), data) for zxy, data in all_tiles(MemorySource(buf.getvalue()))]
+        self.assertEqual(tiles, self.tiles)
+        return writer, Reader(MemorySource(buf.getvalue())).header()
+
+    def test_exact(self):
+        writer, header = self.write("exact")
+        self.assertEqual(header["tile_contents_count"], 3)
+        self.assertEqual(header["tile_entries_count"], 4)
+        self.assertEqual(writer.deduplicated_tiles, 3)
+        self.assertEqual(writer.deduplicated_bytes, 3)
+
+    def test_run_length(self):
+        writer, header = self.write("run_length")
+        self.assertEqual(header["tile_contents_count"], 4)
+        self.assertEqual(header["tile_entries_count"], 4)
+        self.assertEqual(writer.deduplicated_bytes, 2)
+
+    def test_off(self):
+        writer, header = self.write("off")
+        self.assertEqual(header["tile_contents_count"], 6)
+        self.assertEqual(header["tile_entries_count"], 6)
+        self.assertEqual(writer.deduplicated_bytes, 0)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Writer(BytesIO(), dedup="hash")
+
+
+class TestScanTiles(unittest.TestCase):
+    def test_clustered(self):
+        buf, tile_ids = make_leafy_archive()
+        source = CountingSource(buf)
+        tiles = [(zxy, bytes(data)) for zxy, data in scan_tiles(source, block_size=16384)]
+        self.assertEqual(tiles, list(all_tiles(MemorySource(buf))))
+        header = Reader(MemorySource(buf)).header()
+        tile_reads = [c for c in source.calls if c[0] >= header["tile_data_offset"]]
+        self.assertEqual(
+            len(tile_reads), -(-header["tile_data_length"] // 16384)
+        )
+
+    def test_dedup_and_runs(self):
+        buf = BytesIO()
+        writer = Writer(buf)
+        for i in range(100):
+            writer.write_tile(i, b"ocean" if i % 10 < 5 else str(i).encode())
+        writer.finalize(
+            {"tile_compression": Compression.NONE, "tile_type": TileType.MVT}, {}
+        )
+        buf = buf.getvalue()
+        source = CountingSource(buf)
+        tiles = [(zxy, bytes(data)) for zxy, data in scan_tiles(source, block_size=8)]
+        self.assertEqual(tiles, list(all_tiles(MemorySource(buf))))
+        header = Reader(MemorySource(buf)).header()
+        ocean_reads = [c for c in source.calls if c == (header["tile_data_offset"], 5)]
+        # read once in its block and once more when first referenced again
+        self.assertEqual(len(ocean_reads), 1)
+
+        runs = list(scan_tiles(MemorySource(buf), expand_runs=False))
+        self.assertEqual(len(runs), header["tile_entries_count"])
+        self.assertEqual(runs[0][0].run_length, 5)
+        self.assertEqual(bytes(runs[0][1]), b"ocean")
+        self.assertEqual(
+            [e.tile_id for e, _ in runs], [e.tile_id for e in iter_entries(MemorySource(buf))]
+        )
+
+    def test_unclustered(self):
+        buf = BytesIO()
+        writer = Writer(buf)
+        for i in reversed(range(50)):
+            writer.write_tile(i, str(i % 7).encode())
+        writer.finalize(
+            {"tile_compression": Compression.NONE, "tile_type": TileType.MVT}, {}
+        )
+        buf = buf.getvalue()
+        tiles = [(zxy, bytes(data)) for zxy, data in scan_tiles(MemorySource(buf))]
+        self.assertEqual(tiles, list(all_tiles(MemorySource(buf))))
+
+
+class TestTilesIn(unittest.TestCase):
+    def in_ranges(self, tiles, ranges):
+        return [
+            (zxy, data)
+            for zxy, data in tiles
+            if any(start <= zxy_to_tileid(*zxy) < stop for start, stop in ranges)
+        ]
+
+    def test_ranges(self):
+        buf, tile_ids = make_leafy_archive()
+        everything = list(all_tiles(MemorySource(buf)))
+        rng = random.Random(16)
+        for _ in range(20):
+            starts = sorted(rng.sample(range(tile_ids[-1] + 1000), 6))
+            ranges = [(a, a + rng.randint(1, 20000)) for a in starts[::2]]
+            ranges = [r for i, r in enumerate(ranges) if i == 0 or r[0] >= ranges[i - 1][1]]
+            tiles = list(Reader(MemorySource(buf)).tiles_in(ranges=ranges))
+            self.assertEqual(tiles, self.in_ranges(everything, ranges))
+
+    def test_touches_only_matching_leaves(self):
+        buf, tile_ids = make_leafy_archive()
+        header = Reader(MemorySource(buf)).header()
+        source = CountingSource(buf)
+        ranges = [(tile_ids[5000], tile_ids[5010])]
+        tiles = list(Reader(source).tiles_in(ranges=ranges))
+        self.assertEqual(len(tiles), 10)
+        leaf_reads = [
+            c
+            for c in source.calls
+            if header["leaf_directory_offset"] <= c[0] < header["tile_data_offset"]
+        ]
+        self.assertEqual(len(leaf_reads), 1)
+        # header, root, one leaf and one coalesced read of tile data
+        self.assertEqual(len(source.calls), 4)
+
+    def test_bbox_and_clipped_runs(self):
+        buf = BytesIO()
+        writer = Writer(buf)
+        for z in range(0, 6):
+            for i in range(zxy_to_tileid(z, 0, 0), zxy_to_tileid(z + 1, 0, 0)):
+                writer.write_tile(i, b"land" if i % 9 < 6 else str(i).encode())
+        writer.finalize(
+            {"tile_compression": Compression.NONE, "tile_type": TileType.MVT}, {}
+        )
+        buf = buf.getvalue()
+        everything = list(all_tiles(MemorySource(buf)))
+        reader = Reader(MemorySource(buf))
+
+        bbox = (-10, 35, 30, 60)
+        ranges = bbox_tileid_ranges(bbox, 2, 5)
+        self.assertEqual(
+            list(reader.tiles_in(bbox, minzoom=2, maxzoom=5)),
+            self.in_ranges(everything, ranges),
+        )
+        entries = list(reader.tiles_in(bbox, minzoom=2, maxzoom=5, data=False))
+        self.assertEqual(
+            [t for e in entries for t in range(e.tile_id, e.tile_id + e.run_length)],
+            [zxy_to_tileid(*zxy) for zxy, _ in self.in_ranges(everything, ranges)],
+        )
+        self.assertEqual(len(list(reader.tiles_in())), len(everything))
+
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.buf, self.tile_ids = make_leafy_archive(2000)
+        self.f = tempfile.TemporaryFile()
+        self.f.write(self.buf)
+        self.f.flush()
+
+    def tearDown(self):
+        self.f.close()
+
+    def test_mmap_zero_copy(self):
+        with MmapSource(self.f, zero_copy=True) as source:
+            reader = Reader(source)
+            data = reader.get(*tileid_to_zxy(self.tile_ids[10]))
+            self.assertIsInstance(data, memoryview)
+            self.assertEqual(data, b"10")
+            self.assertEqual(reader.metadata(), {})
+            with self.assertRaises(BufferError):
+                source.close()
+            data.release()
+        with MmapSource(self.f) as source:
+            self.assertEqual(source(0, 7), b"PMTiles")
+            self.assertIsInstance(source(0, 7), bytes)
+
+    def test_pread(self):
+        reader = Reader(PreadSource(self.f))
+        expected = [str(i).encode() for i in range(2000)]
+        with ThreadPoolExecutor(8) as executor:
+            tiles = list(
+                executor.map(lambda t: reader.get(*tileid_to_zxy(t)), self.tile_ids)
+            )
+        self.assertEqual(tiles, expected)
+        self.assertEqual(PreadSource(self.f)(len(self.buf) - 2, 10), self.buf[-2:])
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        self.buf, self.tile_ids = make_leafy_archive()
+        self.header = Reader(MemorySource(self.buf)).header()
+
+    def leaf_reads(self, calls):
+        header = self.header
+        return [
+            c
+            for c in calls
+            if header["leaf_directory_offset"] <= c[0] < header["tile_data_offset"]
+        ]
+
+    def test_initial_read(self):
+        source = CountingSource(self.buf)
+        reader = Reader(source)
+        self.assertIsNone(reader.warmup())
+        self.assertEqual(source.calls, [(0, 16384)])
+        self.assertEqual(reader.metadata(), {})
+        self.assertEqual(reader.header(), self.header)
+        self.assertEqual(reader.get(*tileid_to_zxy(self.tile_ids[7])), b"7")
+        # one leaf and the tile data
+        self.assertEqual(len(source.calls), 3)
+
+    def test_all_leaves(self):
+        source = CountingSource(self.buf)
+        reader = Reader(source)
+        reader.warmup(leaves=True)
+        leaves = self.leaf_reads(source.calls)
+        self.assertEqual(len(leaves), 1)
+        del source.calls[:]
+        for i in range(0, len(self.tile_ids), 97):
+            self.assertEqual(reader.get(*tileid_to_zxy(self.tile_ids[i])), str(i).encode())
+        self.assertEqual(self.leaf_reads(source.calls), [])
+
+    def test_zooms_and_bbox(self):
+        z = tileid_to_zxy(self.tile_ids[5000])[0]
+        source = CountingSource(self.buf)
+        reader = Reader(source)
+        reader.warmup(zooms=[z])
+        del source.calls[:]
+        in_zoom = [t for t in self.tile_ids if tileid_to_zxy(t)[0] == z]
+        for t in in_zoom:
+            reader.get(*tileid_to_zxy(t))
+        self.assertEqual(self.leaf_reads(source.calls), [])
+        reader.get(*tileid_to_zxy(self.tile_ids[-1]))
+        self.assertEqual(len(self.leaf_reads(source.calls)), 1)
+
+        bbox = (0, 0, 90, 60)
+        source = CountingSource(self.buf)
+        reader = Reader(source)
+        reader.warmup(bbox=bbox, zooms=[z])
+        del source.calls[:]
+        tiles = list(reader.tiles_in(bbox, minzoom=z, maxzoom=z))
+        self.assertGreater(len(tiles), 0)
+        self.assertEqual(self.leaf_reads(source.calls), [])
+
+    def test_background(self):
+        source = CountingSource(self.buf)
+        reader = Reader(source)
+        thread = reader.warmup(leaves=True, background=True)
+        self.assertEqual(reader.get(*tileid_to_zxy(self.tile_ids[3])), b"3")
+        thread.join()
+        del source.calls[:]
+        reader.get(*tileid_to_zxy(self.tile_ids[-1]))
+        self.assertEqual(self.leaf_reads(source.calls), [])
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = os.path.join(tmp, "archive.pmtiles.idx")
+            Reader(MemorySource(self.buf)).warmup(leaves=True, index=index)
+            self.assertTrue(os.path.exists(index))
+
+            source = CountingSource(self.buf)
+            reader = Reader(source)
+            reader.warmup(leaves=True, index=index)
+            self.assertEqual(source.calls, [(0, 16384)])
+            for i in range(0, len(self.tile_ids), 97):
+                self.assertEqual(reader.get(*tileid_to_zxy(self.tile_ids[i])), str(i).encode())
+            self.assertEqual(self.leaf_reads(source.calls), [])
+
+            # an index of another archive is ignored and replaced
+            other, other_ids = make_leafy_archive(19000)
+            reader = Reader(MemorySource(other))
+            self.assertIsNone(reader.load_index(index))
+            reader.warmup(leaves=True, index=index)
+            self.assertEqual(Reader(MemorySource(other)).load_index(index), len(reader.cache))
+            self.assertEqual(reader.get(*tileid_to_zxy(other_ids[-1])), b"18999")
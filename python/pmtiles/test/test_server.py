@@ -0,0 +1,163 @@
+import asyncio
+import gzip
+import http.client
+import json
+import os
+import tempfile
+import unittest
+from pmtiles.writer import Writer
+from pmtiles.pool import ReaderPool
+from pmtiles.server import TileServer, tilejson
+from pmtiles.tile import Compression, TileType, zxy_to_tileid
+
+BIG = os.urandom(100000)
+
+
+def write_archive(fname):
+    with open(fname, "wb") as f:
+        writer = Writer(f)
+        writer.write_tile(zxy_to_tileid(0, 0, 0), gzip.compress(b"root"))
+        writer.write_tile(zxy_to_tileid(1, 0, 0), gzip.compress(b"a"))
+        writer.write_tile(zxy_to_tileid(1, 0, 1), BIG)
+        writer.finalize(
+            {
+                "tile_compression": Compression.GZIP,
+                "tile_type": TileType.MVT,
+                "min_lon_e7": -1800000000,
+                "min_lat_e7": -850000000,
+                "max_lon_e7": 1800000000,
+                "max_lat_e7": 850000000,
+                "center_zoom": 1,
+            },
+            {"name": "roads", "vector_layers": [{"id": "roads", "fields": {}}]},
+        )
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        write_archive(os.path.join(self.tmp.name, "roads.pmtiles"))
+        self.pool = ReaderPool.from_directory(self.tmp.name)
+        server = TileServer(self.pool, cors="*", cache_control="max-age=60")
+        self.server = await server.start("127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.pool.close()
+        self.tmp.cleanup()
+
+    async def fetch(self, requests):
+        # send (method, path, headers) requests over one keep-alive connection
+        def run():
+            conn = http.client.HTTPConnection("127.0.0.1", self.port)
+            responses = []
+            for method, path, headers in requests:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                responses.append((response.status, dict(response.getheaders()), response.read()))
+            conn.close()
+            return responses
+
+        return await asyncio.to_thread(run)
+
+    async def test_tiles(self):
+        (small, big, pbf, missing, wrong_ext, bad, not_ascii) = await self.fetch(
+            [
+                ("GET", "/roads/1/0/0.mvt", {}),
+                ("GET", "/roads/1/0/1.mvt", {}),
+                ("GET", "/roads/0/0/0.pbf", {}),
+                ("GET", "/roads/1/1/1.mvt", {}),
+                ("GET", "/roads/1/0/0.png", {}),
+                ("GET", "/roads/1/2/0.mvt", {}),
+                ("GET", "/roads/1/0/%C2%B2.mvt", {}),
+            ]
+        )
+        self.assertEqual(small[0], 200)
+        self.assertEqual(gzip.decompress(small[2]), b"a")
+        self.assertEqual(small[1]["Content-Encoding"], "gzip")
+        self.assertEqual(small[1]["Content-Type"], "application/vnd.mapbox-vector-tile")
+        self.assertEqual(small[1]["Access-Control-Allow-Origin"], "*")
+        self.assertEqual(small[1]["Cache-Control"], "max-age=60")
+        # sent with sendfile
+        self.assertEqual(big[0], 200)
+        self.assertEqual(big[2], BIG)
+        self.assertEqual(gzip.decompress(pbf[2]), b"root")
+        self.assertEqual(
+            [r[0] for r in (missing, wrong_ext, bad, not_ascii)], [404, 404, 404, 404]
+        )
+
+    async def test_etag(self):
+        (first,) = await self.fetch([("GET", "/roads/1/0/1.mvt", {})])
+        etag = first[1]["ETag"]
+        not_modified, other, head = await self.fetch(
+            [
+                ("GET", "/roads/1/0/1.mvt", {"If-None-Match": etag}),
+                ("GET", "/roads/1/0/0.mvt", {"If-None-Match": etag}),
+                ("HEAD", "/roads/1/0/1.mvt", {}),
+            ]
+        )
+        self.assertEqual(not_modified[0], 304)
+        self.assertEqual(not_modified[2], b"")
+        self.assertEqual(other[0], 200)
+        self.assertEqual(head[0], 200)
+        self.assertEqual(head[1]["Content-Length"], str(len(BIG)))
+        self.assertEqual(head[2], b"")
+
+    async def test_etag_stable_across_pools(self):
+        (first,) = await self.fetch([("GET", "/roads/1/0/0.mvt", {})])
+        with ReaderPool.from_directory(self.tmp.name) as other:
+            with other.borrow("roads") as archive:
+                fingerprint = archive.fingerprint
+        self.assertTrue(first[1]["ETag"].startswith(f'"{fingerprint}-'))
+
+    async def test_missing_file(self):
+        os.remove(os.path.join(self.tmp.name, "roads.pmtiles"))
+        (tile,) = await self.fetch([("GET", "/roads/1/0/0.mvt", {})])
+        (doc,) = await self.fetch([("GET", "/roads.json", {})])
+        self.assertEqual([tile[0], doc[0]], [500, 500])
+        self.assertEqual(tile[1]["Connection"], "close")
+
+    async def test_not_an_archive(self):
+        path = os.path.join(self.tmp.name, "junk.pmtiles")
+        with open(path, "wb") as f:
+            f.write(b"not an archive" * 100)
+        self.pool.add("junk", path)
+        (tile,) = await self.fetch([("GET", "/junk/0/0/0.mvt", {})])
+        (doc,) = await self.fetch([("GET", "/junk.json", {})])
+        self.assertEqual([tile[0], doc[0]], [500, 500])
+
+    async def test_tilejson(self):
+        (response, not_found, post) = await self.fetch(
+            [
+                ("GET", "/roads.json", {}),
+                ("GET", "/missing.json", {}),
+                ("POST", "/roads.json", {}),
+            ]
+        )
+        self.assertEqual(response[0], 200)
+        doc = json.loads(response[2])
+        self.assertEqual(doc["tiles"], [f"http://127.0.0.1:{self.port}/roads/{{z}}/{{x}}/{{y}}.mvt"])
+        self.assertEqual(doc["vector_layers"], [{"id": "roads", "fields": {}}])
+        self.assertEqual(doc["bounds"], [-180, -85, 180, 85])
+        self.assertEqual(doc["maxzoom"], 1)
+        self.assertEqual(not_found[0], 404)
+        self.assertEqual(post[0], 405)
+
+    def test_tilejson_document(self):
+        header = {
+            "min_zoom": 0,
+            "max_zoom": 4,
+            "min_lon_e7": 0,
+            "min_lat_e7": 0,
+            "max_lon_e7": 10000000,
+            "max_lat_e7": 20000000,
+            "center_lon_e7": 5000000,
+            "center_lat_e7": 10000000,
+            "center_zoom": 2,
+        }
+        doc = tilejson(header, {"attribution": "x", "other": 1}, "u")
+        self.assertEqual(doc["center"], [0.5, 1, 2])
+        self.assertEqual(doc["attribution"], "x")
+        self.assertNotIn("other", doc)
@@ -1,8 +1,18 @@
 import unittest
 from pmtiles.tile import zxy_to_tileid, tileid_to_zxy, Entry
-from pmtiles.tile import read_varint, write_varint
+from pmtiles.tile import read_varint, write_varint, decode_varints, encode_varints
+from pmtiles.tile import _decode_varints_python, _encode_varints_python
+from pmtiles.tile import zxy_to_tileid_array, tileid_to_zxy_array
+from pmtiles.tile import _zxy_to_tileid_reference, _tileid_to_zxy_reference
+from pmtiles.tile import rect_tileid_ranges, bbox_tileid_ranges, lonlat_to_world, merge_ranges
+import math
+import pmtiles.tile
+from array import array
+import random
 from pmtiles.tile import Entry, find_tile, Compression, TileType, HeaderDict
-from pmtiles.tile import serialize_directory, deserialize_directory
+from pmtiles.tile import serialize_directory, deserialize_directory, Directory
+from pmtiles.writer import optimize_directories, estimate_leaf_size
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pmtiles.tile import serialize_header, deserialize_header, SpecVersionUnsupported, MagicNumberNotFound
 import io
 
@@ -27,6 +37,33 @@ class TestVarint(unittest.TestCase):
         write_varint(buf, 624485)
         self.assertEqual(buf.getvalue(), b"\x00\x01\x7f\xe5\x8e\x26")
 
+    def test_decode_varints(self):
+        values, pos = decode_varints(b"\xff\x00\x01\x7f\xe5\x8e\x26", 4, 1)
+        self.assertEqual(list(values), [0, 1, 127, 624485])
+        self.assertEqual(pos, 7)
+        self.assertRaises(EOFError, decode_varints, b"\x00\x80", 2)
+
+    def test_encode_varints(self):
+        out = encode_varints([0, 1, 127, 624485])
+        self.assertEqual(bytes(out), b"\x00\x01\x7f\xe5\x8e\x26")
+
+    def test_bulk_matches_per_value(self):
+        rng = random.Random(0)
+        values = array("Q", [rng.getrandbits(rng.randint(1, 64)) for _ in range(5000)])
+        buf = io.BytesIO()
+        for v in values:
+            write_varint(buf, v)
+        encoded = bytes(encode_varints(values))
+        self.assertEqual(encoded, buf.getvalue())
+        decoded, pos = decode_varints(encoded, len(values))
+        self.assertEqual(decoded, values)
+        self.assertEqual(pos, len(encoded))
+        decoded, _ = _decode_varints_python(encoded, len(values), 0)
+        self.assertEqual(decoded, values)
+        python_out = bytearray()
+        _encode_varints_python(values, python_out)
+        self.assertEqual(bytes(python_out), encoded)
+
 
 class TestTileId(unittest.TestCase):
     def test_zxy_to_tileid(self):
@@ -74,6 +111,114 @@ class TestTileId(unittest.TestCase):
         with self.assertRaises(Exception) as context:
             zxy_to_tileid(0,1,1)
 
+    def random_tiles(self, n):
+        rng = random.Random(14)
+        tiles = []
+        for _ in range(n):
+            z = rng.randint(0, 31)
+            tiles.append((z, rng.getrandbits(z) if z else 0, rng.getrandbits(z) if z else 0))
+        return tiles
+
+    def test_matches_reference(self):
+        for z, x, y in self.random_tiles(5000):
+            tileid = _zxy_to_tileid_reference(z, x, y)
+            self.assertEqual(zxy_to_tileid(z, x, y), tileid)
+            self.assertEqual(tileid_to_zxy(tileid), _tileid_to_zxy_reference(tileid))
+        rng = random.Random(15)
+        for _ in range(5000):
+            tileid = rng.randrange(_zxy_to_tileid_reference(31, 0, 0) * 4)
+            self.assertEqual(tileid_to_zxy(tileid), _tileid_to_zxy_reference(tileid))
+
+    def test_array_conversions(self):
+        tiles = self.random_tiles(1000)
+        zs, xs, ys = (array("Q", v) for v in zip(*tiles))
+        expected = array("Q", [_zxy_to_tileid_reference(*t) for t in tiles])
+        saved = pmtiles.tile.np
+        try:
+            for numpy in (saved, None):
+                if numpy is None and saved is None:
+                    continue
+                pmtiles.tile.np = numpy
+                for n in (10, 1000):
+                    tileids = zxy_to_tileid_array(zs[:n], xs[:n], ys[:n])
+                    self.assertIsInstance(tileids, array)
+                    self.assertEqual(tileids, expected[:n])
+                    self.assertEqual(tileid_to_zxy_array(tileids), (zs[:n], xs[:n], ys[:n]))
+        finally:
+            pmtiles.tile.np = saved
+
+        with self.assertRaises(ValueError):
+            zxy_to_tileid_array(array("Q", [1]), array("Q", [2]), array("Q", [0]))
+
+    @unittest.skipIf(pmtiles.tile.np is None, "numpy not installed")
+    def test_numpy_arrays(self):
+        np = pmtiles.tile.np
+        tiles = self.random_tiles(1000)
+        zs, xs, ys = (np.array(v, dtype=np.uint64) for v in zip(*tiles))
+        tileids = zxy_to_tileid_array(zs, xs, ys)
+        self.assertEqual(tileids.tolist(), [_zxy_to_tileid_reference(*t) for t in tiles])
+        z, x, y = tileid_to_zxy_array(tileids)
+        self.assertEqual(list(zip(z.tolist(), x.tolist(), y.tolist())), tiles)
+        with self.assertRaises(ValueError):
+            zxy_to_tileid_array(np.array([1]), np.array([2]), np.array([0]))
+        with self.assertRaises(OverflowError):
+            tileid_to_zxy_array(np.array([18446744073709551615], dtype=np.uint64))
+
+class TestTileRanges(unittest.TestCase):
+    def expand(self, ranges):
+        for (_, a), (b, _) in zip(ranges, ranges[1:]):
+            self.assertLess(a, b)
+        return [t for start, stop in ranges for t in range(start, stop)]
+
+    def test_merge_ranges(self):
+        self.assertEqual(merge_ranges([(5, 7), (0, 2), (2, 3), (6, 9)]), [(0, 3), (5, 9)])
+
+    def test_rect(self):
+        rng = random.Random(15)
+        for _ in range(200):
+            z = rng.randint(0, 6)
+            n = 1 << z
+            min_x, max_x = sorted((rng.randrange(n), rng.randrange(n)))
+            min_y, max_y = sorted((rng.randrange(n), rng.randrange(n)))
+            expected = sorted(
+                zxy_to_tileid(z, x, y)
+                for x in range(min_x, max_x + 1)
+                for y in range(min_y, max_y + 1)
+            )
+            ranges = rect_tileid_ranges(z, min_x, min_y, max_x, max_y)
+            self.assertEqual(self.expand(ranges), expected)
+
+    def test_bbox(self):
+        rng = random.Random(16)
+        for _ in range(100):
+            lons = sorted((rng.uniform(-180, 180), rng.uniform(-180, 180)))
+            lats = sorted((rng.uniform(-85, 85), rng.uniform(-85, 85)))
+            if rng.random() < 0.2:
+                lons.reverse()
+            bbox = (lons[0], lats[0], lons[1], lats[1])
+            expected = []
+            for z in range(2, 7):
+                n = 1 << z
+                x0, y1 = lonlat_to_world(bbox[0], bbox[1])
+                x1, y0 = lonlat_to_world(bbox[2], bbox[3])
+                xs = [(x0, x1)] if x0 <= x1 else [(x0, 1.0), (0.0, x1)]
+                cols = {
+                    x for a, b in xs for x in range(math.floor(a * n), math.ceil(b * n))
+                }
+                rows = range(math.floor(y0 * n), math.ceil(y1 * n))
+                expected.extend(zxy_to_tileid(z, x, y) for x in cols for y in rows)
+            ranges = bbox_tileid_ranges(bbox, 2, 6)
+            self.assertEqual(self.expand(ranges), sorted(expected))
+
+    def test_whole_world(self):
+        ranges = bbox_tileid_ranges((-180, -90, 180, 90), 0, 14)
+        self.assertEqual(ranges, [(0, zxy_to_tileid(15, 0, 0))])
+
+    def test_point(self):
+        ranges = bbox_tileid_ranges((-122.4, 37.8, -122.4, 37.8), 10, 10)
+        self.assertEqual(len(self.expand(ranges)), 1)
+
+
 class TestFindTile(unittest.TestCase):
     def test_find_tile_missing(self):
         entries = []
@@ -111,6 +256,19 @@ class TestFindTile(unittest.TestCase):
         self.assertEqual(result.offset, 1)
         self.assertEqual(result.length, 1)
 
+    def test_find_tile_directory(self):
+        entries = [Entry(3, 3, 1, 2), Entry(5, 5, 1, 2), Entry(10, 7, 1, 0)]
+        directory = Directory.from_entries(entries)
+        for tile_id in range(0, 20):
+            expected = find_tile(entries, tile_id)
+            result = find_tile(directory, tile_id)
+            if expected is None:
+                self.assertEqual(result, None)
+            else:
+                self.assertEqual(result.tile_id, expected.tile_id)
+                self.assertEqual(result.offset, expected.offset)
+        self.assertEqual(find_tile(Directory(), 0), None)
+
 
 class TestDirectory(unittest.TestCase):
     def test_roundtrip(self):
@@ -131,6 +289,74 @@ class TestDirectory(unittest.TestCase):
         self.assertEqual(result[2].length, 2)
         self.assertEqual(result[2].run_length, 2)
 
+    def test_directory_columns(self):
+        entries = [Entry(i, i * 10, 10, 1) for i in range(100)]
+        directory = Directory.from_entries(entries)
+        self.assertEqual(len(directory), 100)
+        self.assertEqual(directory.nbytes, 100 * 4 * 8)
+        self.assertEqual(serialize_directory(directory), serialize_directory(entries))
+        self.assertEqual(deserialize_directory(serialize_directory(entries)), directory)
+        part = directory[10:20]
+        self.assertIsInstance(part, Directory)
+        self.assertEqual([e.tile_id for e in part], list(range(10, 20)))
+        self.assertEqual(directory[-1].offset, 990)
+
+    def test_roundtrip_large(self):
+        directory = Directory()
+        offset = 0
+        for i in range(3000):
+            length = (i * 7919) % 5000 + 1
+            if i % 5 == 0:
+                directory.append(i * 3, i, length, 1)
+            else:
+                directory.append(i * 3, offset, length, i % 3)
+            offset += length
+        serialized = serialize_directory(directory)
+        self.assertEqual(deserialize_directory(serialized), directory)
+
+        numpy = pmtiles.tile.np
+        pmtiles.tile.np = None
+        try:
+            self.assertEqual(serialize_directory(directory), serialized)
+            self.assertEqual(deserialize_directory(serialized), directory)
+        finally:
+            pmtiles.tile.np = numpy
+
+    def test_optimize_directories(self):
+        entries = [Entry(i, i, 1, 1) for i in range(20000)]
+        directory = Directory.from_entries(entries)
+        root, leaves, num_leaves = optimize_directories(directory, 100)
+        expected_root, expected_leaves, expected_num_leaves = optimize_directories(
+            entries, 100
+        )
+        self.assertEqual(num_leaves, expected_num_leaves)
+        self.assertEqual(len(leaves), len(expected_leaves))
+        self.assertEqual(deserialize_directory(root), deserialize_directory(expected_root))
+
+    def test_estimate_leaf_size(self):
+        self.assertEqual(estimate_leaf_size(100, 16257), 4096)
+        self.assertEqual(estimate_leaf_size(2709 * 4096, 16257), 4096)
+        self.assertEqual(estimate_leaf_size(2709 * 4096 + 1, 16257), 8192)
+        self.assertEqual(estimate_leaf_size(1 << 32, 16257), 1 << 21)
+
+    def test_optimize_directories_parallel(self):
+        rng = random.Random(3)
+        directory = Directory()
+        tile_id = 0
+        for i in range(50000):
+            tile_id += rng.randint(1, 100)
+            directory.append(tile_id, i * 10, 10, 1)
+        root, leaves, num_leaves = optimize_directories(directory, 16257)
+        self.assertEqual(num_leaves, 13)
+        for executor in (ThreadPoolExecutor(4), ProcessPoolExecutor(2)):
+            with executor:
+                parallel = optimize_directories(directory, 16257, executor)
+            self.assertEqual(parallel[2], num_leaves)
+            self.assertEqual(len(parallel[1]), len(leaves))
+            self.assertEqual(
+                deserialize_directory(parallel[0]), deserialize_directory(root)
+            )
+
 
 class TestHeader(unittest.TestCase):
     def test_roundtrip(self):
@@ -0,0 +1,158 @@
+import os
+import random
+import unittest
+from pmtiles.writer import Writer
+from pmtiles.reader import Reader, MemorySource, all_tiles, iter_entries
+from pmtiles.update import update
+from pmtiles.tile import Compression, TileType, tileid_to_zxy
+
+
+def write_archive(fname, tiles, metadata=None):
+    with open(fname, "wb") as f:
+        writer = Writer(f)
+        for tile_id in sorted(tiles):
+            writer.write_tile(tile_id, tiles[tile_id])
+        writer.finalize(
+            {"tile_compression": Compression.NONE, "tile_type": TileType.MVT},
+            metadata or {"name": "before"},
+        )
+        return writer
+
+
+def scattered_tiles(n, seed):
+    rng = random.Random(seed)
+    return {t: b"%d" % t for t in rng.sample(range(20 * n), n)}
+
+
+class TestUpdate(unittest.TestCase):
+    def tearDown(self):
+        try:
+            os.remove("test_update.pmtiles")
+        except FileNotFoundError:
+            pass
+
+    def check(self, tiles):
+        with open("test_update.pmtiles", "rb") as f:
+            buf = f.read()
+        self.assertEqual(
+            list(all_tiles(MemorySource(buf))),
+            [(tileid_to_zxy(t), tiles[t]) for t in sorted(tiles)],
+        )
+        entries = list(iter_entries(MemorySource(buf)))
+        header = Reader(MemorySource(buf)).header()
+        self.assertEqual(header["addressed_tiles_count"], len(tiles))
+        self.assertEqual(header["tile_entries_count"], len(entries))
+        return buf, header
+
+    def test_update_leaves(self):
+        rng = random.Random(19)
+        tiles = {}
+        tile_id = 0
+        for i in range(20000):
+            tile_id += rng.randint(1, 300)
+            tiles[tile_id] = b"sea" if i % 10 < 6 else str(i).encode()
+        write_archive("test_update.pmtiles", tiles)
+        size = os.path.getsize("test_update.pmtiles")
+        with open("test_update.pmtiles", "rb") as f:
+            leaves_length = Reader(MemorySource(f.read())).header()["leaf_directory_length"]
+
+        nearby = sorted(tiles)[5000:5300]
+        changed = {t: b"new %d" % t for t in rng.sample(nearby, 50)}
+        added = {t + 1: b"sea" for t in rng.sample(nearby, 50)}
+        deleted = rng.sample(nearby, 50)
+        update("test_update.pmtiles", {**changed, **added}, deleted)
+        for t in deleted:
+            tiles.pop(t, None)
+        tiles.update(changed)
+        tiles.update(added)
+        for t in deleted:
+            if t not in changed and t not in added:
+                tiles.pop(t, None)
+
+        buf, header = self.check(tiles)
+        self.assertEqual(header["clustered"], False)
+        # only the new data and the leaves touched are appended
+        self.assertLess(len(buf) - size, leaves_length // 2)
+
+    def test_scattered_across_leaves(self):
+        # every change rewrites a different leaf, so the root's pointers stop
+        # being contiguous and it outgrows its slot
+        tiles = scattered_tiles(100000, 19)
+        write_archive("test_update.pmtiles", tiles)
+        with open("test_update.pmtiles", "rb") as f:
+            before = Reader(MemorySource(f.read())).header()
+        size = os.path.getsize("test_update.pmtiles")
+        rng = random.Random(19)
+        appended_tiles = 0
+        for n in (5, 30, 100, 100, 100):
+            changed = {t: b"new %d" % t for t in rng.sample(sorted(tiles), n)}
+            update("test_update.pmtiles", changed)
+            tiles.update(changed)
+            appended_tiles += sum(len(data) for data in changed.values())
+            if n == 5:
+                # at most 5 of the 25 leaves are rewritten
+                appended = os.path.getsize("test_update.pmtiles") - size
+                self.assertLess(appended, before["leaf_directory_length"] // 3)
+        buf, header = self.check(tiles)
+        self.assertEqual(
+            header["tile_data_length"], before["tile_data_length"] + appended_tiles
+        )
+        self.assertEqual(
+            header["leaf_directory_length"] - before["leaf_directory_length"]
+            + header["tile_data_length"] - before["tile_data_length"]
+            + header["metadata_length"],
+            len(buf) - size,
+        )
+
+    def test_crash_before_header(self):
+        # a crash just before the header is written leaves the old archive
+        tiles = scattered_tiles(20000, 21)
+        description = random.Random(21).randbytes(1500).hex()
+        write_archive("test_update.pmtiles", tiles, {"description": description})
+        with open("test_update.pmtiles", "rb") as f:
+            old = f.read()
+        changed = {t: b"new" for t in random.Random(22).sample(sorted(tiles), 30)}
+        update("test_update.pmtiles", changed)
+        with open("test_update.pmtiles", "rb") as f:
+            new = f.read()
+        self.assertNotEqual(new[:127], old[:127])
+        self.assertEqual(
+            list(all_tiles(MemorySource(old[:127] + new[127:]))),
+            [(tileid_to_zxy(t), tiles[t]) for t in sorted(tiles)],
+        )
+        tiles.update(changed)
+        self.check(tiles)
+
+    def test_update_root_only(self):
+        tiles = {t: b"%d" % (t % 3) for t in range(0, 50)}
+        write_archive("test_update.pmtiles", tiles)
+        rng = random.Random(20)
+        added = {t: rng.randbytes(8) for t in range(1000, 20000, 3)}
+        update("test_update.pmtiles", added, deleted=[7, 8, 9], metadata={"name": "after"})
+        for t in (7, 8, 9):
+            del tiles[t]
+        tiles.update(added)
+        buf, header = self.check(tiles)
+        self.assertEqual(Reader(MemorySource(buf)).metadata(), {"name": "after"})
+        self.assertEqual(header["max_zoom"], 7)
+
+    def test_root_grows_within_first_16k(self):
+        # the root outgrows its slot before the metadata but still fits in
+        # the first 16 KiB, so it must stay a root without leaves
+        tiles = {t: b"%d" % t for t in range(1000)}
+        write_archive("test_update.pmtiles", tiles)
+        with open("test_update.pmtiles", "rb") as f:
+            before = Reader(MemorySource(f.read())).header()
+        update("test_update.pmtiles", tiles={2000: b"new"})
+        tiles[2000] = b"new"
+        buf, header = self.check(tiles)
+        self.assertGreater(header["root_length"], before["metadata_offset"] - before["root_offset"])
+        reader = Reader(MemorySource(buf))
+        root = reader.directory(header["root_offset"], header["root_length"])
+        self.assertTrue(all(e.run_length > 0 for e in root))
+        self.assertEqual(reader.get(0, 0, 0), b"0")
+
+    def test_delete_everything(self):
+        write_archive("test_update.pmtiles", {0: b"a", 1: b"b"})
+        with self.assertRaises(ValueError):
+            update("test_update.pmtiles", deleted=[0, 1])